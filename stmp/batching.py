@@ -0,0 +1,99 @@
+import json
+import asyncio
+from typing import Callable, Dict, List
+
+from .settings import BROADCAST_BATCH_DELAY, BROADCAST_BATCH_SIZE
+from .stmp_server.transilation.serializers import SERIALIZERS, RawJSON, DEFAULT_SERIALIZER
+
+
+class _Batch:
+    """Messages waiting to go out together"""
+
+    __slots__ = ("items", "size", "timer")
+
+    def __init__(self) -> None:
+        self.items: List[list] = []  # [namespace, RawJSON data]
+        self.size = 0
+        self.timer: asyncio.TimerHandle = None
+
+
+def batch_body(items: List[list]) -> RawJSON:
+    """The [[namespace, data], ..] batch body, spliced from the serialised messages"""
+    return RawJSON(
+        b"["
+        + b",".join(
+            b"[" + json.dumps(namespace).encode() + b"," + data + b"]"
+            for namespace, data in items
+        )
+        + b"]"
+    )
+
+
+class BroadcastBatcher:
+    """Coalesces small broadcasts into batches (one per port). A batch goes out `delay`
+    seconds after its first message, or right away once it has `max_size` bytes of messages
+
+    The messages are serialised once, when they are added (changing the data afterwards
+    doesn't change what goes out), the batch body is spliced from those.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[int, List[list]], None],
+        delay: float = BROADCAST_BATCH_DELAY,
+        max_size: int = BROADCAST_BATCH_SIZE,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        send:   callable
+            called with the port and the [namespace, data] items of a batch to send it (the
+            data is `RawJSON`, see `batch_body`)
+        delay:  float
+            max time (seconds) a message waits for the others
+        max_size:   int
+            bytes of (JSON serialised) messages in a batch
+        """
+        self.send = send
+        self.delay = delay
+        self.max_size = max_size
+        self._batches: Dict[int, _Batch] = {}
+        self._serializer = SERIALIZERS[DEFAULT_SERIALIZER]
+
+    def add(self, namespace: str, data, port: int = None) -> bool:
+        """Queue a message for the next batch
+
+        Returns
+        -------
+        bool
+            False if the message can't be batched (not JSON serialisable, bigger than a batch,
+            or no running event loop to send the batch later), it should be sent by itself
+        """
+        try:
+            loop = asyncio.get_running_loop()
+            dumped = RawJSON(self._serializer.dumps(data))
+        except (RuntimeError, TypeError, ValueError):
+            return False
+        size = len(dumped) + len(namespace) + 6  # the item brackets, quotes and commas
+        if size > self.max_size:
+            return False
+
+        batch = self._batches.get(port)
+        if batch is not None and batch.size + size > self.max_size:
+            self.flush(port)
+            batch = None
+        if batch is None:
+            batch = self._batches[port] = _Batch()
+            batch.timer = loop.call_later(self.delay, self.flush, port)
+        batch.items.append([namespace, dumped])
+        batch.size += size
+        return True
+
+    def flush(self, port: int = None, all_ports: bool = False):
+        """Send the pending batch of a port (or all of them) right away"""
+        for port in list(self._batches) if all_ports else [port]:
+            batch = self._batches.pop(port, None)
+            if batch is None:
+                continue
+            batch.timer.cancel()
+            self.send(port, batch.items)
@@ -0,0 +1,161 @@
+import random
+import hashlib
+from typing import Iterable, List, Optional, Tuple
+
+from .interfaces import Peer
+from .registry import PeerRegistry
+
+# anti-entropy (gossip) helpers : compact digests of the peer table and the deltas to exchange
+
+FP_LEN = 8  # fingerprint prefix used in the digests
+
+# a peer table entry as it goes on the wire (a list, to keep the datagrams small)
+ENTRY_FIELDS = ("ip", "user", "hostname", "udpport", "tcpport", "key_fp", "hv", "age")
+
+
+def entry(peer: Peer, now: float) -> list:
+    """Wire form of a peer (`age` : seconds since the peer was last heard of)"""
+    return [
+        peer.ip,
+        peer.user,
+        peer.hostname,
+        peer.udpport,
+        peer.tcpport,
+        peer.key_fp,
+        peer.hv,
+        max(0, int(now - peer.update_time)),
+    ]
+
+
+def parse_entry(raw) -> Optional[dict]:
+    """A received entry as a header like dict, None if it's malformed"""
+    if not isinstance(raw, list) or len(raw) != len(ENTRY_FIELDS):
+        return None
+    parsed = dict(zip(ENTRY_FIELDS, raw))
+    if not (
+        isinstance(parsed["ip"], str)
+        and isinstance(parsed["key_fp"], str)
+        and isinstance(parsed["udpport"], int)
+        and isinstance(parsed["tcpport"], int)
+        and isinstance(parsed["age"], (int, float))
+    ):
+        return None
+    return parsed
+
+
+def table_hash(peers: Iterable[Peer]) -> str:
+    """Hash of the membership of a peer table (ips and keys, not the times)"""
+    members = sorted(f"{peer.ip}/{(peer.key_fp or '')[:FP_LEN]}" for peer in peers)
+    return hashlib.sha1("\n".join(members).encode()).hexdigest()[:16]
+
+
+def digest(peers: List[Peer], now: float, limit: int) -> dict:
+    """Compact digest of a peer table : the membership hash, the number of peers and
+    [ip, fingerprint prefix, age] of (a random pick of at most `limit`) peers
+    """
+    sample = peers if len(peers) <= limit else random.sample(peers, limit)
+    return {
+        "h": table_hash(peers),
+        "n": len(peers),
+        "d": [
+            [peer.ip, (peer.key_fp or "")[:FP_LEN], max(0, int(now - peer.update_time))]
+            for peer in sample
+        ],
+    }
+
+
+def deltas(
+    registry: PeerRegistry,
+    remote: dict,
+    now: float,
+    min_gain: float,
+    limit: int,
+    exclude: str = None,
+) -> Tuple[List[list], List[str]]:
+    """Compare a received digest with the local table
+
+    Parameters
+    ----------
+    registry:   PeerRegistry
+        the local peer table
+    remote:     dict
+        digest of the remote table (see `digest`)
+    now:    float
+        current time
+    min_gain:   float
+        an entry is worth sending only if it's fresher than the remote one by this much (seconds)
+    limit:  int
+        max entries (and wants) to return
+    exclude:    str
+        ip not to send an entry of (the remote peer itself)
+
+    Returns
+    -------
+    tuple[list, list[str]]
+        entries the remote peer is missing (or has older), ips the remote peer knows better
+    """
+    entries, wants, seen = [], [], set()
+    items = remote.get("d")
+    for item in items if isinstance(items, list) else ():
+        if not (
+            isinstance(item, list)
+            and len(item) == 3
+            and isinstance(item[0], str)
+            and isinstance(item[1], str)
+            and isinstance(item[2], (int, float))
+        ):
+            continue
+        ip, fp, age = item
+        seen.add(ip)
+        peer = registry.get(ip)
+        if peer is None:
+            wants.append(ip)
+            continue
+        local_age = now - peer.update_time
+        if (peer.key_fp or "")[:FP_LEN] != fp:
+            # a new key, the fresher one wins
+            if local_age < age:
+                entries.append(entry(peer, now))
+            else:
+                wants.append(ip)
+        elif local_age + min_gain < age:
+            entries.append(entry(peer, now))
+        elif age + min_gain < local_age:
+            wants.append(ip)
+
+    if remote.get("h") != table_hash(registry.values()):
+        # some peers are not in the remote table, all the unlisted ones if the digest is
+        # complete, otherwise a random pick of them (the next rounds will get the rest)
+        others = [peer for ip, peer in registry.items() if ip not in seen and ip != exclude]
+        room = limit - len(entries)
+        if room > 0 and others:
+            if len(others) > room:
+                others = random.sample(others, room)
+            entries.extend(entry(peer, now) for peer in others)
+    return entries[:limit], wants[:limit]
+
+
+def entries_for(registry: PeerRegistry, ips: Iterable[str], now: float, limit: int) -> list:
+    """Entries of the requested peers (the ones we know)"""
+    entries = []
+    for ip in ips:
+        peer = registry.get(ip) if isinstance(ip, str) else None
+        if peer is not None:
+            entries.append(entry(peer, now))
+            if len(entries) >= limit:
+                break
+    return entries
+
+
+def parse_seeds(seeds: Iterable, default_port: int) -> List[Tuple[str, int]]:
+    """Seed peers given as "host", "host:port" or (host, port)"""
+    parsed = []
+    for seed in seeds or ():
+        if isinstance(seed, str):
+            host, _, port = seed.partition(":")
+            parsed.append((host, int(port) if port else default_port))
+        else:
+            host, port = seed
+            parsed.append((host, int(port)))
+    return parsed
+
@@ -15,26 +15,121 @@ class BasePropertyClass:
                     raise ValueError(f"{self.__class__} doesn't have propery : {key}")
 
 
-class PacketHeader(BasePropertyClass):
+class SlottedPropertyClass:
+    """Base of the compact (`__slots__`) interfaces, same keyword constructor as
+    `BasePropertyClass`. Slots can't have class level defaults, so they go in `_defaults`
+    (an unset field reads its default as well).
+    The public ones (`Packet`, `Peer`) have a "__dict__" slot too, the applications may add
+    their own attributes (the dict is only allocated then)
+    """
+
+    __slots__ = ()
+    _defaults: dict = {}
+    _fields: tuple = ()  # the slots, but "__dict__"
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._fields = tuple(key for key in cls.__slots__ if key != "__dict__")
+
+    def __init__(self, strict_parse: bool = False, **kwargs) -> None:
+        for key, val in self._defaults.items():
+            setattr(self, key, val)
+        fields = self._fields
+        for key, val in kwargs.items():
+            if key in fields:
+                setattr(self, key, val)
+            elif strict_parse:
+                raise ValueError(f"{self.__class__} doesn't have propery : {key}")
+
+    def __getattr__(self, key: str):
+        # only reached for the unset slots (and the unknown attributes)
+        try:
+            return self._defaults[key]
+        except KeyError:
+            raise AttributeError(
+                f"'{self.__class__.__name__}' object has no attribute '{key}'"
+            ) from None
+
+    def __repr__(self) -> str:
+        fields = ", ".join(
+            f"{key}={getattr(self, key)!r}" for key in self._fields if hasattr(self, key)
+        )
+        return f"{self.__class__.__name__}({fields})"
+
+
+class PacketHeader(SlottedPropertyClass):
     user: str
     hostname: str
     udpport: int
     tcpport: int
-    encrypted: bool = False
-    public_key: str = None
-    namespace: str = None
+    encrypted: bool  # False
+    cipher: str  # None
+    key_fp: str  # None
+    public_key: str  # None
+    namespace: str  # None
+    hv: int  # 0, header version supported by the sender
+    ser: str  # None, body serializer (JSON if not set)
+    cmp: str  # None, body compression (not compressed if not set)
+
+    __slots__ = tuple(__annotations__)
+    _defaults = {
+        "encrypted": False,
+        "cipher": None,
+        "key_fp": None,
+        "public_key": None,
+        "namespace": None,
+        "hv": 0,
+        "ser": None,
+        "cmp": None,
+    }
+
+    @classmethod
+    def from_header(cls, header: dict) -> "PacketHeader":
+        """Create from a decoded header dict (the unknown keys are ignored)"""
+        obj = cls.__new__(cls)
+        get = header.get
+        obj.user = get("user")
+        obj.hostname = get("hostname")
+        obj.udpport = get("udpport")
+        obj.tcpport = get("tcpport")
+        obj.encrypted = get("encrypted", False)
+        obj.cipher = get("cipher")
+        obj.key_fp = get("key_fp")
+        obj.public_key = get("public_key")
+        obj.namespace = get("namespace")
+        obj.hv = get("hv", 0)
+        obj.ser = get("ser")
+        obj.cmp = get("cmp")
+        return obj
 
 
-class Packet(BasePropertyClass):
+class Packet(SlottedPropertyClass):
     """Interface of message packets"""
 
-    data = None
+    data: object  # None, bytes-like for the "raw" serializer
     headers: PacketHeader
     sender: str
     protocol: Literal["UDP", "TCP"]
+    params: dict  # values extracted from the namespace pattern of the route
 
+    __slots__ = tuple(__annotations__) + ("__dict__",)
+    _defaults = {"data": None}
 
-class Peer(BasePropertyClass):
+    @classmethod
+    def from_header(
+        cls, data, header: dict, sender: str, protocol: str, params: dict = None
+    ) -> "Packet":
+        """Create from the decoded body and header"""
+        obj = cls.__new__(cls)
+        obj.data = data
+        obj.headers = PacketHeader.from_header(header)
+        obj.sender = sender
+        obj.protocol = protocol
+        obj.params = params if params is not None else {}
+        return obj
+
+
+class Peer(SlottedPropertyClass):
     """Interface of Peer object"""
 
     user: str
@@ -43,4 +138,35 @@ class Peer(BasePropertyClass):
     udpport: int
     tcpport: int
     public_key: str  # public encyption key
+    key_fp: str  # public key fingerprint
+    # 0, header version supported by the peer (1: binary headers, 2: compressed bodies,
+    # 3: batches, 4: UDP fragments, 5: header version in the binary header)
+    hv: int
     update_time: float
+
+    __slots__ = tuple(__annotations__) + ("__dict__",)
+    _defaults = {"hv": 0}
+
+    @classmethod
+    def from_header(
+        cls,
+        header: dict,
+        ip: str,
+        update_time: float,
+        public_key: str = None,
+        key_fp: str = None,
+    ) -> "Peer":
+        """Create from a decoded header (public key and fingerprint are passed separately,
+        as the header may have only one of them)"""
+        obj = cls.__new__(cls)
+        get = header.get
+        obj.user = get("user")
+        obj.hostname = get("hostname")
+        obj.ip = ip
+        obj.udpport = get("udpport")
+        obj.tcpport = get("tcpport")
+        obj.public_key = public_key
+        obj.key_fp = key_fp
+        obj.hv = get("hv", 0)
+        obj.update_time = update_time
+        return obj
@@ -0,0 +1,121 @@
+import heapq
+from typing import Dict, Iterator, List, Set, Tuple
+
+from .interfaces import Peer
+
+
+class PeerRegistry:
+    """Peer table (ip -> Peer) with an expiry heap and a few secondary indexes
+
+    The heap holds (update_time, ip) entries, a single one per peer. Refreshing a peer
+    doesn't touch the heap, the entry is pushed back with the new time when it pops up
+    and the peer turns out to be refreshed in the meantime. So an expiry check only looks
+    at the peers that may have expired (O(log n) each) instead of scanning all of them.
+    """
+
+    # indexed peer attributes
+    _indexed = ("user", "hostname", "key_fp")
+
+    def __init__(self) -> None:
+        self._peers: Dict[str, Peer] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._scheduled: Set[str] = set()  # ips having an entry in the heap
+        # attribute -> value -> ips
+        self._indexes: Dict[str, Dict[str, Set[str]]] = {
+            attr: {} for attr in self._indexed
+        }
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    def __contains__(self, ip: str) -> bool:
+        return ip in self._peers
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._peers)
+
+    def get(self, ip: str, default: Peer = None) -> Peer:
+        return self._peers.get(ip, default)
+
+    def values(self):
+        return self._peers.values()
+
+    def items(self):
+        return self._peers.items()
+
+    def add(self, peer: Peer):
+        """Add a peer or replace the one with the same ip"""
+        old = self._peers.get(peer.ip)
+        if old is not None:
+            self._unindex(old)
+        self._peers[peer.ip] = peer
+        self._index(peer)
+        if peer.ip not in self._scheduled:
+            self._scheduled.add(peer.ip)
+            heapq.heappush(self._heap, (peer.update_time, peer.ip))
+
+    def remove(self, ip: str) -> Peer:
+        """Remove a peer (None if it's not known), its heap entry is dropped lazily"""
+        peer = self._peers.pop(ip, None)
+        if peer is not None:
+            self._unindex(peer)
+        return peer
+
+    def expire(self, ttl: float, now: float) -> List[Peer]:
+        """Remove the peers not updated in the last `ttl` seconds
+
+        Returns
+        -------
+        list[Peer]
+            the removed peers
+        """
+        removed = []
+        deadline = now - ttl
+        heap = self._heap
+        while heap and heap[0][0] < deadline:
+            _, ip = heapq.heappop(heap)
+            peer = self._peers.get(ip)
+            if peer is None:
+                self._scheduled.discard(ip)  # removed already
+            elif peer.update_time >= deadline:
+                heapq.heappush(heap, (peer.update_time, ip))  # refreshed in between
+            else:
+                self._scheduled.discard(ip)
+                removed.append(self.remove(ip))
+        return removed
+
+    def update_index(self, peer: Peer, attr: str, value: str):
+        """Change an indexed attribute of a known peer in place"""
+        self._discard(attr, getattr(peer, attr, None), peer.ip)
+        setattr(peer, attr, value)
+        if value is not None:
+            self._indexes[attr].setdefault(value, set()).add(peer.ip)
+
+    def by_user(self, user: str) -> List[Peer]:
+        return self._lookup("user", user)
+
+    def by_hostname(self, hostname: str) -> List[Peer]:
+        return self._lookup("hostname", hostname)
+
+    def by_fingerprint(self, key_fp: str) -> List[Peer]:
+        return self._lookup("key_fp", key_fp)
+
+    def _lookup(self, attr: str, value: str) -> List[Peer]:
+        return [self._peers[ip] for ip in self._indexes[attr].get(value, ())]
+
+    def _index(self, peer: Peer):
+        for attr in self._indexed:
+            value = getattr(peer, attr, None)
+            if value is not None:
+                self._indexes[attr].setdefault(value, set()).add(peer.ip)
+
+    def _unindex(self, peer: Peer):
+        for attr in self._indexed:
+            self._discard(attr, getattr(peer, attr, None), peer.ip)
+
+    def _discard(self, attr: str, value: str, ip: str):
+        ips = self._indexes[attr].get(value)
+        if ips is not None:
+            ips.discard(ip)
+            if not ips:
+                del self._indexes[attr][value]
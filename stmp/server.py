@@ -1,23 +1,73 @@
 import time
+import random
+import socket
 import asyncio
 import inspect
 from typing import List, Dict
 from .stmp_server import STMPServerBase
-from .interfaces import PacketHeader, Packet, Peer
+from .stmp_server.executors import call_handler, EXECUTOR_KINDS
+from .interfaces import Packet, Peer
+from .registry import PeerRegistry
+from . import gossip as anti_entropy
+from .batching import BroadcastBatcher, batch_body
 from .exceptions import InvalidImplementation, UsageError
-from .settings import logger, PEER_DISCOVERY_INTERVEL, PEER_TTL, PEER_CLEANUP_INTERVEL
+from .stmp_server.transilation.enc import fingerprint
+from .stmp_server.transilation import TransilationProtocol
+from .stmp_server.transilation.headers import BinaryHeader
+from .stmp_server.transilation.serializers import SERIALIZERS
+from .settings import (
+    logger,
+    PEER_DISCOVERY_INTERVEL,
+    PEER_TTL,
+    PEER_CLEANUP_INTERVEL,
+    KEY_REQUEST_INTERVEL,
+    HEADER_FORMAT,
+    COMPRESSION,
+    ROUTE_CONCURRENCY,
+    ROUTE_QUEUE_SIZE,
+    ROUTE_DROP_POLICY,
+    PEER_REPLY_JITTER,
+    PEER_REPLY_PROTOCOL,
+    PEER_KNOWN_ANSWERS_MAX,
+    PEER_DISCOVERY_JITTER,
+    GOSSIP_INTERVEL,
+    GOSSIP_FANOUT,
+    GOSSIP_DIGEST_MAX,
+    GOSSIP_MAX_ENTRIES,
+    GOSSIP_PROBES_MAX,
+    BROADCAST_BATCH,
+    BROADCAST_BATCH_DELAY,
+    BROADCAST_BATCH_SIZE,
+)
+
+KNOWN_ANSWER_LEN = 8  # fingerprint prefix listed in the discovery requests
 
 
 class STMPServer(STMPServerBase):
     """Advanced server interface for STMPServerBase!"""
 
-    _peers: Dict[str, Peer] = {}  # ip -> Peer
-    _peer_list_update_callbacks = []
-
     # public attr
     PEER_DISCOVERY_INTERVEL = PEER_DISCOVERY_INTERVEL
     PEER_TTL = PEER_TTL
     PEER_CLEANUP_INTERVEL = PEER_CLEANUP_INTERVEL
+    KEY_REQUEST_INTERVEL = KEY_REQUEST_INTERVEL
+    HEADER_FORMAT = HEADER_FORMAT
+    COMPRESSION = COMPRESSION
+    ROUTE_CONCURRENCY = ROUTE_CONCURRENCY
+    ROUTE_QUEUE_SIZE = ROUTE_QUEUE_SIZE
+    ROUTE_DROP_POLICY = ROUTE_DROP_POLICY
+    PEER_REPLY_JITTER = PEER_REPLY_JITTER
+    PEER_REPLY_PROTOCOL = PEER_REPLY_PROTOCOL
+    PEER_KNOWN_ANSWERS_MAX = PEER_KNOWN_ANSWERS_MAX
+    PEER_DISCOVERY_JITTER = PEER_DISCOVERY_JITTER
+    GOSSIP_INTERVEL = GOSSIP_INTERVEL
+    GOSSIP_FANOUT = GOSSIP_FANOUT
+    GOSSIP_DIGEST_MAX = GOSSIP_DIGEST_MAX
+    GOSSIP_MAX_ENTRIES = GOSSIP_MAX_ENTRIES
+    GOSSIP_PROBES_MAX = GOSSIP_PROBES_MAX
+    BROADCAST_BATCH = BROADCAST_BATCH
+    BROADCAST_BATCH_DELAY = BROADCAST_BATCH_DELAY
+    BROADCAST_BATCH_SIZE = BROADCAST_BATCH_SIZE
 
     # propertis
     @property
@@ -38,7 +88,7 @@ class STMPServer(STMPServerBase):
     def hostname(self):
         self._t_protocol.decode_parts["hostname"]
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, *args, gossip: bool = False, seeds: list = None, **kwargs) -> None:
         """STMPServer!
 
         Parameters
@@ -54,41 +104,133 @@ class STMPServer(STMPServerBase):
             oprtation port to be used
         tcpport
             tcp port used for full featured communication
+        tcp_backlog     int
+            listen backlog of the TCP socket
+        tcp_max_connections     int
+            maximum number of incoming TCP connections served at a time
+        udp_rcvbuf      int
+            SO_RCVBUF of the UDP socket (kernel side buffer for the bursts)
+        udp_fragment_size   int
+            UDP packets bigger than this are sent as fragments, to the peers supporting them
+            (None to send them as they are)
+        gossip      bool
+            sync the peer table with the known peers (anti-entropy), so the peers can be learnt
+            through each other. On if seeds are given
+        seeds       list
+            peers to gossip with even if they are not discovered (multicast filtered across the
+            segments), "host", "host:port" or (host, port). The UDP port is the default port
         """
         super().__init__(*args, **kwargs)
+        self.gossip_enabled = bool(gossip or seeds)
+        self._seeds = anti_entropy.parse_seeds(seeds, self.udp_transport.port)
+        self._peers = PeerRegistry()  # ip -> Peer
+        self._peer_list_update_callbacks = []
+        self._peer_update_callbacks = []
+        self.metrics.callback("peers", "known peers", lambda: {(): len(self._peers)})
+        self._key_requests: Dict[str, float] = {}  # ip -> last key request time
+        self._gossip_probes = [0.0, 0]  # start of the probe window, probes sent in it
+        self._legacy_peers = set()  # ips of the peers not reading our binary headers
+        self._uncompressed_peers = set()  # ips of the peers not supporting compressed bodies
+        self._unbatched_peers = set()  # ips of the peers not supporting batches
+        self._unfragmented_peers = set()  # ips of the peers not supporting UDP fragments
+        self._batcher = BroadcastBatcher(
+            self.__send_batch, self.BROADCAST_BATCH_DELAY, self.BROADCAST_BATCH_SIZE
+        )
+        self._pending_replies = set()  # ips of the peers waiting for a discovery reply
+        self._m_discovery_replies = self.metrics.counter(
+            "discovery_replies_total", "answers to the discovery requests", ("result",)
+        )
+        self._m_gossip = self.metrics.counter(
+            "gossip_total", "gossip messages and the peers learnt through them", ("event",)
+        )
         self.__bind_private_callbacks()
 
     # decorators
-    def route(self, namespace: str):
+    def route(
+        self,
+        namespace: str,
+        concurrency: int = None,
+        offload: str = None,
+        queue_size: int = None,
+        drop_policy: str = None,
+        serializer: str = None,
+    ):
         """Provide with a routing decorator, can be used for adding namespace
         the callback will be called with instance of `Packet` as the first argument
 
+        The callback can be a coroutine function (`async def`) as well, it will be run as a
+        separate task so it won't hold the receive loop. CPU heavy (blocking) callbacks can be
+        offloaded to a thread or a process pool in the same way, so they won't hold it either.
+
+        Every route has its own bounded inbound queue, the packets wait there for the callback.
+        See `queue_stats` for the depth and drop counters.
+
         Parameters
         ----------
         namespace:  str
-            message routing namespace
+            message routing namespace, can have params ("/room/{id}/msg") or end with a
+            wildcard ("/sensors/*"). The extracted values are available as `Packet.params`
+        concurrency:    int
+            max number of coroutine callbacks running at a time for this route (the rest will
+            wait for their turn). `ROUTE_CONCURRENCY` by default
+        offload:    str
+            run the (non coroutine) callback in the "thread" pool or the "process" pool.
+            For the process pool, the packet data should be picklable, the return value is
+            ignored and the route should be added before the server starts (needs fork)
+        queue_size: int
+            max packets waiting for the callback. `ROUTE_QUEUE_SIZE` by default
+        drop_policy:    str
+            once the queue is full "drop-oldest", "drop-newest" or "block" (holds the TCP connection
+            of the sender, the other ones go on). `ROUTE_DROP_POLICY` by default
+        serializer: str
+            body serializer ("json", "raw" or "msgpack") of the messages sent to this route by
+            `send_to_peer`, `send_to_user` and `broadcast` when they are not given one
         """
+        if offload is not None and offload not in EXECUTOR_KINDS:
+            raise UsageError(f"unknown offload '{offload}', use one of {EXECUTOR_KINDS}")
+        if serializer is not None and serializer not in SERIALIZERS:
+            raise UsageError(f"unknown (or not installed) serializer : {serializer}")
 
         def inner(func: callable):
+            is_coroutine = inspect.iscoroutinefunction(func)
+            if offload and is_coroutine:
+                raise UsageError(f"coroutine route '{namespace}' can't be offloaded")
+            if offload == "process":
+                handler, handler_args = call_handler, (self._offloaded.register(func),)
+            else:
+                handler, handler_args = func, ()
+
             # validate function from the begining
             num_args = len(inspect.signature(func).parameters)
             if num_args != 1:
-                InvalidImplementation(
+                raise InvalidImplementation(
                     f"Route function for '{namespace}' accepts excatly 1 arg. {num_args} were given!"
                 )
 
             def namespace_callback(
-                body: dict, header: dict, sender_id: str, protocol: str
+                body: dict, header: dict, sender_id: str, protocol: str, params: dict
             ):
-                packet = Packet(
-                    data=body,
-                    headers=PacketHeader(**header),
-                    sender=sender_id,
-                    protocol=protocol,
+                packet = Packet.from_header(
+                    body, header, sender_id, protocol, dict(params) if params else {}
                 )
-                func(packet)
-
-            self.add_callback(namespace=namespace, callback=namespace_callback)
+                if offload:
+                    if offload == "process" and isinstance(body, memoryview):
+                        packet.data = body.tobytes()
+                    return self._offload(offload, handler, *handler_args, packet)
+                return func(packet)  # awaited by the route queue if it's a coroutine
+
+            namespace_callback.serializer = serializer  # see `route_serializer`
+            self.add_callback(
+                namespace=namespace,
+                callback=namespace_callback,
+                concurrency=(
+                    concurrency or self.ROUTE_CONCURRENCY
+                    if is_coroutine or offload
+                    else 1
+                ),
+                queue_size=queue_size or self.ROUTE_QUEUE_SIZE,
+                drop_policy=drop_policy or self.ROUTE_DROP_POLICY,
+            )
 
             def modified(*args):
                 raise UsageError(
@@ -103,15 +245,27 @@ class STMPServer(STMPServerBase):
         """PeerJoin Event decorator, called whenever a new peer is joined
         the callback will be called with instance of `Peer` as the first argument (`new_peer`) and
         instance of `list[Peer]` as second arugument (`removed_peers`)
+        The callback can be a coroutine function as well.
         """
+        is_coroutine = inspect.iscoroutinefunction(func)
         num_args = len(inspect.signature(func).parameters)
         if num_args != 2:
-            InvalidImplementation(
+            raise InvalidImplementation(
                 f"peer_list_update event handler accepts exactly 2 arg. {num_args} were given!"
             )
 
         def callback(new_peer, removed_peers):
-            func(new_peer, removed_peers)
+            if is_coroutine:
+                self._spawn(
+                    self._run_handler(
+                        func, new_peer, removed_peers, context="on_peer_list_update"
+                    )
+                )
+                return
+            try:
+                func(new_peer, removed_peers)
+            except Exception as exp:
+                self._handle_error(exp, "on_peer_list_update")
 
         self._peer_list_update_callbacks.append(callback)
 
@@ -120,6 +274,54 @@ class STMPServer(STMPServerBase):
 
         return modified
 
+    def on_peer_update(self, func: callable):
+        """PeerUpdate Event decorator, called whenever the key or a port of a known peer changes
+        the callback will be called with the updated instance of `Peer` as the first argument
+        (`peer`) and the list of changed attributes as the second argument (`changed`)
+        The callback can be a coroutine function as well.
+        """
+        is_coroutine = inspect.iscoroutinefunction(func)
+        num_args = len(inspect.signature(func).parameters)
+        if num_args != 2:
+            raise InvalidImplementation(
+                f"peer_update event handler accepts exactly 2 arg. {num_args} were given!"
+            )
+
+        def callback(peer, changed):
+            if is_coroutine:
+                self._spawn(
+                    self._run_handler(func, peer, changed, context="on_peer_update")
+                )
+                return
+            try:
+                func(peer, changed)
+            except Exception as exp:
+                self._handle_error(exp, "on_peer_update")
+
+        self._peer_update_callbacks.append(callback)
+
+        def modified(*args):
+            raise UsageError("The Event handler is not intented to be called outside!")
+
+        return modified
+
+    def on_error(self, func: callable):
+        """Error event decorator, called whenever a route or an event handler raises
+        the callback will be called with the exception as the first argument and the context
+        (namespace or the event name) as the second argument
+        """
+        num_args = len(inspect.signature(func).parameters)
+        if num_args != 2:
+            raise InvalidImplementation(
+                f"error handler accepts exactly 2 arg. {num_args} were given!"
+            )
+        self.add_error_handler(func)
+
+        def modified(*args):
+            raise UsageError("The Event handler is not intented to be called outside!")
+
+        return modified
+
     # private routes
     def __bind_private_callbacks(self):
         """Bind private routes and other callbacks"""
@@ -127,68 +329,452 @@ class STMPServer(STMPServerBase):
         # middlewares
         def peer_check(_: dict, header: dict, sender_id: str, *args):
             # automated peer addition
-            peer = Peer(update_time=time.time(), ip=sender_id, **header)
-            if sender_id not in self._peers:
-                logger.debug(f"new peer added : {peer.user}@{sender_id}")
-                [
-                    callback(new_peer=peer, removed_peers=[])
-                    for callback in self._peer_list_update_callbacks
-                ]
-            self._peers[sender_id] = peer
+            update_peer(header, sender_id, time.time())
+
+        def update_peer(header: dict, sender_id: str, update_time: float):
+            # add a new peer or refresh a known one (heard of directly only, the gossip entries
+            # are relayed by third parties, see `apply_entries`)
+            known = self._peers.get(sender_id)
+            if known is not None:
+                refresh_peer(known, header, update_time)
+                return
+
+            public_key = header.get("public_key")
+            if public_key:
+                key_fp = fingerprint(public_key)
+            else:
+                # only the fingerprint is passed, the key should be already known
+                key_fp = header.get("key_fp")
+                if key_fp:
+                    self.request_key(sender_id, header["udpport"])
+
+            peer = Peer.from_header(
+                header,
+                ip=sender_id,
+                update_time=update_time,
+                public_key=public_key,
+                key_fp=key_fp,
+            )
+            self._track_hv(sender_id, peer.hv)
+            logger.debug(f"new peer added : {peer.user}@{sender_id}")
+            self._peers.add(peer)
+            [
+                callback(new_peer=peer, removed_peers=[])
+                for callback in self._peer_list_update_callbacks
+            ]
+
+        def refresh_peer(peer: Peer, header: dict, update_time: float):
+            # a known peer, only the changes are applied (nothing changes most of the time)
+            peer.update_time = update_time
+            changed = None
+
+            public_key = header.get("public_key")
+            if public_key:
+                if public_key != peer.public_key:
+                    changed = ["public_key"]
+                    peer.public_key = public_key
+                    key_fp = fingerprint(public_key)
+                    if key_fp != peer.key_fp:
+                        changed.append("key_fp")
+                        self._peers.update_index(peer, "key_fp", key_fp)
+            else:
+                key_fp = header.get("key_fp")
+                if key_fp and key_fp != peer.key_fp:
+                    # the peer got a new key, we have only got its fingerprint
+                    changed = ["key_fp", "public_key"]
+                    peer.public_key = None
+                    self._peers.update_index(peer, "key_fp", key_fp)
+                if key_fp and not peer.public_key:
+                    self.request_key(peer.ip, header["udpport"])
+
+            for attr in ("udpport", "tcpport"):
+                value = header.get(attr)
+                if value is not None and value != getattr(peer, attr):
+                    setattr(peer, attr, value)
+                    changed = (changed or []) + [attr]
+
+            hv = header.get("hv", 0)
+            if hv != peer.hv:
+                peer.hv = hv
+                self._track_hv(peer.ip, hv)
+            for attr in ("user", "hostname"):
+                value = header.get(attr)
+                if value is not None and value != getattr(peer, attr):
+                    self._peers.update_index(peer, attr, value)
+
+            if changed:
+                logger.debug(f"peer updated : {peer.user}@{peer.ip} : {changed}")
+                for callback in self._peer_update_callbacks:
+                    callback(peer, changed)
 
         self.add_middleware(peer_check)
 
         # routes
         def peer_join(body: dict, header: dict, sender_id: str, protcol: str):
-            if protcol.upper() == "UDP":
-                # considering the peer request to be included
-                self.send_tcp(
-                    "iamheredude",
-                    to_addr=sender_id,
-                    to_port=header["tcpport"],
-                    namespace="/peer-join",
+            if protcol.upper() != "UDP":
+                return  # a reply, `peer_check` got it already
+            # considering the peer request to be included, unless it knows us already
+            # (older peers send a plain string, without the known list)
+            known = body.get("known") if isinstance(body, dict) else None
+            key_fp = self._t_protocol.default_header.get("key_fp")
+            if known and key_fp and key_fp[:KNOWN_ANSWER_LEN] in known:
+                self._m_discovery_replies.inc(("suppressed",))
+                return
+            if sender_id in self._pending_replies:
+                self._m_discovery_replies.inc(("coalesced",))
+                return  # a reply is on the way
+            self._pending_replies.add(sender_id)
+            # replying in background, a slow peer shouldn't hold the receive loop
+            self._spawn(
+                self.reply_peer_join(sender_id, header["udpport"], header["tcpport"])
+            )
+
+        self.add_callback(namespace="/peer-join", callback=peer_join)
+        # nothing to do on "/peer-here" (UDP discovery replies), `peer_check` got it already
+
+        # NOTE : the discovery and key exchange packets always go in the legacy format (JSON
+        # header, plain body), whatever `HEADER_FORMAT` says, every peer has to read them
+
+        def key_request(body: dict, header: dict, sender_id: str, protcol: str):
+            # the peer doesn't know our key (yet), resending it
+            self.send_udp(
+                "hereismykeydude",
+                "/key-exchange",
+                to_addr=sender_id,
+                to_port=header["udpport"],
+                pass_pub_key=True,
+            )
+
+        self.add_callback(namespace="/key-request", callback=key_request)
+        # nothing to do on "/key-exchange", `peer_check` will pick the key up
+
+        def gossip_message(body: dict, header: dict, sender_id: str, protcol: str):
+            # syn (digest) -> ack (entries the sender misses, ips we want) -> ack2 (those entries)
+            if not self.gossip_enabled or not isinstance(body, dict):
+                return
+            kind, now, reply = body.get("t"), time.time(), None
+            if kind == "syn":
+                entries, wants = anti_entropy.deltas(
+                    self._peers,
+                    body,
+                    now,
+                    min_gain=self.GOSSIP_INTERVEL,
+                    limit=self.GOSSIP_MAX_ENTRIES,
+                    exclude=sender_id,
+                )
+                if entries or wants:
+                    reply = {"t": "ack", "e": entries, "w": wants}
+            elif kind in ("ack", "ack2"):
+                apply_entries(body.get("e"), sender_id, now)
+                wants = body.get("w")
+                if kind == "ack" and isinstance(wants, list) and wants:
+                    entries = anti_entropy.entries_for(
+                        self._peers, wants, now, self.GOSSIP_MAX_ENTRIES
+                    )
+                    if entries:
+                        reply = {"t": "ack2", "e": entries}
+            else:
+                return
+            self._m_gossip.inc((kind,))
+            if reply:
+                self.send_udp(
+                    reply,
+                    "/gossip",
                     enc_key=False,
-                    pass_pub_key=True,
+                    to_addr=sender_id,
+                    to_port=header["udpport"],
                 )
 
-        self.add_callback(namespace="/peer-join", callback=peer_join)
+        def apply_entries(entries: list, sender_id: str, now: float):
+            if not isinstance(entries, list):
+                return
+            own_fp = self._t_protocol.default_header.get("key_fp")
+            for raw in entries[: self.GOSSIP_MAX_ENTRIES]:
+                parsed = anti_entropy.parse_entry(raw)
+                if parsed is None or parsed["ip"] == sender_id or parsed["key_fp"] == own_fp:
+                    continue  # the sender (`peer_check` got it) or ourself
+                if parsed["age"] >= self.PEER_TTL:
+                    continue
+                seen = now - parsed["age"]
+                known = self._peers.get(parsed["ip"])
+                # the entries are not authenticated, the peer table (and the capabilities) change
+                # only by hearing from the peer itself. An unknown one is asked for its key,
+                # `peer_check` adds it once it answers
+                if known is None:
+                    if probe_peer(parsed["ip"], parsed["udpport"], now):
+                        self._m_gossip.inc(("probed",))
+                    continue
+                if seen <= known.update_time:
+                    continue  # we've heard of it more recently
+                # only the liveness is taken from them
+                known.update_time = seen
+                self._m_gossip.inc(("refreshed",))
+                if (parsed["key_fp"], parsed["udpport"], parsed["tcpport"]) != (
+                    known.key_fp,
+                    known.udpport,
+                    known.tcpport,
+                ):
+                    probe_peer(known.ip, known.udpport, now)
+
+        def probe_peer(ip: str, udpport: int, now: float) -> bool:
+            # key requests on behalf of the gossip entries, a few per round whatever the
+            # senders say (they'd have us sending datagrams to any address otherwise)
+            window = self._gossip_probes
+            if now - window[0] >= self.GOSSIP_INTERVEL:
+                window[:] = [now, 0]
+            if window[1] >= self.GOSSIP_PROBES_MAX:
+                return False
+            if not self.request_key(ip, udpport):
+                return False  # asked a moment ago
+            window[1] += 1
+            return True
+
+        self.add_callback(namespace="/gossip", callback=gossip_message)
 
     # coroutines
     async def cleanup_peers(self):
         """Clean up old peer data"""
         while True:
             await asyncio.sleep(self.PEER_CLEANUP_INTERVEL)
-            removed_peers = {}
-            now = time.time()
-            for key, peer in self._peers.items():
-                if (now - peer.update_time) > self.PEER_TTL:
-                    removed_peers[key] = peer
-                    logger.debug(f"peer removed : {peer.user}@{peer.ip}")
+            removed_peers = self._peers.expire(self.PEER_TTL, now=time.time())
             if removed_peers:
-                for key in removed_peers.keys():
-                    del self._peers[key]
+                for peer in removed_peers:
+                    logger.debug(f"peer removed : {peer.user}@{peer.ip}")
+                    self._key_requests.pop(peer.ip, None)
+                    self._track_hv(peer.ip, None)
                 [
-                    callback(new_peer=None, removed_peers=removed_peers.values())
+                    callback(new_peer=None, removed_peers=removed_peers)
                     for callback in self._peer_list_update_callbacks
                 ]
-            removed_peers = {}
 
     async def ping_for_address_update(self):
         """Request other peers to send their address"""
         await asyncio.sleep(5)  # give some time for the TCP recievers to readyup
+        # introducing ourselves with the full key the first time, fingerprint is enough after that
+        pass_pub_key = True
+        while True:
+            self.request_sync(pass_pub_key=pass_pub_key)
+            pass_pub_key = False
+            # jittered, so the peers started together won't keep asking together
+            jitter = self.PEER_DISCOVERY_JITTER
+            await asyncio.sleep(
+                self.PEER_DISCOVERY_INTERVEL * random.uniform(1 - jitter, 1 + jitter)
+            )
+
+    async def reply_peer_join(self, peer_ip: str, udpport: int, tcpport: int):
+        """Answer a discovery request after a random delay (`PEER_REPLY_JITTER`), so the
+        requester is not flooded with the replies of the whole LAN at once
+
+        Parameters
+        ----------
+        peer_ip:    str
+            ip of the requester
+        udpport:    int
+            UDP port of the requester
+        tcpport:    int
+            TCP port of the requester
+        """
+        try:
+            await asyncio.sleep(random.uniform(0, self.PEER_REPLY_JITTER))
+        finally:
+            self._pending_replies.discard(peer_ip)
+        self._m_discovery_replies.inc(("sent",))
+        if self.PEER_REPLY_PROTOCOL.upper() == "UDP":
+            self.send_udp(
+                "iamheredude",
+                "/peer-here",
+                enc_key=False,
+                to_addr=peer_ip,
+                to_port=udpport,
+                pass_pub_key=True,
+            )
+            return
+        await self.send_tcp_async(
+            "iamheredude",
+            to_addr=peer_ip,
+            to_port=tcpport,
+            namespace="/peer-join",
+            enc_key=False,
+            pass_pub_key=True,
+        )
+
+    async def gossip_peers(self):
+        """Gossip rounds (if enabled) : a digest of the peer table goes to a few random peers
+        (`GOSSIP_FANOUT`) and a seed every `GOSSIP_INTERVEL`. They answer with only what differs
+        """
+        if not self.gossip_enabled:
+            return
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(random.uniform(0, self.GOSSIP_INTERVEL))
         while True:
-            self.request_sync()
-            await asyncio.sleep(self.PEER_DISCOVERY_INTERVEL)
+            peers = list(self._peers.values())
+            targets = {
+                peer.ip: peer.udpport
+                for peer in random.sample(peers, min(self.GOSSIP_FANOUT, len(peers)))
+            }
+            if self._seeds:
+                host, port = random.choice(self._seeds)
+                try:
+                    infos = await loop.getaddrinfo(
+                        host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM
+                    )
+                    targets.setdefault(infos[0][4][0], port)
+                except OSError as exp:
+                    logger.debug(f"can't resolve the seed '{host}' : {exp}")
+
+            digest = anti_entropy.digest(peers, time.time(), self.GOSSIP_DIGEST_MAX)
+            syn = {"t": "syn", **digest}
+            for addr, port in targets.items():
+                self.send_udp(syn, "/gossip", enc_key=False, to_addr=addr, to_port=port)
+            await asyncio.sleep(self.GOSSIP_INTERVEL * random.uniform(0.75, 1.25))
 
     # methods
-    def request_sync(self):
-        """Request other peers to send their address"""
+    def request_sync(self, pass_pub_key: bool = False):
+        """Request other peers to send their address. The peers we have heard from within the
+        last `PEER_DISCOVERY_INTERVEL` are listed in the request (known answers), they won't reply
+
+        Parameters
+        ----------
+        pass_pub_key:   bool
+            whether to send the full public key along with the request or only its fingerprint
+        """
+        self.send_udp(
+            {"q": "gimmeurnumberdude", "known": self.known_answers()},
+            "/peer-join",
+            enc_key=False,
+            pass_pub_key=pass_pub_key,
+        )
+
+    def known_answers(self) -> List[str]:
+        """Fingerprint prefixes of the peers which needn't answer a discovery request : the
+        ones (with a known key) heard from within the last intervel. Peers missed their last
+        announcement are asked again. At most `PEER_KNOWN_ANSWERS_MAX` (a random pick) so the
+        request fits in a datagram, the rest just reply
+        """
+        fresh_after = time.time() - self.PEER_DISCOVERY_INTERVEL
+        known = [
+            peer.key_fp[:KNOWN_ANSWER_LEN]
+            for peer in self._peers.values()
+            if peer.public_key and peer.key_fp and peer.update_time > fresh_after
+        ]
+        if len(known) > self.PEER_KNOWN_ANSWERS_MAX:
+            known = random.sample(known, self.PEER_KNOWN_ANSWERS_MAX)
+        return known
+
+    def request_key(self, peer_ip: str, udpport: int) -> bool:
+        """Ask a peer to resend its public key (we have only got its fingerprint)
+
+        Parameters
+        ----------
+        peer_ip:    str
+            ip of the peer
+        udpport:    int
+            UDP port of the peer
+
+        Returns
+        -------
+        bool
+            False if the peer was asked a moment ago (`KEY_REQUEST_INTERVEL`)
+        """
+        now = time.time()
+        requests = self._key_requests
+        if (now - requests.get(peer_ip, 0)) < self.KEY_REQUEST_INTERVEL:
+            return False  # already asked, wait for the reply
+        if len(requests) > len(self._peers) + self.GOSSIP_PROBES_MAX:
+            # the ones not answering (gossip probes) would pile up otherwise
+            for ip, asked in list(requests.items()):
+                if now - asked >= self.KEY_REQUEST_INTERVEL:
+                    del requests[ip]
+        requests[peer_ip] = now
+        logger.debug(f"requesting public key of : {peer_ip}")
         self.send_udp(
-            "gimmeurnumberdude", "/peer-join", enc_key=False, pass_pub_key=True
+            "gimmeurkeydude",
+            "/key-request",
+            to_addr=peer_ip,
+            to_port=udpport,
+            pass_pub_key=True,
         )
+        return True
+
+    def route_serializer(self, namespace: str) -> str:
+        """Serializer set (see `route`) for the route a namespace resolves to, None if not set"""
+        for route, _ in self._router.resolve(namespace):
+            serializer = getattr(route.callback, "serializer", None)
+            if serializer:
+                return serializer
+        return None
+
+    def binary_header_for(self, peer: Peer = None) -> bool:
+        """Whether the compact binary header can be used for sending to the peer
+
+        Parameters
+        ----------
+        peer:   Peer
+            the receiver, all the peers (multicast) if not provided. Multicasts stay in JSON
+            until some peer is known (the unknown ones may not support it)
+        """
+        if self.HEADER_FORMAT != "auto":
+            return self.HEADER_FORMAT == "binary"
+        if peer is None:
+            return bool(self._peers) and not self._legacy_peers
+        return peer.hv >= BinaryHeader.hv_version
+
+    def compression_for(self, peer: Peer = None) -> str:
+        """Compression to be used for sending to the peer (None if it doesn't support it)
+
+        Parameters
+        ----------
+        peer:   Peer
+            the receiver, all the peers (multicast) if not provided. Multicasts aren't
+            compressed until some peer is known
+        """
+        if not self.COMPRESSION:
+            return None
+        if peer is None:
+            if not self._peers or self._uncompressed_peers:
+                return None
+            return self.COMPRESSION
+        if peer.hv >= TransilationProtocol.compression_version:
+            return self.COMPRESSION
+        return None
+
+    def fragment_for(self, peer: Peer = None) -> bool:
+        """Whether the big UDP packets to the peer can go as fragments (IP fragmentation
+        otherwise)
+
+        Parameters
+        ----------
+        peer:   Peer
+            the receiver, all the peers (multicast) if not provided. Multicasts aren't
+            fragmented until some peer is known
+        """
+        if not self.udp_transport.fragmenter.fragment_size:
+            return False
+        if peer is None:
+            return bool(self._peers) and not self._unfragmented_peers
+        return peer.hv >= TransilationProtocol.fragment_version
+
+    def _track_hv(self, peer_ip: str, hv: int):
+        """Keep the sets of the peers lacking binary headers / compressed bodies / batches /
+        UDP fragments up to date (hv None : the peer is gone)"""
+        for min_hv, peers in (
+            (BinaryHeader.hv_version, self._legacy_peers),
+            (TransilationProtocol.compression_version, self._uncompressed_peers),
+            (TransilationProtocol.batch_version, self._unbatched_peers),
+            (TransilationProtocol.fragment_version, self._unfragmented_peers),
+        ):
+            if hv is not None and hv < min_hv:
+                peers.add(peer_ip)
+            else:
+                peers.discard(peer_ip)
 
     def send_to_peer(
-        self, namespace: str, data, peer_ip: str, encrypt: bool = True
+        self,
+        namespace: str,
+        data,
+        peer_ip: str,
+        encrypt: bool = True,
+        serializer: str = None,
     ) -> bool:
         """Send TCP message to discovered peer
 
@@ -202,11 +788,18 @@ class STMPServer(STMPServerBase):
             ip of peer
         encrypt:    bool
             whether to encyrpt the body or not
+        serializer: str
+            body serializer : "json", "raw" or "msgpack" (if installed). The one of the route by
+            default (see `route`), otherwise bytes-like data goes raw and everything else as JSON
 
         """
         peer = self._peers.get(peer_ip)
         if not peer:
             return None
+        if encrypt and not peer.public_key:
+            logger.warning(f"public key of {peer_ip} is not known yet, can't encrypt")
+            self.request_key(peer_ip, peer.udpport)
+            return False
 
         return self.send_tcp(
             data,
@@ -214,10 +807,98 @@ class STMPServer(STMPServerBase):
             to_addr=peer_ip,
             to_port=peer.tcpport,
             enc_key=peer.public_key if encrypt else "",
-            pass_pub_key=True,
+            binary_header=self.binary_header_for(peer),
+            serializer=serializer or self.route_serializer(namespace),
+            compression=self.compression_for(peer),
         )
 
-    def broadcast(self, namespace: str, data, port: int = None):
+    async def send_to_peer_async(
+        self,
+        namespace: str,
+        data,
+        peer_ip: str,
+        encrypt: bool = True,
+        serializer: str = None,
+    ) -> bool:
+        """Send TCP message to discovered peer without blocking the event loop.
+        Accepts the same parameters as `send_to_peer`
+        """
+        peer = self._peers.get(peer_ip)
+        if not peer:
+            return None
+        if encrypt and not peer.public_key:
+            logger.warning(f"public key of {peer_ip} is not known yet, can't encrypt")
+            self.request_key(peer_ip, peer.udpport)
+            return False
+
+        return await self.send_tcp_async(
+            data,
+            namespace=namespace,
+            to_addr=peer_ip,
+            to_port=peer.tcpport,
+            enc_key=peer.public_key if encrypt else "",
+            binary_header=self.binary_header_for(peer),
+            serializer=serializer or self.route_serializer(namespace),
+            compression=self.compression_for(peer),
+        )
+
+    def peers_of(self, user: str) -> List[Peer]:
+        """Peers logged in as the given user (a user can be on more than one host)"""
+        return self._peers.by_user(user)
+
+    def send_to_user(
+        self,
+        namespace: str,
+        data,
+        user: str,
+        encrypt: bool = True,
+        serializer: str = None,
+    ) -> Dict[str, bool]:
+        """Send TCP message to all the peers of a user. Accepts the same parameters as
+        `send_to_peer` (the `user` instead of `peer_ip`)
+
+        Returns
+        -------
+        dict[str, bool]
+            peer ip -> result of `send_to_peer`
+        """
+        return {
+            peer.ip: self.send_to_peer(
+                namespace, data, peer.ip, encrypt=encrypt, serializer=serializer
+            )
+            for peer in self._peers.by_user(user)
+        }
+
+    async def send_to_user_async(
+        self,
+        namespace: str,
+        data,
+        user: str,
+        encrypt: bool = True,
+        serializer: str = None,
+    ) -> Dict[str, bool]:
+        """Send TCP message to all the peers of a user without blocking the event loop
+        (concurrently). Accepts the same parameters as `send_to_user`
+        """
+        peers = self._peers.by_user(user)
+        results = await asyncio.gather(
+            *[
+                self.send_to_peer_async(
+                    namespace, data, peer.ip, encrypt=encrypt, serializer=serializer
+                )
+                for peer in peers
+            ]
+        )
+        return {peer.ip: result for peer, result in zip(peers, results)}
+
+    def broadcast(
+        self,
+        namespace: str,
+        data,
+        port: int = None,
+        serializer: str = None,
+        batch: bool = None,
+    ):
         """Send a UDP multicast message to all the connected peers
 
         Parameters
@@ -228,8 +909,58 @@ class STMPServer(STMPServerBase):
             data to be sent
         port:       int
             port to which send the data
+        serializer: str
+            body serializer : "json", "raw" or "msgpack" (if installed). The one of the route by
+            default (see `route`), otherwise bytes-like data goes raw and everything else as JSON
+        batch:      bool
+            coalesce the message with the other small broadcasts (JSON ones) into a single
+            datagram, sent in a few milliseconds (`BROADCAST_BATCH_DELAY`) or once the batch is
+            full. Defaults to `BROADCAST_BATCH`. Sent right away if no peer is known yet or some
+            peer can't split the batches (see `Peer.hv`)
         """
-        return self.send_udp(data, namespace=namespace, to_port=port, pass_pub_key=True)
+        if batch is None:
+            batch = self.BROADCAST_BATCH
+        serializer = serializer or self.route_serializer(namespace)
+        if (
+            batch
+            and serializer in (None, "json")
+            and self._peers
+            and not self._unbatched_peers
+            and self._batcher.add(namespace, data, port)
+        ):
+            return
+        return self.send_udp(
+            data,
+            namespace=namespace,
+            to_port=port,
+            binary_header=self.binary_header_for(),
+            serializer=serializer,
+            compression=self.compression_for(),
+            fragment=self.fragment_for(),
+        )
+
+    def flush_broadcasts(self):
+        """Send the pending broadcast batches right away"""
+        self._batcher.flush(all_ports=True)
+
+    def __send_batch(self, port: int, items: List[list]):
+        if len(items) == 1:
+            # nothing to coalesce with, goes as a plain packet
+            namespace, data = items[0]
+        else:
+            namespace, data = TransilationProtocol.batch_namespace, batch_body(items)
+        try:
+            self.send_udp(
+                data,
+                namespace=namespace,
+                to_port=port,
+                binary_header=self.binary_header_for(),
+                serializer="json",
+                compression=self.compression_for(),
+                fragment=self.fragment_for(),
+            )
+        except Exception as exp:
+            self._handle_error(exp, "broadcast batch")
 
     # overrides
     async def listen(self):
@@ -237,6 +968,8 @@ class STMPServer(STMPServerBase):
         return await asyncio.gather(
             self.listen_udp_async(),
             self.listen_tcp_async(),
+            self.listen_metrics_async(),
             self.cleanup_peers(),
             self.ping_for_address_update(),
+            self.gossip_peers(),
         )
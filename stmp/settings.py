@@ -10,6 +10,86 @@ TCP_PORT = 57001  # certainly TCP port
 
 TCP_TIMEOUT = 5  # in seconds
 
+# UDP receive buffers (a datagram can't be bigger than this anyway)
+UDP_MAX_DATAGRAM = 65535
+UDP_RCVBUF = 4 * 1024 * 1024  # socket SO_RCVBUF (None to keep the system default)
+
+# datagrams are drained from the socket in batches (till it runs dry) and dispatched together
+UDP_BATCH_SIZE = 256  # max datagrams in a batch
+UDP_BATCH_BUFFER = 1024 * 1024  # size of the buffer a batch is received into
+UDP_MAX_PENDING_BATCHES = 16  # stop draining the socket if these many batches are waiting
+
+# UDP fragmentation : datagrams bigger than UDP_FRAGMENT_SIZE go as fragments and are put back
+# together by the receivers (a single lost IP fragment loses the whole datagram, and nothing
+# above ~64KB goes at all otherwise). Used only if every receiver supports it. None to turn it off
+UDP_FRAGMENT_SIZE = 1400  # in bytes, fragment header included (fits the usual 1500 MTU)
+UDP_MAX_FRAGMENTS = 4096  # fragments a message can have
+UDP_REASSEMBLY_BUFFER = 16 * 1024 * 1024  # bytes of the incomplete messages (oldest dropped)
+UDP_REASSEMBLY_MAX_MESSAGES = 256  # incomplete messages kept (oldest dropped)
+UDP_REASSEMBLY_MAX_PER_SENDER = 32  # incomplete messages kept per sender ip (same)
+UDP_REASSEMBLY_TIMEOUT = 2  # in seconds, incomplete messages not getting a fragment are dropped
+UDP_NACK_DELAY = 0.05  # in seconds, wait before asking the sender for the missing fragments
+UDP_NACK_RETRIES = 3  # NACKs sent for an incomplete message (0 to turn retransmission off)
+UDP_RETRANSMIT_BUFFER = 8 * 1024 * 1024  # bytes of the sent fragments kept for the NACKs
+
+# outgoing TCP connection pool (keep-alive connections to peers)
+TCP_POOL_MAX_CONNECTIONS = 32  # max idle connections kept open
+TCP_POOL_IDLE_TIMEOUT = 30  # in seconds (should be less than TCP_KEEPALIVE_TIMEOUT)
+
+# time for an incoming TCP connection to stay open without any message
+TCP_KEEPALIVE_TIMEOUT = 60  # in seconds
+
+# incoming TCP connections
+TCP_BACKLOG = 128  # listen backlog (pending connections the kernel queues for us)
+TCP_MAX_CONNECTIONS = 256  # connections served at a time, the rest will wait for a slot
+TCP_READ_QUEUE_SIZE = 1024  # messages read and waiting to be dispatched (readers wait after that)
+
+# body encryption ("hybrid": RSA wrapped AES-GCM session keys, "rsa": RSA only (legacy, ~86 bytes max))
+ENCRYPTION_MODE = "hybrid"
+SESSION_KEY_TTL = 10 * 60  # in seconds, a new session key will be used for a peer after that
+SESSION_KEY_MAX_MESSAGES = 1_000_000  # or after encrypting these many messages with it
+SESSION_KEY_CACHE_SIZE = 1024  # session keys remembered (per direction)
+KEY_CACHE_SIZE = 1024  # parsed peer public keys (and their ciphers) kept in memory
+KEY_REQUEST_INTERVEL = 5  # in seconds, min gap between two key requests to a peer
+
+# body compression ("zlib", "lz4" or "zstd" if installed, None to turn it off). Bodies bigger than
+# COMPRESSION_MIN_SIZE are compressed before the encryption, for the peers supporting it
+COMPRESSION = "zlib"
+COMPRESSION_MIN_SIZE = 512  # in bytes (of the serialised body)
+
+# broadcast batching (opt-in) : small JSON broadcasts are coalesced into a single datagram sharing
+# one header, for the peers supporting it
+BROADCAST_BATCH = False  # batch all the broadcasts (can be asked per broadcast as well)
+BROADCAST_BATCH_DELAY = 0.005  # in seconds, a batch goes out this long after its first message
+BROADCAST_BATCH_SIZE = 1200  # in bytes (of serialised messages), a full batch goes out right away
+
+# async (coroutine) route handlers running at a time, per route
+ROUTE_CONCURRENCY = 16
+
+# inbound queue of every route (between the packet decoding and the callback)
+ROUTE_QUEUE_SIZE = 1024
+# what to do once a route queue is full : "drop-oldest", "drop-newest" or "block" (holds the
+# TCP connection of the sender, so it waits for the ack. UDP packets are dropped (newest) anyway)
+ROUTE_DROP_POLICY = "drop-oldest"
+
+# executor for decrypting/decoding the packet bodies (None: on the event loop, "thread" or "process")
+DECODE_EXECUTOR = None
+DECODE_OFFLOAD_MIN_SIZE = 4096  # plain (not encrypted) bodies smaller than this stay on the loop
+EXECUTOR_WORKERS = None  # workers per executor (None: decided by concurrent.futures, ~cpu count)
+
+# metrics
+METRICS_PORT = None  # serve the metrics (prometheus text format) over http on this port
+METRICS_HOST = "127.0.0.1"  # interface to serve them on ("" for all of them)
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)  # in seconds
+METRICS_MAX_LABEL_SETS = 1000  # per metric, the namespaces beyond are counted as "other"
+
+# namespaces whose route resolution is cached
+ROUTER_CACHE_SIZE = 1024
+
+# packet header encoding ("json", "binary" or "auto": binary only for peers advertising support,
+# multicast goes binary only if all the known peers support it)
+HEADER_FORMAT = "auto"
+
 # peer cleanup intervel (check for TTL)
 PEER_CLEANUP_INTERVEL = 10  # in seconds
 
@@ -18,3 +98,17 @@ PEER_DISCOVERY_INTERVEL = 3 * 60  # in seconds
 
 # time for a peer object to live in memory even if didn't appeared again
 PEER_TTL = PEER_DISCOVERY_INTERVEL + 60  # in seconds
+
+# discovery replies ("/peer-join" requests are answered after a random delay, and only by the
+# peers the requester doesn't know already, so a big LAN won't answer all at once)
+PEER_REPLY_JITTER = 2  # in seconds, max random delay before answering a discovery request
+PEER_REPLY_PROTOCOL = "TCP"  # "TCP" or "UDP" (a unicast datagram, no connection setup)
+PEER_KNOWN_ANSWERS_MAX = 64  # known peers listed in a discovery request (they won't reply)
+PEER_DISCOVERY_JITTER = 0.1  # the periodic requests are spread over this fraction of the intervel
+
+# gossip (anti-entropy) peer table sync, off by default (turned on by `gossip=True` or seeds)
+GOSSIP_INTERVEL = 10  # in seconds, between two gossip rounds
+GOSSIP_FANOUT = 2  # known peers gossiped with in a round (plus a seed)
+GOSSIP_DIGEST_MAX = 32  # peers listed in a digest (a random pick beyond that)
+GOSSIP_MAX_ENTRIES = 16  # peer entries sent in a message (keeps it within a datagram)
+GOSSIP_PROBES_MAX = 4  # peers heard of only through gossip asked for their key, per GOSSIP_INTERVEL
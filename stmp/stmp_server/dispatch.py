@@ -0,0 +1,193 @@
+import time
+import asyncio
+import inspect
+from typing import Dict, List
+
+from .router import Route
+from ..exceptions import UsageError
+from ..settings import logger, ROUTE_QUEUE_SIZE, ROUTE_DROP_POLICY
+
+DROP_POLICIES = ("drop-oldest", "drop-newest", "block")
+
+
+class RouteQueue:
+    """Bounded inbound queue of a route, drained by its own worker tasks
+
+    A route returning an awaitable (coroutine routes, offloaded routes) is awaited by the
+    worker, so the number of workers is the concurrency of the route.
+    """
+
+    def __init__(
+        self,
+        route: Route,
+        maxsize: int = ROUTE_QUEUE_SIZE,
+        drop_policy: str = ROUTE_DROP_POLICY,
+        workers: int = 1,
+        on_error: callable = None,
+        latency=None,
+    ) -> None:
+        if drop_policy not in DROP_POLICIES:
+            raise UsageError(
+                f"unknown drop policy '{drop_policy}', use one of {DROP_POLICIES}"
+            )
+        self.route = route
+        self.maxsize = maxsize
+        self.drop_policy = drop_policy
+        self.workers = workers
+        self.on_error = on_error
+        self.latency = latency  # Histogram of the handler latency (optional)
+
+        # counters
+        self.dropped = 0
+        self.dispatched = 0
+        self.max_depth = 0
+
+        self._queue: asyncio.Queue = None
+        self._loop: asyncio.AbstractEventLoop = None
+        self._tasks: List[asyncio.Task] = []
+        self._blocked = 0  # messages waiting for room ("block" policy)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def _start(self, loop: asyncio.AbstractEventLoop):
+        """Create the queue and the workers on the running loop"""
+        for task in self._tasks:
+            task.cancel()
+        self._loop = loop
+        self._queue = asyncio.Queue(self.maxsize)
+        self._blocked = 0
+        self._tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    def put(self, item: tuple, can_block: bool = False) -> asyncio.Task:
+        """Queue a message (body, header, sender_id, protocol, params) for the route
+
+        Parameters
+        ----------
+        item:   tuple
+            arguments of the route
+        can_block:  bool
+            weather the sender can be held till there is a room ("block" policy). The
+            message is dropped (drop-newest) otherwise
+
+        Returns
+        -------
+        asyncio.Task
+            the task waiting for a room if the message has to wait (the caller holds the
+            sender till it's done), None otherwise
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._start(loop)
+        queue = self._queue
+        if self.drop_policy == "block" and can_block and (queue.full() or self._blocked):
+            # waiting behind the already blocked ones, keeps the order of a sender
+            self._blocked += 1
+            return loop.create_task(self._put_blocked(queue, item))
+        if queue.full():
+            self.dropped += 1
+            if self.dropped == 1 or not self.dropped % 1000:
+                logger.warning(
+                    f"route queue '{self.route.pattern}' is full, dropped : {self.dropped}"
+                )
+            if self.drop_policy != "drop-oldest":
+                return
+            queue.get_nowait()
+            queue.task_done()
+        queue.put_nowait(item)
+        if queue.qsize() > self.max_depth:
+            self.max_depth = queue.qsize()
+        return None
+
+    async def _put_blocked(self, queue: asyncio.Queue, item: tuple):
+        try:
+            await queue.put(item)
+        finally:
+            if queue is self._queue:  # not restarted in between
+                self._blocked -= 1
+
+    async def _work(self):
+        queue = self._queue
+        latency = self.latency
+        labels = (self.route.pattern,)
+        while True:
+            item = await queue.get()
+            started = time.perf_counter()
+            try:
+                result = self.route(*item)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as exp:
+                if self.on_error:
+                    self.on_error(exp, self.route.pattern)
+            finally:
+                self.dispatched += 1
+                queue.task_done()
+                if latency is not None:
+                    latency.observe(labels, time.perf_counter() - started)
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._loop = None
+        self._queue = None
+        self._blocked = 0
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "dispatched": self.dispatched,
+        }
+
+
+class Dispatcher:
+    """Route queues (one per route) between the packet decoding and the callbacks, so a noisy
+    namespace can fill (and drop from) only its own queue"""
+
+    def __init__(self, on_error: callable = None, latency=None) -> None:
+        self.on_error = on_error
+        self.latency = latency
+        self._queues: Dict[Route, RouteQueue] = {}
+
+    def add(
+        self,
+        route: Route,
+        maxsize: int = ROUTE_QUEUE_SIZE,
+        drop_policy: str = ROUTE_DROP_POLICY,
+        workers: int = 1,
+    ) -> RouteQueue:
+        queue = RouteQueue(
+            route,
+            maxsize=maxsize,
+            drop_policy=drop_policy,
+            workers=workers,
+            on_error=self.on_error,
+            latency=self.latency,
+        )
+        self._queues[route] = queue
+        return queue
+
+    def dispatch(self, route: Route, item: tuple, can_block: bool = False) -> asyncio.Task:
+        """Queue a message for a route, returns the task waiting for a room if the message
+        has to wait (see `RouteQueue.put`)"""
+        return self._queues[route].put(item, can_block=can_block)
+
+    def close(self):
+        for queue in self._queues.values():
+            queue.close()
+
+    def stats(self) -> Dict[str, dict]:
+        """depth and drop counters by namespace pattern"""
+        stats = {}
+        for route, queue in self._queues.items():
+            current = queue.stats()
+            if route.pattern in stats:  # more than one callback for the pattern
+                current = {
+                    key: val + stats[route.pattern][key] for key, val in current.items()
+                }
+            stats[route.pattern] = current
+        return stats
@@ -0,0 +1,109 @@
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict
+
+from ..exceptions import UsageError
+
+EXECUTOR_KINDS = ("thread", "process")
+
+# the offloaded handlers reach the worker processes only through fork
+FORK_AVAILABLE = "fork" in multiprocessing.get_all_start_methods()
+
+# state of a worker process (inherited with fork, or set by the initializer)
+_decoder = None  # TransilationProtocol used by the decoder processes
+_handlers: Dict[str, callable] = {}  # route handlers of the server owning the pool
+
+
+def _init_decoder(protocol):
+    global _decoder
+    _decoder = protocol
+
+
+def _init_handlers(handlers: Dict[str, callable]):
+    global _handlers
+    _handlers = handlers
+
+
+def decode_body(data: bytes, decrypt, serializer: str, compression: str = None):
+    """Decode a packet body in a decoder process (see `TransilationProtocol.decode_parts`)"""
+    return _decoder.decode_parts(
+        data, decrypt=decrypt, serializer=serializer, compression=compression
+    )
+
+
+class HandlerRegistry:
+    """The handlers of a server to be called in its worker processes (one per server)
+
+    The workers are forked with the handlers registered so far, so the handlers should be
+    registered before the process pool of the server is started (i.e. before it starts
+    listening), later ones are refused. Needs the 'fork' start method.
+    """
+
+    def __init__(self) -> None:
+        self.handlers: Dict[str, callable] = {}
+        self.frozen = False  # set once the pool is started (its workers got the handlers)
+
+    def register(self, handler: callable) -> str:
+        """Register a handler, the returned name ("module:qualname") is what goes to the
+        worker (the decorated handlers can't be pickled by reference)"""
+        if not FORK_AVAILABLE:
+            raise UsageError("offloading routes to processes needs the 'fork' start method")
+        if self.frozen:
+            raise UsageError(
+                "the process pool of this server is already started, offloaded routes should "
+                "be added before the server starts"
+            )
+        name = base_name = f"{handler.__module__}:{handler.__qualname__}"
+        suffix = 1
+        while self.handlers.get(name, handler) is not handler:
+            suffix += 1  # same qualname (a closure, a lambda..), still unique and stable
+            name = f"{base_name}#{suffix}"
+        self.handlers[name] = handler
+        return name
+
+
+def call_handler(name: str, *args):
+    """Call a registered handler (in a worker process)"""
+    handler = _handlers.get(name)
+    if handler is None:
+        raise UsageError(f"handler '{name}' is unknown to the worker process")
+    return handler(*args)
+
+
+def new_executor(
+    kind: str, max_workers: int = None, protocol=None, handlers: HandlerRegistry = None
+) -> Executor:
+    """Create an executor
+
+    Parameters
+    ----------
+    kind:   str
+        "thread" or "process"
+    max_workers:    int
+        number of workers (None to let concurrent.futures decide)
+    protocol:   TransilationProtocol
+        a process pool used for decoding the bodies gets a copy of the protocol (keys included)
+    handlers:   HandlerRegistry
+        or the handlers it runs (no handler can be registered to them after)
+    """
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stmp")
+    if kind == "process":
+        # no fork, decoding still works (the protocol gets pickled), not the handlers
+        context = multiprocessing.get_context("fork") if FORK_AVAILABLE else None
+        if protocol is None:
+            handlers = handlers or HandlerRegistry()
+            handlers.frozen = True
+            return ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=context,
+                initializer=_init_handlers,
+                initargs=(handlers.handlers,),
+            )
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=context,
+            initializer=_init_decoder,
+            initargs=(protocol,),
+        )
+    raise UsageError(f"unknown executor '{kind}', use one of {EXECUTOR_KINDS}")
@@ -0,0 +1,194 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+from ..settings import METRICS_LATENCY_BUCKETS, METRICS_MAX_LABEL_SETS
+
+# labels not having a bounded set of values, collapsed into "other" once a metric has too many
+# label sets (the bounded ones, like the protocol, are kept as they are)
+UNBOUNDED_LABELS = ("namespace",)
+
+
+def _unbounded(labels: Tuple[str, ...]) -> Tuple[int, ...]:
+    return tuple(index for index, name in enumerate(labels) if name in UNBOUNDED_LABELS)
+
+
+def _collapse(labels: tuple, positions: Tuple[int, ...]) -> tuple:
+    """Label values with the unbounded ones replaced by 'other'"""
+    labels = list(labels)
+    for index in positions:
+        labels[index] = "other"
+    return tuple(labels)
+
+
+class Counter:
+    """A monotonic counter per label values"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        self._unbounded = _unbounded(labels)
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        values = self.values
+        if labels not in values and len(values) >= METRICS_MAX_LABEL_SETS:
+            labels = _collapse(labels, self._unbounded)
+        values[labels] = values.get(labels, 0) + amount
+
+    def samples(self) -> Dict[tuple, float]:
+        return self.values
+
+
+class Histogram:
+    """Bucketed observations (cumulative buckets, like the prometheus ones) per label values"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per bucket counts (last one is +Inf), sum, count]
+        self.values: Dict[tuple, list] = {}
+        self._unbounded = _unbounded(labels)
+
+    def observe(self, labels: tuple, value: float):
+        entry = self.values.get(labels)
+        if entry is None:
+            if len(self.values) >= METRICS_MAX_LABEL_SETS:
+                labels = _collapse(labels, self._unbounded)
+                entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self) -> Dict[tuple, dict]:
+        samples = {}
+        for labels, (counts, total, count) in self.values.items():
+            cumulative, buckets = 0, {}
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                buckets[bound] = cumulative
+            samples[labels] = {"buckets": buckets, "sum": total, "count": count}
+        return samples
+
+
+class Callback:
+    """A metric read from a callable on collection (gauges like the peer table size, or the
+    counters some other component keeps by itself)"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], Dict[tuple, float]],
+        labels: Tuple[str, ...] = (),
+        type: str = "gauge",
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.type = type
+        self._collect = collect
+
+    def samples(self) -> Dict[tuple, float]:
+        return self._collect()
+
+
+class MetricsRegistry:
+    """Counters, histograms and gauges of a server
+
+    Label values are passed as tuples (in the order of the label names), so updating a
+    metric is just a dict update.
+    """
+
+    def __init__(self, prefix: str = "stmp_") -> None:
+        self.prefix = prefix
+        self._metrics: Dict[str, object] = {}
+        self.started = time.time()
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(self.prefix + name, help, labels, buckets))
+
+    def callback(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], Dict[tuple, float]],
+        labels: Tuple[str, ...] = (),
+        type: str = "gauge",
+    ) -> Callback:
+        return self._register(Callback(self.prefix + name, help, collect, labels, type))
+
+    def stats(self) -> dict:
+        """Snapshot of all the metrics
+
+        Returns
+        -------
+        dict
+            metric name -> {"label1=value1,label2=value2": value}. Histograms have
+            {"buckets": {upper bound: cumulative count}, "sum": .., "count": ..} as the value
+        """
+        stats = {}
+        for name, metric in self._metrics.items():
+            stats[name[len(self.prefix) :]] = {
+                ",".join(f"{label}={value}" for label, value in zip(metric.labels, key)): val
+                for key, val in metric.samples().items()
+            }
+        return stats
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @staticmethod
+    def _labels(names: tuple, values: tuple, extra: List[str] = ()) -> str:
+        pairs = [
+            f'{name}="{MetricsRegistry._escape(value)}"' for name, value in zip(names, values)
+        ]
+        pairs.extend(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def prometheus(self) -> str:
+        """All the metrics in the prometheus text exposition format"""
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for key, val in metric.samples().items():
+                if metric.type != "histogram":
+                    lines.append(f"{name}{self._labels(metric.labels, key)} {val}")
+                    continue
+                for bound, count in val["buckets"].items():
+                    bound = "+Inf" if bound == float("inf") else repr(bound)
+                    labels = self._labels(metric.labels, key, [f'le="{bound}"'])
+                    lines.append(f"{name}_bucket{labels} {count}")
+                lines.append(f"{name}_sum{self._labels(metric.labels, key)} {val['sum']}")
+                lines.append(f"{name}_count{self._labels(metric.labels, key)} {val['count']}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,152 @@
+import inspect
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from ..exceptions import InvalidImplementation
+from ..settings import ROUTER_CACHE_SIZE
+
+
+class _Node:
+    """A segment trie node"""
+
+    __slots__ = ("children", "param", "wildcard", "routes")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}  # literal segments
+        self.param: "_Node" = None  # "{name}" segment
+        self.wildcard: list = None  # routes ending with "*"
+        self.routes: list = None  # routes ending right here
+
+
+class Route:
+    """A callback registered for a namespace pattern"""
+
+    __slots__ = ("pattern", "callback", "param_names", "accepts_params")
+
+    def __init__(self, pattern: str, callback: callable, param_names: tuple) -> None:
+        self.pattern = pattern
+        self.callback = callback
+        self.param_names = param_names
+        try:
+            parameters = inspect.signature(callback).parameters.values()
+        except (TypeError, ValueError):
+            parameters = []
+        self.accepts_params = any(
+            param.name == "params" or param.kind == param.VAR_KEYWORD
+            for param in parameters
+        )
+
+    def __call__(self, body, header: dict, sender_id: str, protocol: str, params: dict):
+        if self.accepts_params:
+            return self.callback(body, header, sender_id, protocol, params=params)
+        return self.callback(body, header, sender_id, protocol)
+
+
+class Router:
+    """Namespace router (a segment trie)
+
+    Namespaces are matched segment by segment ("/" separated). Apart from the exact
+    namespaces, a pattern can have
+        - parameters : "/room/{id}/msg" matches "/room/12/msg" with params {"id": "12"}
+        - a trailing wildcard : "/sensors/*" matches "/sensors/a" and "/sensors/a/b"
+          with params {"*": "a/b"}
+
+    The most specific pattern wins (literal > parameter > wildcard, segment by segment),
+    all the callbacks registered for that pattern are returned. Resolutions of the
+    hot namespaces are cached.
+    """
+
+    def __init__(self, cache_size: int = ROUTER_CACHE_SIZE) -> None:
+        self._root = _Node()
+        self._cache: "OrderedDict[str, List[Tuple[Route, dict]]]" = OrderedDict()
+        self.cache_size = cache_size
+
+    @staticmethod
+    def _split(namespace: str) -> List[str]:
+        return [segment for segment in namespace.split("/") if segment]
+
+    def add(self, pattern: str, callback: callable) -> Route:
+        """Register a callback for a namespace pattern"""
+        node = self._root
+        param_names = []
+        segments = self._split(pattern)
+        for index, segment in enumerate(segments):
+            if segment == "*":
+                if index != len(segments) - 1:
+                    raise InvalidImplementation(
+                        f"wildcard is allowed only at the end of a namespace : {pattern}"
+                    )
+                route = Route(pattern, callback, tuple(param_names))
+                if node.wildcard is None:
+                    node.wildcard = []
+                node.wildcard.append(route)
+                self._cache.clear()
+                return route
+            if segment.startswith("{") and segment.endswith("}"):
+                param_names.append(segment[1:-1])
+                if node.param is None:
+                    node.param = _Node()
+                node = node.param
+            else:
+                node = node.children.setdefault(segment, _Node())
+
+        route = Route(pattern, callback, tuple(param_names))
+        if node.routes is None:
+            node.routes = []
+        node.routes.append(route)
+        self._cache.clear()
+        return route
+
+    def _match(self, node: _Node, segments: List[str], index: int, values: list):
+        if index == len(segments):
+            if node.routes:
+                return node.routes, values
+            return None
+        segment = segments[index]
+
+        child = node.children.get(segment)
+        if child is not None:
+            found = self._match(child, segments, index + 1, values)
+            if found:
+                return found
+        if node.param is not None:
+            found = self._match(node.param, segments, index + 1, values + [segment])
+            if found:
+                return found
+        if node.wildcard:
+            return node.wildcard, values + ["/".join(segments[index:])]
+        return None
+
+    def resolve(self, namespace: str) -> List[Tuple[Route, dict]]:
+        """Find the routes for a namespace
+
+        Returns
+        -------
+        list[tuple[Route, dict]]
+            routes of the matching pattern (empty if nothing matches) along with the
+            params extracted for each of them
+        """
+        if namespace is None:
+            return []
+        cached = self._cache.get(namespace)
+        if cached is not None:
+            self._cache.move_to_end(namespace)
+            return cached
+
+        result = []
+        found = self._match(self._root, self._split(namespace), 0, [])
+        if found is not None:
+            routes, values = found
+            params_by_names = {}
+            for route in routes:
+                names = route.param_names
+                if len(values) > len(names):
+                    names = names + ("*",)  # wildcard value
+                if names not in params_by_names:
+                    params_by_names[names] = dict(zip(names, values))
+                result.append((route, params_by_names[names]))
+
+        self._cache[namespace] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
@@ -1,27 +1,53 @@
-import os
+import getpass
 import asyncio
 import socket
 from uuid import uuid4
 from .transport import UDPTransport, TCPTransport
 from .transport.interfaces import ListenSession
 from .transilation import TransilationProtocol
-from ..settings import logger, STMP_PORT, STMP_MADDR, TCP_PORT
+from .transilation.serializers import pick_serializer, RawJSON, DEFAULT_SERIALIZER
+from .router import Router
+from .dispatch import Dispatcher
+from .metrics import MetricsRegistry
+from .executors import new_executor, decode_body, HandlerRegistry, EXECUTOR_KINDS
+from ..exceptions import UsageError
+from ..settings import (
+    logger,
+    STMP_PORT,
+    STMP_MADDR,
+    TCP_PORT,
+    TCP_BACKLOG,
+    TCP_MAX_CONNECTIONS,
+    UDP_RCVBUF,
+    UDP_FRAGMENT_SIZE,
+    DECODE_EXECUTOR,
+    DECODE_OFFLOAD_MIN_SIZE,
+    EXECUTOR_WORKERS,
+    ROUTE_QUEUE_SIZE,
+    ROUTE_DROP_POLICY,
+    METRICS_PORT,
+    METRICS_HOST,
+)
 
 
 class STMPServerBase:
     """The mighty STMPServer backend"""
 
-    # callbacks will be stored over here (namespaces-> list[callbacks])
-    _callbacks = {}
-    _middlewares = []  # custom middle wares to be called
-
     def __init__(
         self,
-        user: str = os.getlogin(),
+        user: str = getpass.getuser(),
         hostname: str = socket.gethostname(),
         maddr: str = STMP_MADDR,
         udpport: int = STMP_PORT,
         tcpport: int = TCP_PORT,
+        tcp_backlog: int = TCP_BACKLOG,
+        tcp_max_connections: int = TCP_MAX_CONNECTIONS,
+        udp_rcvbuf: int = UDP_RCVBUF,
+        udp_fragment_size: int = UDP_FRAGMENT_SIZE,
+        decode_executor: str = DECODE_EXECUTOR,
+        executor_workers: int = EXECUTOR_WORKERS,
+        metrics_port: int = METRICS_PORT,
+        metrics_host: str = METRICS_HOST,
     ) -> None:
         """STPServer backend.
 
@@ -38,33 +64,157 @@ class STMPServerBase:
             oprtation port to be used
         tcpport
             tcp port used for full featured communication
+        tcp_backlog     int
+            listen backlog of the TCP socket
+        tcp_max_connections     int
+            maximum number of incoming TCP connections served at a time
+        udp_rcvbuf      int
+            SO_RCVBUF of the UDP socket (kernel side buffer for the bursts)
+        udp_fragment_size   int
+            UDP packets bigger than this are sent as fragments, to the peers supporting them
+            (None to send them as they are)
+        decode_executor     str
+            where to decrypt and decode the packet bodies, None (on the event loop), "thread" or
+            "process". Headers are always parsed on the loop
+        executor_workers    int
+            number of workers of the executors (None to let concurrent.futures decide)
+        metrics_port        int
+            if given, the metrics are served over http on this port (prometheus text format)
+        metrics_host        str
+            interface the metrics are served on, localhost by default ("" for all of them)
         """
+        if decode_executor is not None and decode_executor not in EXECUTOR_KINDS:
+            raise UsageError(
+                f"unknown decode executor '{decode_executor}', use one of {EXECUTOR_KINDS}"
+            )
+        # callbacks will be stored over here (namespace patterns -> list[callbacks])
+        self._router = Router()
+        self._middlewares = []  # custom middle wares to be called
+        self._error_handlers = []  # called with the exceptions raised by the callbacks
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics = MetricsRegistry()
+        self._init_metrics()
+        self._dispatcher = Dispatcher(
+            on_error=self._handle_error, latency=self._m_handler_latency
+        )
         self._t_protocol = TransilationProtocol(
             udp_port=udpport, tcp_port=tcpport, user=user, hostname=hostname
         )
         self._size_bytes_len = self._t_protocol.size()
         self._max_packet_size = self._t_protocol.max_packet_size
 
-        self.udp_transport = UDPTransport(maddr=maddr, port=udpport)
-        self.tcp_transport = TCPTransport(baddr="", port=tcpport)
+        self.udp_transport = UDPTransport(
+            maddr=maddr, port=udpport, rcvbuf=udp_rcvbuf, fragment_size=udp_fragment_size
+        )
+        self.tcp_transport = TCPTransport(
+            baddr="",
+            port=tcpport,
+            backlog=tcp_backlog,
+            max_connections=tcp_max_connections,
+            frame_reader=self._t_protocol.read_frame,
+        )
+
+        self._udp_session_id = uuid4().hex
+        self._tasks = set()  # strong refs to the fire-and-forget tasks
+
+        self.decode_executor = decode_executor
+        self.executor_workers = executor_workers
+        self._executors = {}  # kind -> executor (for the offloaded handlers), created on demand
+        self._offloaded = HandlerRegistry()  # handlers run by the process pool
+        self._decoder = None  # executor decoding the bodies
+
+    def _init_metrics(self):
+        metrics = self.metrics
+        labels = ("protocol", "namespace")
+        self._m_packets_in = metrics.counter(
+            "packets_received_total", "packets received", labels
+        )
+        self._m_bytes_in = metrics.counter("bytes_received_total", "bytes received", labels)
+        self._m_packets_out = metrics.counter("packets_sent_total", "packets sent", labels)
+        self._m_bytes_out = metrics.counter("bytes_sent_total", "bytes sent", labels)
+        self._m_decode_errors = metrics.counter(
+            "decode_errors_total",
+            "packets dropped for failing to decode (stage : header, body or decrypt)",
+            ("protocol", "stage"),
+        )
+        self._m_self_messages = metrics.counter(
+            "self_messages_total", "our own (multicast) packets dropped", ("protocol",)
+        )
+        self._m_handler_latency = metrics.histogram(
+            "handler_latency_seconds", "time taken by the route callbacks", ("namespace",)
+        )
+        metrics.callback(
+            "tcp_sends_total",
+            "outgoing TCP messages by result (ok, unavailable, timeout or error)",
+            lambda: {(key,): val for key, val in self.tcp_transport.send_results.items()},
+            ("result",),
+            type="counter",
+        )
+        metrics.callback(
+            "udp_fragments_total",
+            "UDP fragmentation events (fragments sent/received, reassembled, NACKs, timeouts..)",
+            lambda: {(key,): val for key, val in self.udp_transport.fragment_stats.items()},
+            ("event",),
+            type="counter",
+        )
+        metrics.callback(
+            "route_queue_depth",
+            "packets waiting in the route queues",
+            lambda: {(key,): val["depth"] for key, val in self.queue_stats().items()},
+            ("namespace",),
+        )
+        metrics.callback(
+            "route_queue_dropped_total",
+            "packets dropped by the full route queues",
+            lambda: {(key,): val["dropped"] for key, val in self.queue_stats().items()},
+            ("namespace",),
+            type="counter",
+        )
 
-        self._udp_session_id = str(uuid4())
+    def stats(self) -> dict:
+        """Snapshot of the metrics (see `MetricsRegistry.stats`), `metrics.prometheus()`
+        gives the same in the prometheus text format"""
+        return self.metrics.stats()
 
     def __del__(self, *args, **kwargs):
         self.udp_transport.__exit__(*args, **kwargs)
 
-    def add_callback(self, namespace: str, callback: callable):
+    def add_callback(
+        self,
+        namespace: str,
+        callback: callable,
+        concurrency: int = 1,
+        queue_size: int = ROUTE_QUEUE_SIZE,
+        drop_policy: str = ROUTE_DROP_POLICY,
+    ):
         """Add an on message callback
 
         Parameters
         ----------
+        namespace   str
+            namespace or a namespace pattern, like "/room/{id}/msg" (param) or "/sensors/*"
+            (prefix wildcard)
         callback    callable
             A callable that will be called with first prameter as STP body, second parameter as
             STP header, thrid paramter as UDP sender ip and fourth param as protocol being used.
+            If it accepts a `params` keyword argument, the params extracted from the namespace
+            will be passed as well. If it returns an awaitable, it will be awaited.
+        concurrency     int
+            number of callbacks (awaitables returned by it) running at a time
+        queue_size      int
+            max messages waiting for the callback
+        drop_policy     str
+            "drop-oldest", "drop-newest" or "block" once the queue is full (see `ROUTE_DROP_POLICY`)
         """
-        if namespace not in self._callbacks:
-            self._callbacks[namespace] = []
-        self._callbacks[namespace].append(callback)
+        route = self._router.add(namespace, callback)
+        self._dispatcher.add(
+            route, maxsize=queue_size, drop_policy=drop_policy, workers=concurrency
+        )
+
+    def queue_stats(self) -> dict:
+        """Inbound queue depth and drop counters by namespace pattern"""
+        return self._dispatcher.stats()
 
     def add_middleware(self, callback: callable):
         """Middle wares will be called for all requests came to the server
@@ -77,6 +227,61 @@ class STMPServerBase:
         """
         self._middlewares.append(callback)
 
+    def add_error_handler(self, callback: callable):
+        """Error handlers will be called whenever a middleware or a callback raises,
+        the listener keeps going after reporting the error
+
+        Parameters
+        ----------
+        callback    callable
+            A callable that will be called with first parameter as the exception and second
+            parameter as the context (namespace or the handler name) it got raised in.
+        """
+        self._error_handlers.append(callback)
+
+    def _handle_error(self, exp: Exception, context: str):
+        """Report an exception raised by a callback"""
+        logger.error(f"error in handler ({context}) : {exp!r}", exc_info=exp)
+        for handler in self._error_handlers:
+            try:
+                handler(exp, context)
+            except Exception as handler_exp:
+                logger.error(f"error in error handler : {handler_exp!r}")
+
+    async def _run_handler(self, handler: callable, *args, context: str = ""):
+        """Await a coroutine handler and report its errors"""
+        try:
+            await handler(*args)
+        except Exception as exp:
+            self._handle_error(exp, context)
+
+    def _executor(self, kind: str):
+        """Executor for the offloaded handlers (created on the first use)"""
+        executor = self._executors.get(kind)
+        if executor is None:
+            executor = new_executor(
+                kind, max_workers=self.executor_workers, handlers=self._offloaded
+            )
+            self._executors[kind] = executor
+        return executor
+
+    async def _offload(self, kind: str, func: callable, *args):
+        """Run a (blocking) callable in the thread or process pool"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor(kind), func, *args
+        )
+
+    def close_executors(self):
+        """Shutdown the executors, waits for the running jobs (pending ones are cancelled)"""
+        executors = list(self._executors.values())
+        if self._decoder is not None:
+            executors.append(self._decoder)
+        self._executors = {}
+        self._decoder = None
+        self._offloaded.frozen = False  # a new pool gets the handlers added meanwhile
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+
     def send_udp(
         self,
         data,
@@ -84,7 +289,11 @@ class STMPServerBase:
         enc_key: str = None,
         to_addr: str = None,
         to_port: int = None,
-        pass_pub_key: bool = True,
+        pass_pub_key: bool = False,
+        binary_header: bool = False,
+        serializer: str = None,
+        compression: str = None,
+        fragment: bool = False,
     ):
         """Send UDP packet to peer(s)
 
@@ -101,17 +310,33 @@ class STMPServerBase:
         to_port:    int
             port to which the message to be send
         pass_pub_key:   bool
-            Whether or not to use pass public key with the reeuest header
+            Whether or not to use pass public key with the reeuest header (only the key
+            fingerprint is passed otherwise, peers will ask for the key if they don't have it)
+        binary_header:  bool
+            Use the compact binary header, every receiver should support it (see `Peer.hv`)
+        serializer: str
+            body serializer : "json", "raw" or "msgpack" (if installed). Bytes-like data goes
+            raw and everything else as JSON by default
+        compression:    str
+            compress the body ("zlib", "lz4" or "zstd"), every receiver should support it
+            (see `Peer.hv`)
+        fragment:   bool
+            send the packet as fragments if it's bigger than `udp_fragment_size` (IP
+            fragmentation otherwise), every receiver should support it (see `Peer.hv`)
         """
-        data = {"msg": data}
-        data = self._t_protocol.pack(
+        data = self._pack(
             data,
+            serializer=serializer,
+            compression=compression,
             namespace=namespace,
             enc_key=enc_key,
             pass_pub_key=pass_pub_key,
             extra_headers={"udp_session": self._udp_session_id},
+            binary_header=binary_header,
         )
-        self.udp_transport.send(data, addr=to_addr, port=to_port)
+        self._m_packets_out.inc(("UDP", namespace))
+        self._m_bytes_out.inc(("UDP", namespace), len(data))
+        self.udp_transport.send(data, addr=to_addr, port=to_port, fragment=fragment)
 
     def send_tcp(
         self,
@@ -120,7 +345,10 @@ class STMPServerBase:
         to_port: int = TCP_PORT,
         namespace: str = "/",
         enc_key: str = None,
-        pass_pub_key: bool = True,
+        pass_pub_key: bool = False,
+        binary_header: bool = False,
+        serializer: str = None,
+        compression: str = None,
     ) -> bool:
         """Send TCP packet to peer(s)
 
@@ -137,66 +365,293 @@ class STMPServerBase:
         enc_key:    str
             if an rsa public key is provided, the provided data will be encrypted using it
         pass_pub_key:   bool
-            Whether or not to use pass public key with the reeuest header
+            Whether or not to use pass public key with the reeuest header (only the key
+            fingerprint is passed otherwise, peers will ask for the key if they don't have it)
+        binary_header:  bool
+            Use the compact binary header, every receiver should support it (see `Peer.hv`)
+        serializer: str
+            body serializer : "json", "raw" or "msgpack" (if installed). Bytes-like data goes
+            raw and everything else as JSON by default
+        compression:    str
+            compress the body ("zlib", "lz4" or "zstd"), every receiver should support it
+            (see `Peer.hv`)
         """
-        data = {"msg": data}
-        data = self._t_protocol.pack(
-            data, namespace=namespace, enc_key=enc_key, pass_pub_key=pass_pub_key
+        data = self._pack(
+            data,
+            serializer=serializer,
+            compression=compression,
+            namespace=namespace,
+            enc_key=enc_key,
+            pass_pub_key=pass_pub_key,
+            binary_header=binary_header,
         )
+        self._m_packets_out.inc(("TCP", namespace))
+        self._m_bytes_out.inc(("TCP", namespace), len(data))
         return self.tcp_transport.send(data, addr=to_addr, port=to_port)
 
+    async def send_tcp_async(
+        self,
+        data,
+        to_addr: str,
+        to_port: int = TCP_PORT,
+        namespace: str = "/",
+        enc_key: str = None,
+        pass_pub_key: bool = False,
+        binary_header: bool = False,
+        serializer: str = None,
+        compression: str = None,
+    ) -> bool:
+        """Send TCP packet to peer(s) without blocking the event loop.
+        Accepts the same parameters as `send_tcp`
+        """
+        data = self._pack(
+            data,
+            serializer=serializer,
+            compression=compression,
+            namespace=namespace,
+            enc_key=enc_key,
+            pass_pub_key=pass_pub_key,
+            binary_header=binary_header,
+        )
+        self._m_packets_out.inc(("TCP", namespace))
+        self._m_bytes_out.inc(("TCP", namespace), len(data))
+        return await self.tcp_transport.send_async(data, addr=to_addr, port=to_port)
+
+    def _pack(self, data, serializer: str = None, **kwargs) -> bytes:
+        """Pack the application data with the right serializer (see `TransilationProtocol.pack`)"""
+        serializer = pick_serializer(data, serializer)
+        if serializer == DEFAULT_SERIALIZER:
+            # JSON body envelope (spliced around the data serialised already)
+            if isinstance(data, RawJSON):
+                data = RawJSON(b'{"msg":' + data + b"}")
+            else:
+                data = {"msg": data}
+        return self._t_protocol.pack(data, serializer=serializer, **kwargs)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        """Schedule a coroutine on the running loop (keeping a reference till it's done)"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def __decode_header(self, view: memoryview, protocol: str) -> tuple:
+        """Parse the prefix and the header of a packet read from the wire
+
+        Returns (header, body part) or None if the packet is junk or is our own message.
+        """
+        header_v, header_s, body_s = self._t_protocol.unpack_prefix(
+            view[: self._size_bytes_len]
+        )
+        if header_s is None:
+            self._m_decode_errors.inc((protocol, "header"))
+            return None  # error parsing (retry and self correct)
+        if (header_s + body_s + self._size_bytes_len) > self._max_packet_size:
+            logger.warning("MSG Parsing: packet having illegal buffer length received!")
+            self._m_decode_errors.inc((protocol, "header"))
+            return None
+
+        header_end = self._size_bytes_len + header_s
+        header: dict = self._t_protocol.decode_header(
+            view[self._size_bytes_len : header_end], header_v
+        )
+        if header is None:
+            self._m_decode_errors.inc((protocol, "header"))
+            return None  # error parsing (retry and self correct)
+        if header.get("udp_session") == self._udp_session_id:
+            self._m_self_messages.inc((protocol,))
+            return None  # self message  ignoring
+        return header, view[header_end : header_end + body_s]
+
+    @staticmethod
+    def __body_args(header: dict) -> tuple:
+        """(decrypt, serializer, compression) arguments of `decode_parts` for a packet"""
+        return (
+            header.get("encrypted") and header.get("cipher", True),
+            header.get("ser") or DEFAULT_SERIALIZER,
+            header.get("cmp"),
+        )
+
+    @staticmethod
+    def __empty_body(header: dict):
+        """Body of a packet without one (empty bytes for raw bodies)"""
+        return b"" if header.get("ser") == "raw" else {}
+
+    @staticmethod
+    def __unwrap_body(header: dict, body, copy_raw: bool = False):
+        if (header.get("ser") or DEFAULT_SERIALIZER) == DEFAULT_SERIALIZER:
+            return body.get("msg")
+        if copy_raw and isinstance(body, memoryview):
+            return body.tobytes()  # the receive buffer is going to be reused
+        return body
+
+    def __decode_packet(self, data, protocol: str, copy_raw: bool = False) -> tuple:
+        """Decode a packet read from the wire into (header, body). Works on memoryviews all the way
+        through, so the payload is not copied around while slicing
+
+        Returns None if the packet is junk or is our own message.
+        """
+        decoded = self.__decode_header(memoryview(data), protocol)
+        if decoded is None:
+            return None
+        header, body_part = decoded
+        body = self.__empty_body(header)
+        if body_part:
+            decrypt, serializer, compression = self.__body_args(header)
+            body = self._t_protocol.decode_parts(
+                body_part, decrypt=decrypt, serializer=serializer, compression=compression
+            )
+            if body is None:
+                self._m_decode_errors.inc((protocol, "decrypt" if decrypt else "body"))
+                return None  # error parsing (retry and self correct)
+            body = self.__unwrap_body(header, body, copy_raw=copy_raw)
+        return header, body
+
+    async def __decode_batch_offloaded(self, batch: list, session: ListenSession) -> list:
+        """Decode a batch with the body decryption/decoding done in the decode executor, the
+        bodies of the batch are decoded in parallel (the order of the batch is kept)
+
+        Returns
+        -------
+        list
+            [((header, body), address, size)] for the valid packets of the batch (address :
+            sender information of the session)
+        """
+        loop = asyncio.get_running_loop()
+        if self._decoder is None:
+            self._decoder = new_executor(
+                self.decode_executor,
+                max_workers=self.executor_workers,
+                protocol=self._t_protocol,
+            )
+        in_process = self.decode_executor == "process"
+        protocol = session.protocol
+        decode = decode_body if in_process else self._t_protocol.decode_parts
+
+        pending = []
+        try:
+            for data, address in batch:
+                decoded = self.__decode_header(memoryview(data), protocol)
+                if decoded is None:
+                    continue
+                header, body_part = decoded
+                decrypt, serializer, compression = self.__body_args(header)
+                if not body_part:
+                    pending.append((header, self.__empty_body(header), address, len(data)))
+                elif decrypt or len(body_part) >= DECODE_OFFLOAD_MIN_SIZE:
+                    if in_process or session.recycles_buffers:
+                        body_part = body_part.tobytes()
+                    future = loop.run_in_executor(
+                        self._decoder, decode, body_part, decrypt, serializer, compression
+                    )
+                    pending.append((header, future, address, len(data)))
+                else:  # not worth the round trip
+                    body = self._t_protocol.decode_parts(
+                        body_part,
+                        decrypt=decrypt,
+                        serializer=serializer,
+                        compression=compression,
+                    )
+                    if body is None:
+                        self._m_decode_errors.inc((protocol, "body"))
+                        continue
+                    body = self.__unwrap_body(header, body, session.recycles_buffers)
+                    pending.append((header, body, address, len(data)))
+        finally:
+            session.release_batch(batch)
+
+        packets = []
+        for header, body, address, size in pending:
+            if asyncio.isfuture(body):
+                try:
+                    body = await body
+                except Exception as exp:
+                    self._handle_error(exp, "decode")
+                    body = None
+                if body is None:
+                    stage = "decrypt" if header.get("encrypted") else "body"
+                    self._m_decode_errors.inc((protocol, stage))
+                    continue  # error parsing (retry and self correct)
+                body = self.__unwrap_body(header, body)
+            packets.append(((header, body), address, size))
+        return packets
+
+    def __split_batch(self, header: dict, body, size: int, protocol: str) -> list:
+        """Split a batch packet into (header, body, size) of its messages, each one gets a
+        copy of the batch header with its own namespace (and a share of the packet size)"""
+        if not isinstance(body, list) or not all(
+            isinstance(item, list) and len(item) == 2 and isinstance(item[0], str)
+            for item in body
+        ):
+            self._m_decode_errors.inc((protocol, "body"))
+            return ()
+        share = size // max(1, len(body))
+        return [
+            ({**header, "namespace": namespace}, data, share) for namespace, data in body
+        ]
+
     async def __listen_session_manaer(self, session: ListenSession):
         """Manage listen session!"""
         event_loop = asyncio.get_running_loop()
         logger.info(f"[{session.protocol}] listening for connection..")
+        protocol = session.protocol
+        can_block = protocol == "TCP"  # holding a UDP sender just moves the drops
+        batch_namespace = self._t_protocol.batch_namespace
         while True:
-            data, (sender_id, *_) = await session.read(
-                self._max_packet_size, loop=event_loop
-            )
-            header, body = {}, {}
-
-            roi = data[: self._size_bytes_len]
-            data = data[self._size_bytes_len :]
-            header_s, body_s = self._t_protocol.unpack_size_bytes(roi)
-            if (header_s + body_s + self._size_bytes_len) > self._max_packet_size:
-                logger.warning(
-                    "MSG Parsing: packet having illegal buffer length received!"
-                )
-                continue
-            if header_s is None:
-                continue  # error parsing (retry and self correct)
-
-            header_raw = data[:header_s]
-            body_raw = data[header_s:]
-            header: dict = self._t_protocol.decode_parts(header_raw, False)
-            if header is None:
-                continue  # error parsing (retry and self correct)
-            if header.get("udp_session") == self._udp_session_id:
-                continue  # self message  ignoring
-
-            if body_s:
-                body = self._t_protocol.decode_parts(
-                    body_raw, decrypt=header.get("encrypted")
-                )
-                if body is None:
-                    continue  # error parsing (retry and self correct)
-                body: dict = body.get("msg")
+            batch = await session.read_batch(self._max_packet_size, loop=event_loop)
+            if self.decode_executor:
+                packets = await self.__decode_batch_offloaded(batch, session)
+            else:
+                try:
+                    packets = [
+                        (
+                            self.__decode_packet(
+                                data, protocol, copy_raw=session.recycles_buffers
+                            ),
+                            address,
+                            len(data),
+                        )
+                        for data, address in batch
+                    ]
+                finally:
+                    session.release_batch(batch)
 
-            logger.debug(
-                f"[{session.protocol} Pack]: from '{sender_id}' @ {header.get('namespace')}"
-            )
+            for packet, address, size in packets:
+                if packet is None:
+                    continue
+                header, body = packet
+                sender_id = address[0]
+                if header.get("namespace") == batch_namespace:
+                    messages = self.__split_batch(header, body, size, protocol)
+                else:
+                    messages = ((header, body, size),)
+
+                for header, body, size in messages:
+                    namespace = header.get("namespace")
+                    self._m_packets_in.inc((protocol, namespace))
+                    self._m_bytes_in.inc((protocol, namespace), size)
+
+                    logger.debug(f"[{protocol} Pack]: from '{sender_id}' @ {namespace}")
 
-            # executing middlewares
-            [
-                callback(body, header, sender_id, session.protocol)
-                for callback in self._middlewares
-            ]
+                    # executing middlewares
+                    for callback in self._middlewares:
+                        try:
+                            callback(body, header, sender_id, protocol)
+                        except Exception as exp:
+                            self._handle_error(
+                                exp, getattr(callback, "__name__", "middleware")
+                            )
 
-            # executing callbacks by namespace
-            [
-                callback(body, header, sender_id, session.protocol)
-                for callback in self._callbacks.get(header.get("namespace"), [])
-            ]
+                    # queuing up for the callbacks by namespace
+                    for route, params in self._router.resolve(namespace):
+                        waiting = self._dispatcher.dispatch(
+                            route,
+                            (body, header, sender_id, protocol, params),
+                            can_block=can_block,
+                        )
+                        if waiting is not None:
+                            # the route is full ("block"), only that sender waits for it
+                            session.hold(address, waiting)
 
     async def listen_udp_async(self):
         """Listen for UDP packets"""
@@ -220,11 +675,47 @@ class STMPServerBase:
             if session:
                 session.close()
 
+    async def _serve_metrics(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            parts = request.split()
+            if len(parts) > 1 and parts[0] == b"GET" and parts[1] in (b"/", b"/metrics"):
+                status, body = "200 OK", self.metrics.prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                (
+                    f"HTTP/1.0 {status}\r\n"
+                    "Content-Type: text/plain; version=0.0.4\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n"
+                ).encode()
+                + body
+            )
+            await writer.drain()
+        except (OSError, TimeoutError):
+            ...
+        finally:
+            writer.close()
+
+    async def listen_metrics_async(self):
+        """Serve the metrics over http (prometheus text format) if `metrics_port` is set"""
+        if not self.metrics_port:
+            return
+        server = await asyncio.start_server(
+            self._serve_metrics, host=self.metrics_host or None, port=self.metrics_port
+        )
+        logger.info(f"[METRICS] serving on {self.metrics_host or '*'}:{self.metrics_port}")
+        async with server:
+            await server.serve_forever()
+
     async def listen(self):
         """Listen for UDP and TCP packets"""
         return await asyncio.gather(
             self.listen_udp_async(),
             self.listen_tcp_async(),
+            self.listen_metrics_async(),
         )
 
     def run(self):
@@ -233,3 +724,5 @@ class STMPServerBase:
             asyncio.run(self.listen())
         except KeyboardInterrupt:
             logger.error("STPServer Shutdown : KeyboardInterrupt")
+        finally:
+            self.close_executors()
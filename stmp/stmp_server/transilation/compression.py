@@ -0,0 +1,97 @@
+import zlib
+from typing import Dict
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # optional dependency
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+
+class Compressor:
+    """Body compressor interface"""
+
+    name: str
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress the (serialised) body"""
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        """Decompress a body back, raises ValueError if it grows beyond max_size"""
+
+
+class ZlibCompressor(Compressor):
+    """The default one (standard library)"""
+
+    name = "zlib"
+
+    def __init__(self, level: int = 6) -> None:
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"decompressed body is bigger than {max_size} bytes")
+        return body
+
+
+class Lz4Compressor(Compressor):
+    """LZ4 frames, faster but compresses less (available only if `lz4` is installed)"""
+
+    name = "lz4"
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4_frame.compress(data)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        decompressor = lz4_frame.LZ4FrameDecompressor()
+        body = decompressor.decompress(data, max_length=max_size)
+        if not decompressor.eof:
+            raise ValueError(f"decompressed body is bigger than {max_size} bytes")
+        return body
+
+
+class ZstdCompressor(Compressor):
+    """Zstandard (available only if `zstandard` is installed)
+
+    The zstandard contexts are not thread safe (bodies are decoded in the executors as well),
+    so every call gets its own.
+    """
+
+    name = "zstd"
+
+    def __init__(self, level: int = 3) -> None:
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        # reading at most a byte over the limit, a small frame can expand to gigabytes
+        reader = zstandard.ZstdDecompressor().stream_reader(data)
+        chunks, size = [], 0
+        while size <= max_size:
+            chunk = reader.read(max_size + 1 - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        if size > max_size:
+            raise ValueError(f"decompressed body is bigger than {max_size} bytes")
+        return b"".join(chunks)
+
+
+# name -> compressor
+COMPRESSORS: Dict[str, Compressor] = {ZlibCompressor.name: ZlibCompressor()}
+if lz4_frame is not None:
+    COMPRESSORS[Lz4Compressor.name] = Lz4Compressor()
+if zstandard is not None:
+    COMPRESSORS[ZstdCompressor.name] = ZstdCompressor()
@@ -1 +1,2 @@
 from .crypt import Encryption
+from .cache import KeyCache, fingerprint
@@ -0,0 +1,65 @@
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable
+
+from ....settings import KEY_CACHE_SIZE
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def fingerprint(pub_key: str) -> str:
+    """Short fingerprint of a (hex DER formatted) public key
+
+    Parameters
+    ----------
+    pub_key:    str
+        hex DER formatted public key
+
+    Returns
+    -------
+    str
+        first 16 hex chars of the sha256 digest of the key
+    """
+    return hashlib.sha256(bytes.fromhex(pub_key)).hexdigest()[:16]
+
+
+class KeyCache:
+    """A bounded LRU cache of objects derived from public keys (parsed keys, ciphers..)
+    keyed by the key fingerprint"""
+
+    def __init__(self, max_size: int = KEY_CACHE_SIZE) -> None:
+        """
+        Parameters
+        ----------
+        max_size:   int
+            maximum number of keys to be remembered
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, Any]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, pub_key: str, factory: Callable[[str], Any]) -> Any:
+        """Get the cached object for the key (created with `factory(pub_key)` on a miss)"""
+        key_fp = fingerprint(pub_key)
+        item = self._items.get(key_fp)
+        if item is None:
+            self.misses += 1
+            item = factory(pub_key)
+            self._items[key_fp] = item
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        else:
+            self.hits += 1
+            self._items.move_to_end(key_fp)
+        return item
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self) -> dict:
+        """Cache counters"""
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
@@ -1,23 +1,82 @@
+import time
+import struct
+import threading
+from collections import OrderedDict
 from typing import Union
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher import PKCS1_OAEP, AES
+from Crypto.Random import get_random_bytes
+from .cache import KeyCache
+from ....settings import SESSION_KEY_TTL, SESSION_KEY_MAX_MESSAGES, SESSION_KEY_CACHE_SIZE
+
+
+class SessionKey:
+    """An AES session key used for a single peer (along with its RSA wrapped form)"""
+
+    __slots__ = ("key", "wrapped", "created", "uses")
+
+    def __init__(self, key: bytes, wrapped: bytes) -> None:
+        self.key = key
+        self.wrapped = wrapped
+        self.created = time.monotonic()
+        self.uses = 0
+
+    def expired(self) -> bool:
+        return (
+            self.uses >= SESSION_KEY_MAX_MESSAGES
+            or (time.monotonic() - self.created) > SESSION_KEY_TTL
+        )
 
 
 class Encryption:
-    """For the sake of simplicity we are going with RSA :)"""
+    """For the sake of simplicity we are going with RSA :)
+
+    Well, RSA can only take a few bytes at a time (and is slow), so there is a hybrid mode as well.
+    A random AES-GCM session key is created per peer and is wrapped with the peer's RSA public key.
+    The wrapped key travels along with every message, so the peer has to do the RSA decryption only
+    once per session key. Session keys are rotated every `SESSION_KEY_TTL` seconds
+    (or `SESSION_KEY_MAX_MESSAGES` messages)
+
+    hybrid ciphertext : "!BH" (version, wrapped key length) + wrapped key + nonce + tag + ciphertext
+    """
 
     _encoding = "utf-8"
     _key_size = 1024  # min 1024, should be multiple of 256
 
+    # hybrid mode
+    HYBRID_CIPHER = "rsa-aes-gcm"  # name used in packet headers
+    _hybrid_version = 1
+    _hybrid_prefix_format = "!BH"
+    _session_key_size = 32  # AES-256
+    _nonce_size = 12
+    _tag_size = 16
+
     pub_key = None
     _cipher = None
 
-    def __init__(self):
-        """Create new encryption key pairs"""
-        self.key = RSA.generate(1024)
-        self.pub_key = self.key.exportKey("DER").hex()
+    # peer ciphers (parsing the keys takes a good part of the time spent in `encrypt`)
+    _cipher_cache = KeyCache()
+
+    def __init__(self, key: RSA.RsaKey = None):
+        """Create new encryption key pairs (or use the given private key)"""
+        self.key = key or RSA.generate(self._key_size)
+        self.pub_key = self.key.publickey().exportKey("DER").hex()
         self._cipher = PKCS1_OAEP.new(key=self.key)
 
+        # peer public key -> SessionKey (for encryption)
+        self._session_keys: "OrderedDict[str, SessionKey]" = OrderedDict()
+        # wrapped session key -> session key (for decryption)
+        self._peer_session_keys: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self._lock = threading.Lock()  # decryption may run in executor threads
+
+    def __reduce__(self):
+        # the rsa keys can't be pickled as it is (needed for the decoder processes)
+        return (self._from_der, (self.key.export_key("DER"),))
+
+    @classmethod
+    def _from_der(cls, der: bytes) -> "Encryption":
+        return cls(RSA.import_key(der))
+
     @classmethod
     def encrypt(cls, msg: Union[str, bytes], pub_key: str) -> bytes:
         """Encrypt a message using an identical public key
@@ -36,10 +95,19 @@ class Encryption:
         """
         if isinstance(msg, str):
             msg = msg.encode(cls._encoding)
-        key = RSA.importKey(bytes.fromhex(pub_key))
-        cipher = PKCS1_OAEP.new(key=key)
+        cipher = cls._cipher_cache.get(pub_key, cls._new_cipher)
         return cipher.encrypt(msg)
 
+    @staticmethod
+    def _new_cipher(pub_key: str) -> PKCS1_OAEP.PKCS1OAEP_Cipher:
+        key = RSA.importKey(bytes.fromhex(pub_key))
+        return PKCS1_OAEP.new(key=key)
+
+    @classmethod
+    def cache_stats(cls) -> dict:
+        """Hit/miss counters of the peer key cache"""
+        return cls._cipher_cache.stats()
+
     def decypt(self, ciphertext: Union[str, bytes]) -> bytes:
         """Decypt using the creted secret key
 
@@ -56,3 +124,87 @@ class Encryption:
         if isinstance(ciphertext, str):
             ciphertext = ciphertext.encode(self._encoding)
         return self._cipher.decrypt(ciphertext)
+
+    def _session_key(self, pub_key: str) -> SessionKey:
+        """Get the current session key for a peer (creating a new one if needed)"""
+        session = self._session_keys.get(pub_key)
+        if session is None or session.expired():
+            key = get_random_bytes(self._session_key_size)
+            session = SessionKey(key=key, wrapped=self.encrypt(key, pub_key))
+            self._session_keys[pub_key] = session
+            if len(self._session_keys) > SESSION_KEY_CACHE_SIZE:
+                self._session_keys.popitem(last=False)
+        self._session_keys.move_to_end(pub_key)
+        session.uses += 1
+        return session
+
+    def encrypt_hybrid(self, msg: Union[str, bytes], pub_key: str) -> bytes:
+        """Encrypt a message of any size with an AES-GCM session key of the peer
+
+        Parameters
+        ----------
+        msg:    str | bytes
+            message to be encypted
+        pub_key: str
+            DIR formatted rsa public key of the peer
+
+        Returns
+        -------
+        bytes
+            encypted bytes
+        """
+        if isinstance(msg, str):
+            msg = msg.encode(self._encoding)
+        session = self._session_key(pub_key)
+        nonce = get_random_bytes(self._nonce_size)
+        cipher = AES.new(session.key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(msg)
+        prefix = struct.pack(
+            self._hybrid_prefix_format, self._hybrid_version, len(session.wrapped)
+        )
+        return b"".join((prefix, session.wrapped, nonce, tag, ciphertext))
+
+    def decrypt_hybrid(self, ciphertext: Union[str, bytes]) -> bytes:
+        """Decrypt a message created with `encrypt_hybrid` using our public key
+
+        Parameters
+        ----------
+        ciphertext: str | bytes
+            The data encypted using public key of 'self'
+
+        Returns
+        -------
+        bytes
+            Decrypted bytes
+
+        Raises
+        ------
+        ValueError
+            if the message is malformed or fails the authentication
+        """
+        if isinstance(ciphertext, str):
+            ciphertext = ciphertext.encode(self._encoding)
+        prefix_size = struct.calcsize(self._hybrid_prefix_format)
+        version, wrapped_size = struct.unpack_from(self._hybrid_prefix_format, ciphertext)
+        if version != self._hybrid_version:
+            raise ValueError(f"unsupported hybrid cipher version : {version}")
+
+        offset = prefix_size + wrapped_size
+        wrapped = bytes(ciphertext[prefix_size:offset])
+        with self._lock:
+            key = self._peer_session_keys.get(wrapped)
+            if key is not None:
+                self._peer_session_keys.move_to_end(wrapped)
+        if key is None:
+            key = self.decypt(wrapped)  # the only RSA operation per session key
+            with self._lock:
+                self._peer_session_keys[wrapped] = key
+                if len(self._peer_session_keys) > SESSION_KEY_CACHE_SIZE:
+                    self._peer_session_keys.popitem(last=False)
+
+        nonce = ciphertext[offset : offset + self._nonce_size]
+        offset += self._nonce_size
+        tag = ciphertext[offset : offset + self._tag_size]
+        offset += self._tag_size
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        return cipher.decrypt_and_verify(ciphertext[offset:], tag)
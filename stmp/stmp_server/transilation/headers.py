@@ -0,0 +1,181 @@
+import json
+import struct
+
+
+class BinaryHeader:
+    """Fixed layout binary header (version 1), a compact alternative to the JSON header
+
+    The version bits of the size_bytes say what sent it : 1 for the first peers having it
+    (their "hv" is 1, unless the extras say otherwise), `hv_version` and above for the later
+    ones, the bits carry their "hv" then (so it needn't go in the extras)
+
+    fixed part : "!HHB8s" -> udpport, tcpport, flags, key fingerprint (raw)
+    followed by (in order)
+        udp_session : 16 raw bytes (hex uuid)       # if FLAG_SESSION
+        user        : "!B" length + utf-8 bytes
+        hostname    : "!B" length + utf-8 bytes
+        namespace   : "!H" length + utf-8 bytes
+        public_key  : "!H" length + raw DER bytes   # if FLAG_PUB_KEY
+        extras      : "!H" length + JSON object     # if FLAG_EXTRAS (any other header)
+    """
+
+    version = 1
+    hv_version = 5  # header version carried in the version bits from (peers supporting it)
+    max_hv_bits = 7  # a later "hv" goes in the extras
+
+    FLAG_ENCRYPTED = 0x01
+    FLAG_HYBRID = 0x02  # cipher : rsa-aes-gcm
+    FLAG_SESSION = 0x04
+    FLAG_PUB_KEY = 0x08
+    FLAG_EXTRAS = 0x10
+    # 0x20 | 0x40 : body serializer id
+    FLAG_ZLIB = 0x80  # body compression : zlib (others go with the extras)
+    _serializer_shift = 5
+    _serializer_mask = 0x60
+    _serializer_ids = {"raw": 1, "msgpack": 2}
+    _serializer_names = {val: key for key, val in _serializer_ids.items()}
+
+    _fixed_format = struct.Struct("!HHB8s")
+    _short_len = struct.Struct("!B")
+    _long_len = struct.Struct("!H")
+    _no_key_fp = bytes(8)
+
+    # headers having a slot in the fixed layout
+    _known_keys = frozenset(
+        (
+            "user",
+            "hostname",
+            "udpport",
+            "tcpport",
+            "encrypted",
+            "cipher",
+            "key_fp",
+            "public_key",
+            "namespace",
+            "udp_session",
+            "ser",
+            "cmp",
+            "hv",  # in the version bits (unless it's a later one)
+        )
+    )
+
+    def __init__(self, encoding: str = "utf-8", hybrid_cipher: str = "rsa-aes-gcm"):
+        self.encoding = encoding
+        self.hybrid_cipher = hybrid_cipher
+
+    def encode(self, header: dict) -> bytes:
+        """Encode a header dict
+
+        Raises
+        ------
+        ValueError
+            if some of the values can't go in the fixed layout (use JSON instead)
+        """
+        try:
+            return self._encode(header)
+        except (struct.error, KeyError, AttributeError) as exp:
+            raise ValueError(f"header doesn't fit the binary layout : {exp}")
+
+    def _encode(self, header: dict) -> bytes:
+        flags = 0
+        extras = {key: val for key, val in header.items() if key not in self._known_keys}
+        if header.get("encrypted"):
+            flags |= self.FLAG_ENCRYPTED
+        cipher = header.get("cipher")
+        if cipher == self.hybrid_cipher:
+            flags |= self.FLAG_HYBRID
+        elif cipher is not None:
+            extras["cipher"] = cipher
+        serializer = header.get("ser")
+        if serializer in self._serializer_ids:
+            flags |= self._serializer_ids[serializer] << self._serializer_shift
+        elif serializer is not None:
+            extras["ser"] = serializer
+        compression = header.get("cmp")
+        if compression == "zlib":
+            flags |= self.FLAG_ZLIB
+        elif compression is not None:
+            extras["cmp"] = compression
+        if header.get("hv", self.version) > self.max_hv_bits:
+            extras["hv"] = header["hv"]
+
+        parts = [b""]  # place holder for the fixed part
+        if header.get("udp_session"):
+            flags |= self.FLAG_SESSION
+            parts.append(bytes.fromhex(header["udp_session"]))
+        for key, len_format in (
+            ("user", self._short_len),
+            ("hostname", self._short_len),
+            ("namespace", self._long_len),
+        ):
+            val = (header.get(key) or "").encode(self.encoding)
+            parts.append(len_format.pack(len(val)))
+            parts.append(val)
+        if header.get("public_key"):
+            flags |= self.FLAG_PUB_KEY
+            val = bytes.fromhex(header["public_key"])
+            parts.append(self._long_len.pack(len(val)))
+            parts.append(val)
+        if extras:
+            flags |= self.FLAG_EXTRAS
+            val = json.dumps(extras, separators=(",", ":")).encode(self.encoding)
+            parts.append(self._long_len.pack(len(val)))
+            parts.append(val)
+
+        parts[0] = self._fixed_format.pack(
+            header["udpport"],
+            header["tcpport"],
+            flags,
+            bytes.fromhex(header.get("key_fp") or "").ljust(8, b"\0"),
+        )
+        return b"".join(parts)
+
+    def decode(self, data: bytes, hv: int = version) -> dict:
+        """Decode the binary header into a header dict (same keys as the JSON header), `hv`
+        is the version from the size_bytes"""
+        encoding = self.encoding
+        udpport, tcpport, flags, key_fp = self._fixed_format.unpack_from(data)
+        offset = self._fixed_format.size
+        header = {
+            "udpport": udpport,
+            "tcpport": tcpport,
+            "encrypted": bool(flags & self.FLAG_ENCRYPTED),
+            "hv": hv,
+        }
+        if flags & self.FLAG_SESSION:
+            header["udp_session"] = data[offset : offset + 16].hex()
+            offset += 16
+
+        size = data[offset]
+        offset += 1
+        header["user"] = str(data[offset : offset + size], encoding)
+        offset += size
+        size = data[offset]
+        offset += 1
+        header["hostname"] = str(data[offset : offset + size], encoding)
+        offset += size
+        size = (data[offset] << 8) | data[offset + 1]
+        offset += 2
+        header["namespace"] = str(data[offset : offset + size], encoding)
+        offset += size
+
+        if flags & self.FLAG_HYBRID:
+            header["cipher"] = self.hybrid_cipher
+        if flags & self._serializer_mask:
+            header["ser"] = self._serializer_names.get(
+                (flags & self._serializer_mask) >> self._serializer_shift
+            )
+        if flags & self.FLAG_ZLIB:
+            header["cmp"] = "zlib"
+        if key_fp != self._no_key_fp:
+            header["key_fp"] = key_fp.hex()
+        if flags & self.FLAG_PUB_KEY:
+            size = (data[offset] << 8) | data[offset + 1]
+            offset += 2
+            header["public_key"] = data[offset : offset + size].hex()
+            offset += size
+        if flags & self.FLAG_EXTRAS:
+            size = (data[offset] << 8) | data[offset + 1]
+            offset += 2
+            header.update(json.loads(str(data[offset : offset + size], encoding)))
+        return header
@@ -0,0 +1,88 @@
+import json
+from typing import Any, Dict
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+
+class Serializer:
+    """Body serializer interface"""
+
+    name: str
+
+    def dumps(self, data: Any) -> bytes:
+        """Serialise data into bytes"""
+
+    def loads(self, data: bytes) -> Any:
+        """Deserialise bytes (or any bytes-like object) back"""
+
+
+class RawJSON(bytes):
+    """JSON serialised already (by `JSONSerializer`), goes in a JSON body as it is"""
+
+
+class JSONSerializer(Serializer):
+    """The default one, the body should be JSON serialisable"""
+
+    name = "json"
+
+    def __init__(self, encoding: str = "utf-8") -> None:
+        self.encoding = encoding
+
+    def dumps(self, data: Any) -> bytes:
+        if isinstance(data, RawJSON):
+            return data
+        return json.dumps(data, separators=(",", ":")).encode(self.encoding)
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(str(data, self.encoding))
+
+
+class RawSerializer(Serializer):
+    """Bytes passthrough, for the binary payloads (no encoding at all)"""
+
+    name = "raw"
+
+    def dumps(self, data: Any) -> bytes:
+        if isinstance(data, str):
+            raise TypeError("raw serializer accepts only bytes-like objects")
+        return data if isinstance(data, bytes) else bytes(data)
+
+    def loads(self, data: bytes) -> Any:
+        return data
+
+
+class MsgpackSerializer(Serializer):
+    """MessagePack (available only if `msgpack` is installed)"""
+
+    name = "msgpack"
+
+    def dumps(self, data: Any) -> bytes:
+        return msgpack.packb(data)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data)
+
+
+# name -> serializer
+SERIALIZERS: Dict[str, Serializer] = {
+    serializer.name: serializer
+    for serializer in (JSONSerializer(), RawSerializer())
+}
+if msgpack is not None:
+    SERIALIZERS[MsgpackSerializer.name] = MsgpackSerializer()
+
+DEFAULT_SERIALIZER = JSONSerializer.name
+
+
+def pick_serializer(data: Any, serializer: str = None) -> str:
+    """Name of the serializer to be used for the data (raw for bytes-like data, JSON otherwise)"""
+    if serializer:
+        return serializer
+    if isinstance(data, RawJSON):
+        return DEFAULT_SERIALIZER
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return RawSerializer.name
+    return DEFAULT_SERIALIZER
@@ -1,10 +1,15 @@
-import os
+import getpass
+import asyncio
 import struct
 import socket
 import json
 from typing import Union, Tuple
-from .enc import Encryption
-from ...settings import STMP_PORT, TCP_PORT, logger
+from .enc import Encryption, fingerprint
+from .headers import BinaryHeader
+from .serializers import SERIALIZERS, DEFAULT_SERIALIZER
+from .compression import COMPRESSORS
+from ...exceptions import UsageError
+from ...settings import STMP_PORT, TCP_PORT, ENCRYPTION_MODE, COMPRESSION_MIN_SIZE, logger
 
 
 class TransilationProtocol:
@@ -14,19 +19,32 @@ class TransilationProtocol:
 
     'size_bytes' -> represent size of remaing payload
     'header' -> of json strucutre (TBH, I like protobuf as well)
-    'body' -> again of json structure for convenience
+    'body' -> again of json structure for convenience (or raw bytes / msgpack, see "ser")
 
     size_bytes : "!HI"                          # not encypted
+        if the top bit of the header size is set, the header is a fixed layout binary
+        header (see `BinaryHeader`) : 0x8000 | version << 12 | header size (max 4095 bytes)
+        JSON headers are limited to 0x7FFF bytes hence. The version is the "hv" of the sender
+        (or 1, from the older ones)
     header : {                                  # not encrypted
         "user": "<user name>",
         "hostname": <hostname>,
         "udpport": <recieving UDP port>,
         "tcpport" <recieving TCP port>
         "encrypted": <boolean : if the body encrypted or not>,
-        "public_key": <private-key>,            # optional
+        "cipher": <"rsa-aes-gcm" if hybrid encrypted>,  # optional (plain RSA otherwise)
+        "key_fp": <fingerprint of the public key>,
+        "public_key": <public-key>,             # optional (peers ask for it if they miss it)
         "namespace": <target namespace>,
+        "hv": <max header version supported (1: binary headers, 2: compressed bodies, 3: batches,
+               4: UDP fragments, 5: "hv" in the binary header version bits)>,
+        "ser": <body serializer : "raw" | "msgpack">,  # optional (JSON otherwise)
+        "cmp": <body compression : "zlib" | "lz4" | "zstd">,  # optional (not compressed otherwise)
     }
-    body : <data provided by the application>   # can be encrypted
+    body : <data provided by the application>   # can be compressed, then encrypted
+
+    A batch is a JSON packet to `batch_namespace` having [[namespace, data], ..] as the data,
+    the receivers split it back into individual messages (sharing the header of the batch).
     """
 
     # going with network byte order (happens to be big-endiannes) & unsigned short & unsigned Int
@@ -37,11 +55,23 @@ class TransilationProtocol:
     encoding = "utf-8"  # default encoding
     max_packet_size = 4 * 1000 * 1024  # limiting the packet max size to 4 MB
 
+    # header size bits of the size_bytes
+    _binary_header_flag = 0x8000
+    _header_version_mask = 0x7000
+    _binary_header_size_mask = 0x0FFF
+    _json_header_size_mask = 0x7FFF
+
+    header_version = 5  # max header version supported ("hv" header)
+    compression_version = 2  # header version the compressed bodies came with
+    batch_version = 3  # and the batches
+    fragment_version = 4  # and the UDP fragments
+    batch_namespace = "/stmp-batch"
+
     def __init__(
         self,
         udp_port: int = STMP_PORT,
         tcp_port: int = TCP_PORT,
-        user: str = os.getlogin(),
+        user: str = getpass.getuser(),
         hostname: str = socket.gethostname(),
     ) -> None:
         """Create a transilational instance
@@ -63,7 +93,12 @@ class TransilationProtocol:
             "udpport": udp_port,
             "tcpport": tcp_port,
             "encrypted": False,
+            "key_fp": fingerprint(self.encyption.pub_key),
+            "hv": self.header_version,
         }
+        self.binary_header = BinaryHeader(
+            encoding=self.encoding, hybrid_cipher=Encryption.HYBRID_CIPHER
+        )
 
     @classmethod
     def size(cls) -> int:
@@ -77,66 +112,223 @@ class TransilationProtocol:
         enc_key: str = "",
         pass_pub_key: bool = False,
         extra_headers: dict = {},
+        cipher: str = ENCRYPTION_MODE,
+        binary_header: bool = False,
+        serializer: str = DEFAULT_SERIALIZER,
+        compression: str = None,
+        compression_min_size: int = COMPRESSION_MIN_SIZE,
     ) -> bytes:
         """Package given data payload
 
         Parameters
         ----------
         data:       str
-            data to be packed (should be JSON serialisable)
+            data to be packed (should be serialisable with the `serializer`)
         enc_key:    str
             if provided the body will be encrypted with the given public key
         pass_pub_key:   bool
             if True public_key will be sent with header (increase payload size)
         extra_headers:  dict
             additional headers to be send
+        cipher:     str
+            "hybrid" (AES-GCM session key wrapped with the RSA key) or "rsa" (RSA only,
+            limits the body to a few bytes)
+        binary_header:  bool
+            use the compact binary header (only understood by peers advertising "hv" >= 5, it
+            carries our "hv" in the version bits)
+        serializer: str
+            body serializer : "json", "raw" (bytes passthrough) or "msgpack" (if installed)
+        compression:    str
+            compress the body with "zlib", "lz4" or "zstd" (if installed), only understood by
+            peers advertising "hv" >= 2
+        compression_min_size:   int
+            smaller bodies are not compressed (not worth it)
 
         Returns
         -------
         bytes
             packed bytes data
+
+        Raises
+        ------
+        ValueError
+            if the header is too big for the size_bytes (over 0x7FFF bytes as JSON, a long
+            namespace or extra headers)
         """
         header = {**extra_headers, "namespace": namespace, **self.default_header}
         if pass_pub_key:
             header["public_key"] = self.encyption.pub_key
 
-        body = json.dumps(data, separators=(",", ":")).encode(self.encoding)
+        if serializer not in SERIALIZERS:
+            raise UsageError(f"unknown (or not installed) serializer : {serializer}")
+        body = SERIALIZERS[serializer].dumps(data)
+        if serializer != DEFAULT_SERIALIZER:
+            header["ser"] = serializer
+        if compression and len(body) >= compression_min_size:
+            # before the encryption, cipher text doesn't compress
+            if compression not in COMPRESSORS:
+                raise UsageError(f"unknown (or not installed) compression : {compression}")
+            compressed = COMPRESSORS[compression].compress(body)
+            if len(compressed) < len(body):
+                body = compressed
+                header["cmp"] = compression
         if enc_key:
-            body = self.encyption.encrypt(data, enc_key)
+            if cipher == "hybrid":
+                body = self.encyption.encrypt_hybrid(body, enc_key)
+                header["cipher"] = Encryption.HYBRID_CIPHER
+            else:
+                body = self.encyption.encrypt(body, enc_key)
             header["encrypted"] = True
-        header = json.dumps(header, separators=(",", ":")).encode(self.encoding)
-        size_bytes = struct.pack(self._size_bytes_format, len(header), len(body))
+        header_size_bits = None
+        if binary_header:
+            try:
+                header_bin = self.binary_header.encode(header)
+                if len(header_bin) <= self._binary_header_size_mask:
+                    header_size_bits = (
+                        self._binary_header_flag
+                        | (min(header.get("hv", 1), BinaryHeader.max_hv_bits) << 12)
+                        | len(header_bin)
+                    )
+                    header = header_bin
+            except ValueError as exp:
+                logger.debug(f"falling back to JSON header : {exp}")
+        if header_size_bits is None:
+            header = json.dumps(header, separators=(",", ":")).encode(self.encoding)
+            header_size_bits = len(header)
+            if header_size_bits > self._json_header_size_mask:
+                # the top bit would read as a binary header
+                raise ValueError(
+                    f"header too big ({header_size_bits} bytes, max {self._json_header_size_mask})"
+                )
+        size_bytes = struct.pack(self._size_bytes_format, header_size_bits, len(body))
 
         return size_bytes + header + body
 
-    def decode_parts(self, data: bytes, decrypt: bool = False):
+    def decode_parts(
+        self,
+        data: bytes,
+        decrypt: Union[bool, str] = False,
+        serializer: str = DEFAULT_SERIALIZER,
+        compression: str = None,
+    ):
         """Decode header or body part into python objects
 
         Parameters
         ----------
         data:   bytes
             data to be decoded into object
-        decrypt:    bool
-            weather or not to decrypt the data before parsing or not
+        decrypt:    bool | str
+            weather or not to decrypt the data before parsing or not. The cipher name
+            from the header can be passed as well ("rsa-aes-gcm" for hybrid encryption)
+        serializer: str
+            serializer of the data ("ser" header of the packet), raw data is returned as it is
+        compression:    str
+            compression of the data ("cmp" header of the packet), decompressed after decryption
 
         """
         try:
-            if decrypt:
+            if decrypt == Encryption.HYBRID_CIPHER:
+                data = self.encyption.decrypt_hybrid(data)
+            elif decrypt:
                 data = self.encyption.decypt(data)
-            data = json.loads(data.decode(self.encoding))
-            return data
+            if compression:
+                data = COMPRESSORS[compression].decompress(data, self.max_packet_size)
+            return SERIALIZERS[serializer].loads(data)
         except Exception as exp:
             logger.error(f"MSG decode error : {exp}")
             return None
 
+    def decode_header(self, data: bytes, version: int = 0) -> dict:
+        """Decode the header part into a dict
+
+        Parameters
+        ----------
+        data:   bytes
+            header bytes
+        version:    int
+            header version from the size_bytes (0: JSON, 1 or `BinaryHeader.hv_version` and
+            above: binary)
+
+        """
+        if not version:
+            return self.decode_parts(data)
+        try:
+            if version != BinaryHeader.version and version < BinaryHeader.hv_version:
+                raise ValueError(f"unsupported header version : {version}")
+            return self.binary_header.decode(data, hv=version)
+        except Exception as exp:
+            logger.error(f"MSG header decode error : {exp}")
+            return None
+
+    @classmethod
+    async def read_frame(cls, reader: asyncio.StreamReader) -> bytes:
+        """Read exactly one packet (size_bytes + header + body) from a stream
+
+        Parameters
+        ----------
+        reader:     asyncio.StreamReader
+            stream to read from, can carry any number of back-to-back packets
+
+        Returns
+        -------
+        bytes
+            the whole packet, None if the stream got closed in between two packets
+
+        Raises
+        ------
+        ValueError
+            if the size_bytes are junk (the stream can't be trusted after that)
+        asyncio.IncompleteReadError
+            if the stream got closed in the middle of a packet
+        """
+        size_bytes_len = cls.size()
+        try:
+            size_bytes = await reader.readexactly(size_bytes_len)
+        except asyncio.IncompleteReadError as exp:
+            if not exp.partial:
+                return None  # clean close
+            raise
+        header_s, body_s = cls.unpack_size_bytes(size_bytes)
+        if header_s is None or (header_s + body_s + size_bytes_len) > cls.max_packet_size:
+            raise ValueError("packet having illegal buffer length received!")
+        return size_bytes + await reader.readexactly(header_s + body_s)
+
+    @classmethod
+    def unpack_prefix(cls, size_bytes: bytes) -> Tuple[int]:
+        """Unpack the size_bytes to decode the header version, header and body size
+
+        Parameters
+        ----------
+        size_bytes:     bytes
+            bytes to be decoded with size_bytes_format
+
+        Returns
+        -------
+        int, int, int
+            header version (0 for JSON), size of header and size of body
+
+        """
+        header_s, body_s = cls.unpack_size_bytes(size_bytes, masked=False)
+        if header_s is None:
+            return (None, None, None)
+        if header_s & cls._binary_header_flag:
+            return (
+                (header_s & cls._header_version_mask) >> 12,
+                header_s & cls._binary_header_size_mask,
+                body_s,
+            )
+        return 0, header_s, body_s
+
     @classmethod
-    def unpack_size_bytes(cls, size_bytes: bytes) -> Tuple[int]:
+    def unpack_size_bytes(cls, size_bytes: bytes, masked: bool = True) -> Tuple[int]:
         """Unpack the size_bytes to decode the header and body size
 
         Parameters
         ----------
         size_bytes:     bytes
             bytes to be decoded with size_bytes_format
+        masked:     bool
+            strip the header version bits from the header size
 
         Returns
         -------
@@ -145,7 +337,10 @@ class TransilationProtocol:
 
         """
         try:
-            return struct.unpack(cls._size_bytes_format, size_bytes)
+            header_s, body_s = struct.unpack(cls._size_bytes_format, size_bytes)
+            if masked and header_s & cls._binary_header_flag:
+                header_s &= cls._binary_header_size_mask
+            return header_s, body_s
         except:
             logger.warning(f"SIZE Bytes decode error! : junk data recieved!")
             return (None, None)
@@ -0,0 +1,29 @@
+from typing import List
+
+
+class BufferPool:
+    """A pool of preallocated receive buffers (to avoid allocating a new one for every read)"""
+
+    def __init__(self, buff_size: int, max_buffers: int = 64) -> None:
+        """
+        Parameters
+        ----------
+        buff_size:  int
+            size of a single buffer
+        max_buffers:    int
+            maximum number of free buffers kept around
+        """
+        self.buff_size = buff_size
+        self.max_buffers = max_buffers
+        self._free: List[bytearray] = []
+
+    def acquire(self) -> bytearray:
+        """Get a free buffer"""
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.buff_size)
+
+    def release(self, buff: bytearray):
+        """Give back a buffer, nobody should hold a view of it after this"""
+        if len(self._free) < self.max_buffers and len(buff) == self.buff_size:
+            self._free.append(buff)
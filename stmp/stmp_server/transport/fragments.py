@@ -0,0 +1,296 @@
+import os
+import struct
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+
+from ...settings import (
+    UDP_FRAGMENT_SIZE,
+    UDP_MAX_FRAGMENTS,
+    UDP_REASSEMBLY_BUFFER,
+    UDP_REASSEMBLY_MAX_MESSAGES,
+    UDP_REASSEMBLY_MAX_PER_SENDER,
+    UDP_REASSEMBLY_TIMEOUT,
+    UDP_NACK_DELAY,
+    UDP_NACK_RETRIES,
+    UDP_RETRANSMIT_BUFFER,
+)
+
+# fragment datagram : magic, kind, message id, fragment index, fragment count, payload
+# (peers not knowing the fragments read the magic as a binary header of an unknown version,
+# and drop them as junk)
+FRAGMENT_MAGIC = b"\xffSF"
+FRAGMENT_HEADER = struct.Struct("!3sBQHH")
+KIND_FRAGMENT = 0
+KIND_NACK = 1  # missing fragments of a message (the index part is unused, "!H" indexes follow)
+# bytes an incomplete message is charged for each of its fragment slots (whether it arrived or
+# not), so the announced fragment count is paid for up front
+SLOT_COST = 8
+
+
+def is_fragment(data) -> bool:
+    """Whether a datagram is a fragment (or a NACK) rather than a whole packet"""
+    return data[:3] == FRAGMENT_MAGIC
+
+
+def fragment_kind(data) -> int:
+    return data[3]
+
+
+def pack_nack(msg_id: int, missing: List[int]) -> bytes:
+    header = FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, KIND_NACK, msg_id, 0, len(missing))
+    return header + struct.pack(f"!{len(missing)}H", *missing)
+
+
+def unpack_nack(data) -> Tuple[int, List[int]]:
+    """(message id, missing fragment indexes) of a NACK, raises struct.error on junk"""
+    _, _, msg_id, _, count = FRAGMENT_HEADER.unpack_from(data)
+    return msg_id, list(struct.unpack_from(f"!{count}H", data, FRAGMENT_HEADER.size))
+
+
+class _Sent:
+    """Fragments of a sent message, kept for the NACKs"""
+
+    __slots__ = ("dest", "fragments", "size", "resent")
+
+    def __init__(self, dest: tuple, fragments: List[bytes]) -> None:
+        self.dest = dest
+        self.fragments = fragments
+        self.size = sum(map(len, fragments))
+        self.resent = {}  # fragment index -> last retransmission time
+
+
+class Fragmenter:
+    """Splits the datagrams bigger than the fragment size into fragments, and keeps the
+    recently sent fragments around (bounded by size) to answer the NACKs
+
+    A fragment is sent again to where the message went (the multicast group for the
+    multicasts) at most once in `resend_interval`, so the NACKs of all the receivers
+    missing it are answered by a single retransmission.
+    """
+
+    def __init__(
+        self,
+        fragment_size: int = UDP_FRAGMENT_SIZE,
+        retransmit_buffer: int = UDP_RETRANSMIT_BUFFER,
+        stats: Counter = None,
+        resend_interval: float = UDP_NACK_DELAY,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        fragment_size:  int
+            max datagram size (fragment header included), None to never split
+        retransmit_buffer:  int
+            bytes of the sent fragments kept for retransmission
+        stats:  Counter
+            event -> count, shared with the `Reassembler`
+        resend_interval:    float
+            min seconds between two retransmissions of a fragment
+        """
+        self.fragment_size = fragment_size
+        self.retransmit_buffer = retransmit_buffer
+        self.stats = stats if stats is not None else Counter()
+        self.resend_interval = resend_interval
+        self._sent: OrderedDict = OrderedDict()  # message id -> _Sent
+        self._sent_bytes = 0
+
+    def needs_split(self, data) -> bool:
+        return bool(self.fragment_size) and len(data) > self.fragment_size
+
+    def split(self, data: bytes, dest: tuple = None) -> List[bytes]:
+        """Fragments of a datagram (remembered for the NACKs, along with the destination)"""
+        view = memoryview(data)
+        size = self.fragment_size - FRAGMENT_HEADER.size
+        count = -(-len(view) // size)
+        if count > UDP_MAX_FRAGMENTS:
+            raise ValueError(f"datagram too big to be fragmented : {len(view)} bytes")
+        msg_id = int.from_bytes(os.urandom(8), "big")
+        fragments = [
+            FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, KIND_FRAGMENT, msg_id, index, count)
+            + view[index * size : (index + 1) * size]
+            for index in range(count)
+        ]
+        self.stats["fragmented"] += 1
+        self.stats["fragments_sent"] += count
+        self._remember(msg_id, _Sent(dest, fragments))
+        return fragments
+
+    def _remember(self, msg_id: int, sent: _Sent):
+        if not self.retransmit_buffer:
+            return
+        self._sent[msg_id] = sent
+        self._sent_bytes += sent.size
+        while self._sent_bytes > self.retransmit_buffer and self._sent:
+            _, old = self._sent.popitem(last=False)
+            self._sent_bytes -= old.size
+
+    def retransmit(
+        self, msg_id: int, indexes: List[int], now: float
+    ) -> Tuple[Optional[tuple], List[bytes]]:
+        """Fragments asked for by a NACK, leaving out the ones just sent again for an other
+        NACK (none if the message is not kept anymore)
+
+        Returns
+        -------
+        tuple[tuple, list[bytes]]
+            destination of the message (None if not known) and the fragments to send again
+        """
+        sent = self._sent.get(msg_id)
+        if sent is None:
+            self.stats["nacks_missed"] += 1
+            return None, []
+        resend, resent, count = [], sent.resent, len(sent.fragments)
+        for index in indexes:
+            if index >= count:
+                continue
+            if now - resent.get(index, float("-inf")) < self.resend_interval:
+                self.stats["retransmits_coalesced"] += 1
+                continue
+            resent[index] = now
+            resend.append(sent.fragments[index])
+        self.stats["retransmitted"] += len(resend)
+        return sent.dest, resend
+
+
+def _sender(address) -> str:
+    # the ip, the source port is up to the sender
+    return address[0] if isinstance(address, tuple) else address
+
+
+class _Partial:
+    """An incomplete message"""
+
+    __slots__ = ("parts", "received", "size", "updated", "nacks")
+
+    def __init__(self, count: int, now: float) -> None:
+        self.parts: List[Optional[bytes]] = [None] * count
+        self.received = 0
+        self.size = count * SLOT_COST  # bytes charged, the slots and the payloads received
+        self.updated = now
+        self.nacks = 0
+
+
+class Reassembler:
+    """Puts the fragments back together. The incomplete messages are bounded by size (the
+    oldest are dropped), by number (overall and per sender ip, the oldest are dropped
+    as well) and by time (dropped if no fragment arrives for `timeout`); in between, the
+    senders are asked for the missing fragments (NACK) a few times"""
+
+    def __init__(
+        self,
+        max_bytes: int = UDP_REASSEMBLY_BUFFER,
+        timeout: float = UDP_REASSEMBLY_TIMEOUT,
+        nack_delay: float = UDP_NACK_DELAY,
+        nack_retries: int = UDP_NACK_RETRIES,
+        max_nack_indexes: int = ((UDP_FRAGMENT_SIZE or 1400) - FRAGMENT_HEADER.size) // 2,
+        stats: Counter = None,
+        max_messages: int = UDP_REASSEMBLY_MAX_MESSAGES,
+        max_per_sender: int = UDP_REASSEMBLY_MAX_PER_SENDER,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.nack_delay = nack_delay
+        self.nack_retries = nack_retries
+        self.max_nack_indexes = max_nack_indexes
+        self.stats = stats if stats is not None else Counter()
+        self.max_messages = max_messages
+        self.max_per_sender = max_per_sender
+        self._pending: OrderedDict = OrderedDict()  # (sender address, message id) -> _Partial
+        self._per_sender = Counter()  # sender ip -> incomplete messages
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def feed(self, data, address: tuple, now: float) -> Optional[bytes]:
+        """Take a fragment in, returns the message once all of its fragments are in"""
+        try:
+            _, kind, msg_id, index, count = FRAGMENT_HEADER.unpack_from(data)
+        except Exception:
+            kind = None
+        if kind != KIND_FRAGMENT or index >= count or count > UDP_MAX_FRAGMENTS:
+            self.stats["junk"] += 1
+            return None
+        self.stats["fragments_received"] += 1
+
+        key = (address, msg_id)
+        partial = self._pending.get(key)
+        if partial is None:
+            partial = self._start(key, count, now)
+        elif len(partial.parts) != count:
+            self.stats["junk"] += 1
+            return None
+        if partial.parts[index] is not None:
+            self.stats["duplicates"] += 1
+            return None
+
+        payload = bytes(data[FRAGMENT_HEADER.size :])
+        partial.parts[index] = payload
+        partial.received += 1
+        partial.size += len(payload)
+        partial.updated = now
+        self._bytes += len(payload)
+
+        if partial.received == count:
+            self._drop(key)
+            self.stats["reassembled"] += 1
+            return b"".join(partial.parts)
+
+        self._evict()
+        return None
+
+    def _start(self, key: tuple, count: int, now: float) -> _Partial:
+        """Make room for a new incomplete message (its slots are charged before they are
+        allocated) and add it"""
+        sender = _sender(key[0])
+        if self._per_sender[sender] >= self.max_per_sender:
+            # the oldest of the sender goes, not some other sender's
+            self._drop(next(old for old in self._pending if _sender(old[0]) == sender))
+            self.stats["evicted"] += 1
+        self._evict(extra_bytes=count * SLOT_COST, extra_messages=1)
+        partial = self._pending[key] = _Partial(count, now)
+        self._per_sender[sender] += 1
+        self._bytes += partial.size
+        return partial
+
+    def _evict(self, extra_bytes: int = 0, extra_messages: int = 0):
+        """Drop the oldest incomplete messages while over the limits (the ones about to be
+        added included)"""
+        while self._pending and (
+            len(self._pending) + extra_messages > self.max_messages
+            or self._bytes + extra_bytes > self.max_bytes
+        ):
+            self._drop(next(iter(self._pending)))
+            self.stats["evicted"] += 1
+
+    def _drop(self, key: tuple):
+        partial = self._pending.pop(key)
+        self._bytes -= partial.size
+        sender = _sender(key[0])
+        self._per_sender[sender] -= 1
+        if not self._per_sender[sender]:
+            del self._per_sender[sender]
+
+    def check(self, now: float) -> List[Tuple[tuple, bytes]]:
+        """Drop the timed out messages
+
+        Returns
+        -------
+        list[tuple[tuple, bytes]]
+            NACKs to be sent, (sender address, NACK datagram)
+        """
+        nacks = []
+        for key, partial in list(self._pending.items()):
+            idle = now - partial.updated
+            if idle >= self.timeout:
+                self._drop(key)
+                self.stats["timeouts"] += 1
+            elif partial.nacks < self.nack_retries and idle >= self.nack_delay * (
+                partial.nacks + 1
+            ):
+                partial.nacks += 1
+                missing = [index for index, part in enumerate(partial.parts) if part is None]
+                address, msg_id = key
+                nacks.append((address, pack_nack(msg_id, missing[: self.max_nack_indexes])))
+                self.stats["nacks_sent"] += 1
+        return nacks
@@ -1,7 +1,31 @@
+import time
 import asyncio
 import socket
-from typing import Tuple, Literal
-from ...settings import logger, TCP_TIMEOUT
+from collections import deque
+from typing import Tuple, List, Literal, Callable, Awaitable
+from .buffers import BufferPool
+from .fragments import (
+    Fragmenter,
+    Reassembler,
+    is_fragment,
+    fragment_kind,
+    unpack_nack,
+    KIND_NACK,
+)
+from ...settings import (
+    logger,
+    UDP_MAX_DATAGRAM,
+    UDP_BATCH_SIZE,
+    UDP_BATCH_BUFFER,
+    UDP_MAX_PENDING_BATCHES,
+    TCP_READ_QUEUE_SIZE,
+    TCP_KEEPALIVE_TIMEOUT,
+    TCP_BACKLOG,
+    TCP_MAX_CONNECTIONS,
+)
+
+# single byte reciept sent back for every message read from a TCP connection
+TCP_ACK = b"\x06"
 
 
 class ListenSession:
@@ -9,6 +33,8 @@ class ListenSession:
 
     protocol: Literal["UDP", "TCP"]
     socket: socket.socket
+    # whether the data returned by `read` lives in a buffer that will be reused after `release`
+    recycles_buffers: bool = False
 
     async def read(
         self, buff_size: int = 1024, loop: asyncio.BaseEventLoop = None
@@ -25,8 +51,32 @@ class ListenSession:
         Returns
         -------
         future
-            resolve with the gibrish read from the wire and sender infromation
+            resolve with the gibrish read from the wire (bytes-like) and sender infromation
+        """
+
+    def release(self, data):
+        """Hand back the data returned by `read` once done with it (and every view of it)"""
+
+    async def read_batch(
+        self, buff_size: int = 1024, loop: asyncio.BaseEventLoop = None
+    ) -> List[Tuple[bytes, tuple]]:
+        """read whatever is available (at least one message)
+
+        Returns
+        -------
+        future
+            resolve with a list of (data, sender information), same as `read`
         """
+        return [await self.read(buff_size, loop=loop)]
+
+    def release_batch(self, batch: List[Tuple[bytes, tuple]]):
+        """Hand back a batch returned by `read_batch` once done with it"""
+        for data, _ in batch:
+            self.release(data)
+
+    def hold(self, address: tuple, waiting: Awaitable):
+        """Stop reading from a sender (connection) till the awaitable is done, if the
+        session can (backpressure)"""
 
     def close(self):
         """To close the  ports"""
@@ -42,13 +92,35 @@ class ListenSession:
             print("got error on socket shut", exp)
 
 
+class _Batch(list):
+    """Datagrams of a batch, along with the buffer they are received into"""
+
+    __slots__ = ("buffer", "unreleased")
+
+
 # transilation layer
 class UDPListenSession(ListenSession):
-    """A simple socket listen session"""
+    """A simple socket listen session
+
+    `read_batch` drains the socket till it runs dry (EAGAIN) on every readiness event and
+    receives all those datagrams into a single buffer, so a burst is handed over in one go
+    instead of one event loop round trip per datagram. `read` hands the datagrams of those
+    batches over one by one.
+
+    Fragments are taken out of the batches by `read_batch` (the messages they complete take
+    their place) and the NACKs are answered from the sent fragments of the transport.
+    """
 
     protocol = "UDP"
+    recycles_buffers = True
 
-    def __init__(self, socket: socket.socket, inet_addr: str) -> None:
+    def __init__(
+        self,
+        socket: socket.socket,
+        inet_addr: str,
+        fragmenter: Fragmenter = None,
+        reassembler: Reassembler = None,
+    ) -> None:
         """
 
         Parameters
@@ -57,10 +129,29 @@ class UDPListenSession(ListenSession):
             udp socket session to be used
         inet_addr:  str
             inetaddress to be drop membership on session close
+        fragmenter: Fragmenter
+            fragmenter of the transport (to answer the NACKs)
+        reassembler:    Reassembler
+            puts the received fragments together (fragments are dropped if not given)
 
         """
         self.socket = socket
         self.inet_addr = inet_addr
+        self.fragmenter = fragmenter
+        self.reassembler = reassembler
+        self._fragment_check: asyncio.TimerHandle = None
+        self._unread = deque()  # (data, address, batch) left over for `read`
+        self._read_batches = {}  # id(data) -> batch, of the datagrams handed over by `read`
+
+        # batched receive
+        self._loop: asyncio.AbstractEventLoop = None
+        self._batch_buffers = BufferPool(
+            max(UDP_BATCH_BUFFER, UDP_MAX_DATAGRAM),
+            max_buffers=UDP_MAX_PENDING_BATCHES,
+        )
+        self._batches = deque()
+        self._waiter: asyncio.Future = None
+        self._reading = False
 
     def __enter__(self, *args, **kwargs):
         return self
@@ -70,6 +161,10 @@ class UDPListenSession(ListenSession):
         self.close()
 
     def close(self):
+        self._pause_reading()
+        if self._fragment_check is not None:
+            self._fragment_check.cancel()
+            self._fragment_check = None
         try:
             self.socket.setsockopt(
                 socket.SOL_IP,
@@ -83,24 +178,192 @@ class UDPListenSession(ListenSession):
     async def read(
         self, buff_size: int = 1024, loop: asyncio.BaseEventLoop = None
     ) -> Tuple[bytes, tuple]:
-        if not loop:
-            loop = asyncio.get_running_loop()
+        if not self._unread:
+            batch = await self.read_batch(buff_size, loop=loop)
+            batch.unreleased = len(batch)
+            self._unread.extend((data, address, batch) for data, address in batch)
+        data, address, batch = self._unread.popleft()
+        self._read_batches[id(data)] = batch
+        return data, address
+
+    def release(self, data: memoryview):
+        batch = self._read_batches.pop(id(data))
+        data.release()
+        batch.unreleased -= 1
+        if not batch.unreleased:
+            self._batch_buffers.release(batch.buffer)
+
+    def _resume_reading(self):
+        if not self._reading:
+            self._loop.add_reader(self.socket.fileno(), self._drain)
+            self._reading = True
+
+    def _pause_reading(self):
+        if self._reading:
+            self._loop.remove_reader(self.socket.fileno())
+            self._reading = False
+
+    def _drain(self):
+        """Reader callback, receive datagrams till the socket runs dry (or the batch is full)"""
+        buff = self._batch_buffers.acquire()
+        view = memoryview(buff)
+        batch = _Batch()
+        batch.buffer = buff
+        offset = 0
+        while len(batch) < UDP_BATCH_SIZE and (len(buff) - offset) >= UDP_MAX_DATAGRAM:
+            try:
+                size, address = self.socket.recvfrom_into(view[offset:])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as exp:
+                logger.warning(f"UDP receive error : {exp}")
+                break
+            batch.append((view[offset : offset + size], address))
+            offset += size
+        view.release()
+
+        if not batch:
+            self._batch_buffers.release(buff)
+            return
+        self._batches.append(batch)
+        if len(self._batches) >= UDP_MAX_PENDING_BATCHES:
+            self._pause_reading()  # let the kernel buffer hold the rest for a while
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def read_batch(
+        self, buff_size: int = 1024, loop: asyncio.BaseEventLoop = None
+    ) -> List[Tuple[memoryview, tuple]]:
+        if self._loop is None:
+            self._loop = loop or asyncio.get_running_loop()
+        while True:
+            while not self._batches:
+                self._resume_reading()
+                self._waiter = self._loop.create_future()
+                try:
+                    await self._waiter
+                finally:
+                    self._waiter = None
+            batch = self._batches.popleft()
+            if len(self._batches) < UDP_MAX_PENDING_BATCHES:
+                self._resume_reading()
+            if any(is_fragment(data) for data, _ in batch):
+                batch = self._defragment(batch)
+                if not batch:  # all fragments, nothing completed yet
+                    self.release_batch(batch)
+                    continue
+            return batch
+
+    def release_batch(self, batch: List[Tuple[memoryview, tuple]]):
+        for data, _ in batch:
+            data.release()
+        self._batch_buffers.release(batch.buffer)
+
+    def _defragment(self, batch: _Batch) -> _Batch:
+        """Take the fragments and the NACKs out of a batch, the messages completed by the
+        fragments take their place (order of the batch is kept)"""
+        defragmented = _Batch()
+        defragmented.buffer = batch.buffer
+        now = time.monotonic()
+        for data, address in batch:
+            if not is_fragment(data):
+                defragmented.append((data, address))
+                continue
+            if fragment_kind(data) == KIND_NACK:
+                self._answer_nack(data, address)
+            elif self.reassembler is not None:
+                message = self.reassembler.feed(data, address, now)
+                if message is not None:
+                    defragmented.append((memoryview(message), address))
+            data.release()
+        self._schedule_fragment_check()
+        return defragmented
+
+    def _answer_nack(self, data: memoryview, address: tuple):
+        if self.fragmenter is None:
+            return
+        try:
+            msg_id, missing = unpack_nack(data)
+        except Exception:
+            return  # junk
+        dest, fragments = self.fragmenter.retransmit(msg_id, missing, time.monotonic())
+        dest = dest or address  # to the group for the multicasts (all the receivers missed it)
+        for fragment in fragments:
+            try:
+                self.socket.sendto(fragment, dest)
+            except OSError as exp:
+                logger.debug(f"UDP retransmission to {dest} failed : {exp}")
+                break
 
-        # older method using an executor
-        # return await loop.run_in_executor(None, self.socket.recvfrom, buff_size)   # available from py3.5
+    def _schedule_fragment_check(self):
+        reassembler = self.reassembler
+        if self._fragment_check is None and reassembler is not None and len(reassembler):
+            self._fragment_check = self._loop.call_later(
+                reassembler.nack_delay or reassembler.timeout, self._check_fragments
+            )
 
-        return await loop.sock_recvfrom(
-            self.socket, buff_size
-        )  # the feautre available from py3.11
+    def _check_fragments(self):
+        """Timer callback, ask for the missing fragments (NACK) and drop the timed out ones"""
+        self._fragment_check = None
+        for address, nack in self.reassembler.check(time.monotonic()):
+            try:
+                self.socket.sendto(nack, address)
+            except OSError as exp:
+                logger.debug(f"UDP NACK to {address} failed : {exp}")
+        self._schedule_fragment_check()
 
 
 class TCPListenSession(ListenSession):
-    """A simple socket listen session"""
+    """A simple socket listen session
+
+    Backed by an `asyncio.start_server` server, every accepted connection is served
+    in its own task, so a peer can keep the connection open and send more messages
+    over it (each one is acknowledged with `TCP_ACK`). The messages from all the
+    connections are handed over through `read`.
+
+    If a `frame_reader` is given, messages are cut out of the stream with it, so they
+    can span any number of segments and be pipelined back-to-back on the connection.
+    """
 
     protocol = "TCP"
+    max_batch = 256  # max messages handed over by a `read_batch`
+    read_queue_size = TCP_READ_QUEUE_SIZE  # the connections stop reading if it's full
+
+    def __init__(
+        self,
+        socket: socket.socket,
+        backlog: int = TCP_BACKLOG,
+        max_connections: int = TCP_MAX_CONNECTIONS,
+        frame_reader: Callable[[asyncio.StreamReader], Awaitable[bytes]] = None,
+    ) -> None:
+        """
+
+        Parameters
+        ----------
+        socket:     socket.socket
+            bound tcp socket to be served
+        backlog:    int
+            listen backlog of the socket
+        max_connections:    int
+            maximum number of connections served concurrently (others wait for a slot)
+        frame_reader:   callable
+            coroutine function reading exactly one message from a stream reader
+            (resolve with None on a clean EOF). A single `read` is taken as a message otherwise
 
-    def __init__(self, socket: socket.socket) -> None:
+        """
         self.socket = socket
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.frame_reader = frame_reader
+
+        self._buff_size = 1024
+        self._server: asyncio.Server = None
+        self._queue: asyncio.Queue = None
+        self._slots: asyncio.Semaphore = None
+        self._writers = set()  # open client connections
+        self._idle = {}  # connections waiting for their next message (oldest first)
+        self._waiting = 0  # connections waiting for a slot
+        self._holds = {}  # peername -> awaitables the connection waits for (see `hold`)
 
     def __enter__(self, *args, **kwargs):
         return self
@@ -108,35 +371,104 @@ class TCPListenSession(ListenSession):
     def __exit__(self, *args, **kwargs):
         self.close()
 
+    def close(self):
+        for writer in list(self._writers):
+            writer.close()  # the connection tasks will see EOF and wrap up
+        if self._server:
+            self._server.close()  # closes the listening socket as well
+            self._server = None
+            self.socket = None
+        else:
+            super().close()
+
     async def read(
         self, buff_size: int = 1024, loop: asyncio.BaseEventLoop = None
     ) -> Tuple[bytes, tuple]:
-        if not loop:
-            loop = asyncio.get_running_loop()
+        if self._server is None:
+            self._buff_size = buff_size
+            self._queue = asyncio.Queue(self.read_queue_size)
+            self._slots = asyncio.Semaphore(self.max_connections)
+            self._server = await asyncio.start_server(
+                self._serve, sock=self.socket, backlog=self.backlog
+            )
+        return await self._queue.get()
+
+    async def read_batch(
+        self, buff_size: int = 1024, loop: asyncio.BaseEventLoop = None
+    ) -> List[Tuple[bytes, tuple]]:
+        batch = [await self.read(buff_size, loop=loop)]
+        # messages from the other connections that piled up in the meantime
+        while len(batch) < self.max_batch and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    def hold(self, address: tuple, waiting: asyncio.Future):
+        """The connection of the address hands over no more messages till it's done (the
+        other connections go on)"""
+        holds = self._holds.setdefault(address, [])
+        holds.append(waiting)
+
+        def done(_):
+            if waiting in holds:
+                holds.remove(waiting)
+            if not holds and self._holds.get(address) is holds:
+                del self._holds[address]
+
+        waiting.add_done_callback(done)
 
-        # yeah our protocol is too simple
-        data, address = None, None
+    async def _read_message(self, reader: asyncio.StreamReader) -> bytes:
+        if self.frame_reader:
+            return await self.frame_reader(reader)
+        # yeah without framing our protocol is too simple (the sender waits for the
+        # reciept before sending the next one, so a read is a message)
+        return await reader.read(self._buff_size)
 
-        client_socket, address = await loop.sock_accept(self.socket)
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Read messages from a single connection till the peer closes it (or stays idle)"""
+        self._writers.add(writer)
+        address = writer.get_extra_info("peername")
         try:
-            client_socket.settimeout(TCP_TIMEOUT)
-            # data = await loop.run_in_executor(None, client_socket.recv, buff_size)    # available from py3.7
-            data = await loop.sock_recv(
-                client_socket, buff_size
-            )  # avialble from py3.11
+            if self._slots.locked():
+                logger.debug(f"too many connections, {address} waiting for a slot")
+                if self._idle:
+                    # make room by dropping the connection that stayed idle the longest
+                    next(iter(self._idle)).close()
+            self._waiting += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                self._waiting -= 1
+            try:
+                while True:
+                    data = await asyncio.wait_for(
+                        self._read_message(reader), TCP_KEEPALIVE_TIMEOUT
+                    )
+                    self._idle.pop(writer, None)
+                    if not data:
+                        break
+                    holds = self._holds.pop(address, None)
+                    if holds:
+                        await asyncio.gather(*holds, return_exceptions=True)
+                    await self._queue.put((data, address))
+                    writer.write(TCP_ACK)
+                    await writer.drain()
+                    if self._waiting:
+                        break  # somebody is waiting for the slot, don't keep it idle
+                    self._idle[writer] = None  # waiting for the next message
+            finally:
+                self._slots.release()
         except TimeoutError:
-            logger.warning("Client Takes too much time : {address} [is he a hacker!]")
+            logger.debug(f"closing idle connection : {address}")
+        except asyncio.IncompleteReadError:
+            logger.warning(f"Client disconnected in the middle of a message : {address}")
+        except ValueError as exp:
+            logger.warning(f"dropping connection {address} : {exp}")
         except OSError:
             logger.warning("Client disconnected in between!")
+        except asyncio.CancelledError:
+            ...  # shutting down (asyncio can't handle a cancelled connection callback)
         finally:
-            try:
-                client_socket.shutdown(socket.SHUT_RDWR)
-                try:
-                    client_socket.recv(400_000_000)
-                except:
-                    ...
-                client_socket.close()
-                client_socket = None
-            except:
-                ...
-        return data, address
+            self._writers.discard(writer)
+            self._idle.pop(writer, None)
+            self._holds.pop(address, None)
+            writer.close()
@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Tuple
+
+from ...settings import logger, TCP_POOL_MAX_CONNECTIONS, TCP_POOL_IDLE_TIMEOUT
+
+
+class ConnectionPool:
+    """A tiny LRU pool of idle connections keyed by peer (addr, port)
+
+    The pool only holds *idle* connections. A connection is taken out of the pool
+    with `acquire` and handed back with `release` once the exchange is done, so
+    the same stream is never shared between two senders at a time.
+    """
+
+    def __init__(
+        self,
+        close: Callable[[Any], None],
+        max_connections: int = TCP_POOL_MAX_CONNECTIONS,
+        idle_timeout: float = TCP_POOL_IDLE_TIMEOUT,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        close:  callable
+            called with a connection object whenever the pool drops it
+        max_connections:    int
+            maximum number of idle connections kept around (LRU eviction after that)
+        idle_timeout:   float
+            seconds after which an unused connection is closed
+        """
+        self._close = close
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        # (key, id(conn)) -> (conn, last_used) ; ordered by last use (oldest first)
+        self._idle: "OrderedDict[Tuple[Hashable, int], Tuple[Any, float]]" = (
+            OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._idle)
+
+    def acquire(self, key: Hashable) -> Any:
+        """Take an idle connection for the given key out of the pool (None if there is none)"""
+        self.sweep()
+        # most recently used first, it's the one with least chance of being stale
+        for pool_key in reversed(self._idle):
+            if pool_key[0] == key:
+                conn, _ = self._idle.pop(pool_key)
+                return conn
+        return None
+
+    def release(self, key: Hashable, conn: Any):
+        """Hand back a healthy connection to the pool"""
+        self._idle[(key, id(conn))] = (conn, time.monotonic())
+        while len(self._idle) > self.max_connections:
+            (old_key, _), (old_conn, _) = self._idle.popitem(last=False)
+            logger.debug(f"connection pool full, evicting : {old_key}")
+            self.discard(old_conn)
+
+    def discard(self, conn: Any):
+        """Close a connection without putting it back"""
+        if conn is None:
+            return
+        try:
+            self._close(conn)
+        except Exception:
+            ...
+
+    def sweep(self):
+        """Close the connections that stayed idle for too long"""
+        deadline = time.monotonic() - self.idle_timeout
+        while self._idle:
+            pool_key = next(iter(self._idle))
+            conn, last_used = self._idle[pool_key]
+            if last_used > deadline:
+                break
+            del self._idle[pool_key]
+            self.discard(conn)
+
+    def clear(self):
+        """Close all the idle connections"""
+        while self._idle:
+            _, (conn, _) = self._idle.popitem()
+            self.discard(conn)
@@ -1,7 +1,24 @@
 import socket
+import asyncio
+from collections import Counter
+from typing import Callable, Awaitable
 
 from .interfaces import ListenSession, UDPListenSession, TCPListenSession
-from ...settings import logger, STMP_MADDR, STMP_PORT, TCP_PORT, TCP_TIMEOUT
+from .pool import ConnectionPool
+from .fragments import Fragmenter, Reassembler
+from ...settings import (
+    logger,
+    STMP_MADDR,
+    STMP_PORT,
+    UDP_RCVBUF,
+    UDP_FRAGMENT_SIZE,
+    TCP_PORT,
+    TCP_TIMEOUT,
+    TCP_POOL_MAX_CONNECTIONS,
+    TCP_POOL_IDLE_TIMEOUT,
+    TCP_BACKLOG,
+    TCP_MAX_CONNECTIONS,
+)
 
 
 class Transport:
@@ -54,7 +71,13 @@ class Transport:
 class UDPTransport(Transport):
     """A simple UDP transport."""
 
-    def __init__(self, maddr: str = STMP_MADDR, port: int = STMP_PORT) -> None:
+    def __init__(
+        self,
+        maddr: str = STMP_MADDR,
+        port: int = STMP_PORT,
+        rcvbuf: int = UDP_RCVBUF,
+        fragment_size: int = UDP_FRAGMENT_SIZE,
+    ) -> None:
         """TransilationLayer! Feel Free to change the port and multicast address.
 
         Parameters
@@ -63,10 +86,19 @@ class UDPTransport(Transport):
             multicast address to be used
         port:   int
             port to be used
+        rcvbuf: int
+            SO_RCVBUF to be requested for the socket (system default if None)
+        fragment_size:  int
+            datagrams bigger than this are sent as fragments (None to send them as they are)
 
         """
         self.addr = maddr
         self.port = port
+        self.rcvbuf = rcvbuf
+
+        # fragmentation event -> count (fragments sent/received, NACKs, retransmissions..)
+        self.fragment_stats = Counter()
+        self.fragmenter = Fragmenter(fragment_size, stats=self.fragment_stats)
 
         # socket
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -81,11 +113,24 @@ class UDPTransport(Transport):
         except:
             ...
 
-    def send(self, data: bytes, addr: str = None, port: int = None) -> bool:
+    def send(
+        self, data: bytes, addr: str = None, port: int = None, fragment: bool = True
+    ) -> bool:
+        """multicasts a UDP datagram (see `Transport.send`), a datagram bigger than the
+        fragment size goes as fragments if `fragment` (every receiver should support them)"""
         if not addr:
             addr = self.addr
         if not port:
             port = self.port
+        if fragment and self.fragmenter.needs_split(data):
+            for part in self.fragmenter.split(data, dest=(addr, port)):
+                try:
+                    self._sock.sendto(part, (addr, port))
+                except BlockingIOError:
+                    # send buffer is full, the receivers will ask for it (NACK)
+                    self.fragment_stats["send_dropped"] += 1
+            logger.debug(f"Multicasted message (fragmented) : {addr}:{port}")
+            return True
         self._sock.sendto(data, (addr, port))
         logger.debug(f"Multicasted message : {addr}:{port}")
         return True
@@ -95,20 +140,41 @@ class UDPTransport(Transport):
 
         self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
         self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, True)
+        if self.rcvbuf:
+            # the kernel may cap it (net.core.rmem_max)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+            logger.debug(
+                "UDP SO_RCVBUF : "
+                + str(self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+            )
 
         #register to multicast group
-        mGroup = socket.inet_aton(STMP_MADDR) + socket.INADDR_ANY.to_bytes(4, byteorder='big')
+        mGroup = socket.inet_aton(self.addr) + socket.INADDR_ANY.to_bytes(4, byteorder='big')
         self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mGroup)
         #bind the socket to the correct port
-        self._sock.bind(('', STMP_PORT))
+        self._sock.bind(('', self.port))
 
-        return UDPListenSession(self._sock, self.addr)
+        return UDPListenSession(
+            self._sock,
+            self.addr,
+            fragmenter=self.fragmenter,
+            reassembler=Reassembler(stats=self.fragment_stats),
+        )
 
 
 class TCPTransport(Transport):
     """A simple TCP transport. Now we got the read reciepts"""
 
-    def __init__(self, baddr: str = "", port: int = TCP_PORT) -> None:
+    def __init__(
+        self,
+        baddr: str = "",
+        port: int = TCP_PORT,
+        pool_max_connections: int = TCP_POOL_MAX_CONNECTIONS,
+        pool_idle_timeout: float = TCP_POOL_IDLE_TIMEOUT,
+        backlog: int = TCP_BACKLOG,
+        max_connections: int = TCP_MAX_CONNECTIONS,
+        frame_reader: Callable[[asyncio.StreamReader], Awaitable[bytes]] = None,
+    ) -> None:
         """TransilationLayer! Feel Free to change the port and multicast address.
 
         Parameters
@@ -117,56 +183,200 @@ class TCPTransport(Transport):
             bind address to be used
         port:   int
             port to be used
+        pool_max_connections:   int
+            maximum number of idle outgoing connections kept open for reuse
+        pool_idle_timeout:  float
+            seconds after which an unused outgoing connection is closed
+        backlog:    int
+            listen backlog of the listening socket
+        max_connections:    int
+            maximum number of incoming connections served concurrently
+        frame_reader:   callable
+            coroutine function reading exactly one message from an incoming stream
 
         """
         self.addr = baddr
         self.port = port
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.frame_reader = frame_reader
 
-        # socket
+        # outcome of the sends ("ok", "unavailable", "timeout", "error") -> count
+        self.send_results = Counter()
+
+        # socket (listening socket only, outgoing messages use the pool)
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._pool = ConnectionPool(
+            close=self._close_conn,
+            max_connections=pool_max_connections,
+            idle_timeout=pool_idle_timeout,
+        )
+        # asyncio streams (reader, writer) used by `send_async`
+        self._stream_pool = ConnectionPool(
+            close=lambda conn: conn[1].close(),
+            max_connections=pool_max_connections,
+            idle_timeout=pool_idle_timeout,
+        )
 
     def __enter__(self, *args, **kwargs):
         return self
 
     def __exit__(self, *args, **kwargs):
         # closing the port
+        self._pool.clear()
+        self._stream_pool.clear()
         try:
             self._sock.close()
         except:
             ...
 
+    @staticmethod
+    def _close_conn(conn: socket.socket):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            ...
+        conn.close()
+
+    @staticmethod
+    def _is_alive(conn: socket.socket) -> bool:
+        """Check (without blocking) if the peer is still holding the idle connection"""
+        timeout = conn.gettimeout()
+        conn.setblocking(False)
+        try:
+            return bool(conn.recv(1, socket.MSG_PEEK))
+        except BlockingIOError:
+            return True  # nothing to read, still connected
+        except OSError:
+            return False
+        finally:
+            conn.settimeout(timeout)
+
+    def _connect(self, addr: str, port: int) -> socket.socket:
+        conn = socket.create_connection((addr, port), timeout=TCP_TIMEOUT)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
     def send(self, data: bytes, addr: str, port: int = TCP_PORT) -> bool:
-        """Send a message using TCP, will return with True if all went ok, otherwise False"""
+        """Send a message using TCP, will return with True if all went ok, otherwise False
+
+        Connections are kept open and reused for the following messages to the same peer.
+        A message is sent again (on a new connection) only if a pooled connection fails while
+        writing it, once written it may have been delivered, so it's reported as failed.
+        """
+        key = (addr, port)
+        conn = self._pool.acquire(key)
+        while conn is not None and not self._is_alive(conn):
+            self._pool.discard(conn)
+            conn = self._pool.acquire(key)
+        reused = conn is not None
+        written = False
+
         try:
-            self._sock.connect((addr, port))
-            self._sock.sendall(data)
+            if not reused:
+                conn = self._connect(addr, port)
+            conn.sendall(data)
+            written = True
 
             # confirm reciept
-            self._sock.settimeout(TCP_TIMEOUT)
-            self._sock.recv(1024)
+            ack = conn.recv(1)
+            if not ack:
+                if reused:
+                    # the peer dropped the connection, maybe after reading the message
+                    raise ConnectionResetError("pooled connection closed before the ack")
+                # peer closed the connection after reading (one message per connection peer)
+                self._pool.discard(conn)
+            else:
+                self._pool.release(key, conn)
             logger.debug(f"Sent message to server: {addr}:{port}")
+            self.send_results["ok"] += 1
             return True
+        except ConnectionError:
+            self._pool.discard(conn)
+            if reused and not written:
+                # the peer can't have got the whole message
+                logger.debug(f"pooled connection to {addr}:{port} is stale, reconnecting")
+                return self.send(data, addr=addr, port=port)
+            logger.warning(f"peer is unawailable: {addr}:{port} ")
+            self.send_results["unavailable"] += 1
+            return False
         except TimeoutError:
+            self._pool.discard(conn)
             logger.warning(
                 f"peer takes too much time to respond: {addr}:{port} (is he a hacker!)"
             )
+            self.send_results["timeout"] += 1
             return False
+        except Exception as exp:
+            self._pool.discard(conn)
+            logger.warning(f"connection reset by peer : {exp}")
+            self.send_results["error"] += 1
+            return False
+
+    async def send_async(self, data: bytes, addr: str, port: int = TCP_PORT) -> bool:
+        """Non-blocking version of `send` built on asyncio streams,
+        will resolve with True if all went ok, otherwise False"""
+        key = (addr, port)
+        conn = self._stream_pool.acquire(key)
+        while conn is not None and (conn[0].at_eof() or conn[1].is_closing()):
+            self._stream_pool.discard(conn)
+            conn = self._stream_pool.acquire(key)
+        reused = conn is not None
+        written = False
+
+        try:
+            if not reused:
+                conn = await asyncio.wait_for(
+                    asyncio.open_connection(addr, port), TCP_TIMEOUT
+                )
+            reader, writer = conn
+            writer.write(data)
+            # nothing left in the buffer : it all went to the socket already
+            written = not writer.transport.get_write_buffer_size()
+            await asyncio.wait_for(writer.drain(), TCP_TIMEOUT)
+            written = True
+
+            # confirm reciept
+            ack = await asyncio.wait_for(reader.read(1), TCP_TIMEOUT)
+            if not ack:
+                if reused:
+                    raise ConnectionResetError("pooled connection closed before the ack")
+                self._stream_pool.discard(conn)
+            else:
+                self._stream_pool.release(key, conn)
+            logger.debug(f"Sent message to server: {addr}:{port}")
+            self.send_results["ok"] += 1
+            return True
         except ConnectionError:
+            self._stream_pool.discard(conn)
+            if reused and not written:
+                logger.debug(f"pooled connection to {addr}:{port} is stale, reconnecting")
+                return await self.send_async(data, addr=addr, port=port)
             logger.warning(f"peer is unawailable: {addr}:{port} ")
+            self.send_results["unavailable"] += 1
+            return False
+        except TimeoutError:
+            self._stream_pool.discard(conn)
+            logger.warning(
+                f"peer takes too much time to respond: {addr}:{port} (is he a hacker!)"
+            )
+            self.send_results["timeout"] += 1
             return False
         except Exception as exp:
+            self._stream_pool.discard(conn)
             logger.warning(f"connection reset by peer : {exp}")
+            self.send_results["error"] += 1
             return False
-        finally:
-            try:
-                self._sock.close()
-            except:
-                ...
 
     def listen(self) -> "ListenSession":
         """Create a TCP listenerSession"""
         self._prepare_sock()
         self._sock.bind((self.addr, self.port))
-        self._sock.listen(5)  # TODO: adjust the backlog
-
-        return TCPListenSession(self._sock)
+        self._sock.listen(self.backlog)
+
+        return TCPListenSession(
+            self._sock,
+            backlog=self.backlog,
+            max_connections=self.max_connections,
+            frame_reader=self.frame_reader,
+        )
@@ -0,0 +1,361 @@
+"""STMP benchmarks
+
+A standalone runner (no extra dependencies) for the hot paths : packet packing/decoding,
+encryption and the loopback UDP (multicast) / TCP exchanges between two in-process servers.
+The results are dumped as JSON, so the runs can be compared across releases.
+
+    python test/benchmark.py                          # everything, JSON on stdout
+    python test/benchmark.py --output bench.json      # or into a file
+    python test/benchmark.py --only pack,crypto --quick
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import stmp
+from stmp import STMPServer
+from stmp.stmp_server.transilation import TransilationProtocol
+from stmp.stmp_server.transilation.enc import Encryption
+
+GROUPS = ("pack", "crypto", "udp", "tcp")
+SIZES = (16, 256, 4096, 32768)  # payload sizes (bytes)
+
+
+def bench(func, number: int, repeat: int = 5) -> dict:
+    """Time `number` calls of func, `repeat` times (the best run is the one to compare)"""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        runs.append((time.perf_counter() - start) / number)
+    best = min(runs)
+    return {
+        "ops_per_sec": round(1 / best, 1),
+        "best_us": round(best * 1e6, 3),
+        "median_us": round(statistics.median(runs) * 1e6, 3),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def latency_summary(samples: list) -> dict:
+    """Summary of latency samples (seconds) in microseconds"""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    percentile = lambda pct: samples[min(len(samples) - 1, int(len(samples) * pct))]
+    return {
+        "count": len(samples),
+        "mean_us": round(statistics.fmean(samples) * 1e6, 1),
+        "p50_us": round(percentile(0.50) * 1e6, 1),
+        "p90_us": round(percentile(0.90) * 1e6, 1),
+        "p99_us": round(percentile(0.99) * 1e6, 1),
+        "max_us": round(samples[-1] * 1e6, 1),
+    }
+
+
+def payload(size: int, serializer: str):
+    return b"x" * size if serializer == "raw" else "x" * size
+
+
+# groups
+def bench_pack(args) -> dict:
+    """`TransilationProtocol.pack` / `decode_parts` (and the headers) across payload sizes"""
+    protocol = TransilationProtocol(user="bench", hostname="bench")
+    pub_key = protocol.encyption.pub_key
+    size_bytes_len = protocol.size()
+    results = {}
+
+    for binary_header in (False, True):
+        packet = protocol.pack({"msg": "x"}, namespace="/bench", binary_header=binary_header)
+        version, header_s, _ = protocol.unpack_prefix(packet[:size_bytes_len])
+        header = packet[size_bytes_len : size_bytes_len + header_s]
+        name = "binary" if binary_header else "json"
+        results[f"decode_header/{name}"] = bench(
+            lambda: protocol.decode_header(header, version), args.number * 10
+        )
+
+    for size in args.sizes:
+        for serializer in ("json", "raw"):
+            data = payload(size, serializer)
+            for mode, enc_key, compression in (
+                ("plain", "", None),
+                ("hybrid", pub_key, None),
+                ("zlib", "", "zlib"),
+                ("hybrid+zlib", pub_key, "zlib"),
+            ):
+                pack = lambda: protocol.pack(
+                    data,
+                    namespace="/bench",
+                    enc_key=enc_key,
+                    serializer=serializer,
+                    compression=compression,
+                )
+                packet = pack()
+                version, header_s, _ = protocol.unpack_prefix(packet[:size_bytes_len])
+                header = protocol.decode_header(
+                    packet[size_bytes_len : size_bytes_len + header_s], version
+                )
+                body = packet[size_bytes_len + header_s :]
+                decrypt = Encryption.HYBRID_CIPHER if enc_key else False
+                name = f"{serializer}/{mode}/{size}"
+                results[f"pack/{name}"] = {**bench(pack, args.number), "bytes": len(packet)}
+                results[f"decode_parts/{name}"] = bench(
+                    lambda: protocol.decode_parts(
+                        body,
+                        decrypt=decrypt,
+                        serializer=serializer,
+                        compression=header.get("cmp"),
+                    ),
+                    args.number,
+                )
+    return results
+
+
+def bench_crypto(args) -> dict:
+    """`Encryption` : RSA, hybrid (RSA wrapped AES-GCM) and key generation"""
+    encryption = Encryption()
+    pub_key = encryption.pub_key
+    results = {"keygen": bench(Encryption, 1, repeat=3)}
+
+    message = b"x" * 64  # RSA (OAEP, 1024 bit) takes ~86 bytes at most
+    ciphertext = Encryption.encrypt(message, pub_key)
+    results["rsa/encrypt/64"] = bench(lambda: Encryption.encrypt(message, pub_key), args.number)
+    results["rsa/decrypt/64"] = bench(
+        lambda: encryption.decypt(ciphertext), max(1, args.number // 10)
+    )
+    for size in args.sizes:
+        message = b"x" * size
+        ciphertext = encryption.encrypt_hybrid(message, pub_key)
+        results[f"hybrid/encrypt/{size}"] = bench(
+            lambda: encryption.encrypt_hybrid(message, pub_key), args.number
+        )
+        results[f"hybrid/decrypt/{size}"] = bench(
+            lambda: encryption.decrypt_hybrid(ciphertext), args.number
+        )
+    return results
+
+
+class Loopback:
+    """A receiver and a sender server in the same process (and loop)"""
+
+    def __init__(self, args) -> None:
+        self.args = args
+        self.receiver = STMPServer(
+            user="bench-rx", udpport=args.udp_port, tcpport=args.tcp_port
+        )
+        self.sender = STMPServer(
+            user="bench-tx", udpport=args.udp_port, tcpport=args.tcp_port + 1
+        )
+        self.received = 0
+        self.target = None
+        self.done: asyncio.Future = None
+
+        @self.receiver.route("/bench", queue_size=1 << 20)
+        def on_message(_):
+            self.received += 1
+            if self.received == self.target and not self.done.done():
+                self.done.set_result(time.perf_counter())
+
+    def expect(self, count: int):
+        self.received = 0
+        self.target = count
+        self.done = asyncio.get_running_loop().create_future()
+
+    async def wait(self, timeout: float = 10) -> float:
+        """Time at which the expected messages got received (None on timeout)"""
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.done), timeout)
+        except TimeoutError:
+            return None
+
+
+async def _udp(args, loopback: Loopback) -> dict:
+    results = {}
+    sender = loopback.sender
+    for size in (64, 1024):
+        data = "x" * size
+
+        # latency, one message at a time
+        samples = []
+        for _ in range(args.latency_count):
+            loopback.expect(1)
+            start = time.perf_counter()
+            sender.send_udp(data, namespace="/bench")
+            end = await loopback.wait(1)
+            if end is not None:
+                samples.append(end - start)
+        results[f"latency/{size}"] = latency_summary(samples)
+
+        # throughput, bursts of datagrams (yielding in between so the receiver can drain)
+        count = args.number * 10
+        loopback.expect(count)
+        start = time.perf_counter()
+        for index in range(count):
+            sender.send_udp(data, namespace="/bench")
+            if not index % 64:
+                await asyncio.sleep(0)
+        end = await loopback.wait(5)
+        elapsed = (end or time.perf_counter()) - start
+        results[f"throughput/{size}"] = {
+            "sent": count,
+            "received": loopback.received,
+            "msgs_per_sec": round(loopback.received / elapsed, 1),
+            "mb_per_sec": round(loopback.received * size / elapsed / 1e6, 3),
+        }
+    return results
+
+
+async def _tcp(args, loopback: Loopback) -> dict:
+    results = {}
+    sender = loopback.sender
+    addr, port = "127.0.0.1", args.tcp_port
+    pub_key = loopback.receiver._t_protocol.encyption.pub_key
+    for size in (64, 1024, 32768):
+        data = "x" * size
+        for mode, enc_key in (("plain", ""), ("hybrid", pub_key)):
+            name = f"{mode}/{size}"
+
+            # latency, message + ack round trip (pooled connection)
+            samples = []
+            for _ in range(args.latency_count):
+                start = time.perf_counter()
+                if await sender.send_tcp_async(data, addr, port, "/bench", enc_key=enc_key):
+                    samples.append(time.perf_counter() - start)
+            results[f"latency/{name}"] = latency_summary(samples)
+
+            # throughput, a few senders at a time
+            count, concurrency = args.number * 2, 16
+            loopback.expect(count)
+            start = time.perf_counter()
+            for offset in range(0, count, concurrency):
+                await asyncio.gather(
+                    *[
+                        sender.send_tcp_async(data, addr, port, "/bench", enc_key=enc_key)
+                        for _ in range(min(concurrency, count - offset))
+                    ]
+                )
+            end = await loopback.wait(5)
+            elapsed = (end or time.perf_counter()) - start
+            results[f"throughput/{name}"] = {
+                "sent": count,
+                "received": loopback.received,
+                "concurrency": concurrency,
+                "msgs_per_sec": round(loopback.received / elapsed, 1),
+                "mb_per_sec": round(loopback.received * size / elapsed / 1e6, 3),
+            }
+    return results
+
+
+async def _loopback(args, groups: list) -> dict:
+    loopback = Loopback(args)
+    listeners = [
+        asyncio.create_task(loopback.receiver.listen_udp_async()),
+        asyncio.create_task(loopback.receiver.listen_tcp_async()),
+    ]
+    results = {}
+    try:
+        await asyncio.sleep(0.2)  # listeners getting ready
+        # warm up (peer discovery and key exchange happen on the first packets)
+        loopback.expect(2)
+        loopback.sender.send_udp("warmup", namespace="/bench", pass_pub_key=True)
+        await loopback.sender.send_tcp_async("warmup", "127.0.0.1", args.tcp_port, "/bench")
+        await loopback.wait(2)
+
+        for group, func in (("udp", _udp), ("tcp", _tcp)):
+            if group in groups:
+                try:
+                    results[group] = await func(args, loopback)
+                except OSError as exp:
+                    results[group] = {"error": repr(exp)}
+        results["server_stats"] = loopback.receiver.stats()
+    finally:
+        for task in listeners:
+            task.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    groups = args.only.split(",") if args.only else list(GROUPS)
+    report = {
+        "meta": {
+            "stmp_version": stmp.__version__,
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "hostname": socket.gethostname(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "args": {key: val for key, val in vars(args).items() if key != "output"},
+        },
+        "results": {},
+    }
+    results = report["results"]
+    if "pack" in groups:
+        results["pack"] = bench_pack(args)
+    if "crypto" in groups:
+        results["crypto"] = bench_crypto(args)
+    if "udp" in groups or "tcp" in groups:
+        results.update(asyncio.run(_loopback(args, groups)))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="STMP benchmarks (JSON results)")
+    parser.add_argument("--output", "-o", help="write the results into a file (stdout otherwise)")
+    parser.add_argument("--only", help=f"comma separated groups to run : {','.join(GROUPS)}")
+    parser.add_argument("--number", type=int, default=1000, help="iterations per measurement")
+    parser.add_argument("--latency-count", type=int, default=200, help="round trips to time")
+    parser.add_argument(
+        "--sizes",
+        type=lambda val: [int(size) for size in val.split(",")],
+        default=list(SIZES),
+        help="payload sizes for pack/crypto (comma separated)",
+    )
+    parser.add_argument("--udp-port", type=int, default=57100, help="multicast port to use")
+    parser.add_argument(
+        "--tcp-port", type=int, default=57101, help="TCP port of the receiver (+1 for the sender)"
+    )
+    parser.add_argument("--quick", action="store_true", help="fewer iterations (smoke run)")
+    args = parser.parse_args()
+    if args.quick:
+        args.number, args.latency_count = 100, 20
+
+    logging.getLogger("stmp").setLevel(logging.ERROR)
+    with contextlib.redirect_stdout(sys.stderr):  # keeping stdout for the JSON
+        report = json.dumps(run(args), indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+from stmp.batching import BroadcastBatcher, batch_body
+from stmp.stmp_server.transilation.serializers import SERIALIZERS, RawJSON, pick_serializer
+
+
+def run_batcher(messages, max_size=1200, delay=0.01):
+    sent = []
+
+    async def main():
+        batcher = BroadcastBatcher(lambda port, items: sent.append((port, items)), delay, max_size)
+        added = [batcher.add(namespace, data, port=57000) for namespace, data in messages]
+        await asyncio.sleep(delay * 5)
+        return added
+
+    return asyncio.run(main()), sent
+
+
+def test_raw_json_goes_as_it_is():
+    data = RawJSON(b'{"a":[1,2]}')
+    assert pick_serializer(data) == "json"
+    assert pick_serializer(b"bytes") == "raw"
+    assert SERIALIZERS["json"].dumps(data) is data
+
+
+def test_batch_body():
+    items = [["/a", RawJSON(b'{"v":1}')], ['/b "quoted"', RawJSON(b"[1,null]")]]
+    assert json.loads(batch_body(items)) == [["/a", {"v": 1}], ['/b "quoted"', [1, None]]]
+
+
+def test_batched_once_serialised():
+    data = {"v": 1}
+    added, sent = run_batcher([("/a", data), ("/b", "text")])
+    data["v"] = 2  # changed after the broadcast
+    assert added == [True, True]
+    [(port, items)] = sent
+    assert port == 57000
+    assert all(isinstance(item_data, RawJSON) for _, item_data in items)
+    assert json.loads(batch_body(items)) == [["/a", {"v": 1}], ["/b", "text"]]
+
+
+def test_batch_size():
+    messages = [(f"/n/{i}", "x" * 100) for i in range(30)]
+    _, sent = run_batcher(messages, max_size=500)
+    assert sum(len(items) for _, items in sent) == 30
+    for _, items in sent:
+        assert len(batch_body(items)) <= 500 + 2  # the outer brackets
+
+
+def test_not_batched():
+    added, sent = run_batcher([("/big", "x" * 2000), ("/set", {1, 2})])
+    assert added == [False, False] and sent == []
+    # no running loop to send the batch later
+    assert BroadcastBatcher(lambda port, items: None).add("/a", 1) is False
@@ -0,0 +1,104 @@
+import os
+import zlib
+
+import pytest
+
+from stmp.exceptions import UsageError
+from stmp.stmp_server.transilation import TransilationProtocol
+from stmp.stmp_server.transilation.compression import COMPRESSORS
+from stmp.stmp_server.transilation.headers import BinaryHeader
+
+LIMIT = 64 * 1024
+
+
+@pytest.fixture(scope="module")
+def protocol():
+    return TransilationProtocol(user="tester", hostname="box")
+
+
+def compressor(name):
+    if name != "zlib":
+        pytest.importorskip({"lz4": "lz4.frame", "zstd": "zstandard"}[name])
+    return COMPRESSORS[name]
+
+
+@pytest.mark.parametrize("name", ["zlib", "lz4", "zstd"])
+def test_round_trip(name):
+    codec = compressor(name)
+    data = b"sensor reading 21.5 celsius " * 1000
+    packed = codec.compress(data)
+    assert len(packed) < len(data)
+    assert codec.decompress(packed, len(data)) == data
+    assert codec.decompress(codec.compress(b""), LIMIT) == b""
+
+
+@pytest.mark.parametrize("name", ["zlib", "lz4", "zstd"])
+def test_decompression_limit(name):
+    codec = compressor(name)
+    bomb = codec.compress(bytes(LIMIT * 16))
+    with pytest.raises(ValueError):
+        codec.decompress(bomb, LIMIT)
+    # right at the limit is fine
+    assert len(codec.decompress(codec.compress(bytes(LIMIT)), LIMIT)) == LIMIT
+    with pytest.raises(ValueError):
+        codec.decompress(codec.compress(bytes(LIMIT + 1)), LIMIT)
+
+
+def unpack(protocol, packet):
+    n = protocol.size()
+    version, header_s, _ = protocol.unpack_prefix(packet[:n])
+    header = protocol.decode_header(packet[n : n + header_s], version)
+    return version, header, packet[n + header_s :]
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_pack_compressed(protocol, binary):
+    data = {"readings": [{"sensor": i, "value": i * 1.5} for i in range(200)]}
+    packet = protocol.pack(data, compression="zlib", binary_header=binary)
+    _, header, body = unpack(protocol, packet)
+    assert header["cmp"] == "zlib"
+    assert protocol.decode_parts(body, compression="zlib") == data
+    assert len(packet) < len(protocol.pack(data, binary_header=binary))
+
+
+def test_pack_not_worth_compressing(protocol):
+    _, header, _ = unpack(protocol, protocol.pack({"a": 1}, compression="zlib"))
+    assert "cmp" not in header  # below COMPRESSION_MIN_SIZE
+    noise = os.urandom(4000)
+    _, header, body = unpack(protocol, protocol.pack(noise, serializer="raw", compression="zlib"))
+    assert "cmp" not in header and body == noise  # wouldn't shrink
+
+
+def test_pack_unknown_compression(protocol):
+    with pytest.raises(UsageError):
+        protocol.pack({"a": "b" * 2000}, compression="brotli")
+
+
+def test_decode_bomb(protocol):
+    bomb = zlib.compress(bytes(protocol.max_packet_size * 2))
+    assert protocol.decode_parts(bomb, compression="zlib") is None
+
+
+def test_hv_in_version_bits(protocol):
+    packet = protocol.pack({"a": 1}, binary_header=True)
+    version, header, _ = unpack(protocol, packet)
+    assert version == protocol.header_version == header["hv"]
+    assert version >= BinaryHeader.hv_version
+    # not repeated in the extras
+    assert b"hv" not in packet
+
+
+def test_hv_beyond_version_bits():
+    codec = BinaryHeader()
+    header = {"udpport": 1, "tcpport": 2, "user": "u", "hostname": "h", "namespace": "/"}
+    data = codec.encode({**header, "hv": BinaryHeader.max_hv_bits + 2})
+    assert codec.decode(data, hv=BinaryHeader.max_hv_bits)["hv"] == BinaryHeader.max_hv_bits + 2
+
+
+def test_version_one_binary_header():
+    # the first peers having binary headers send version 1, their "hv" in the extras
+    codec = BinaryHeader()
+    header = {"udpport": 1, "tcpport": 2, "user": "u", "hostname": "h", "namespace": "/"}
+    assert codec.decode(codec.encode(header), hv=BinaryHeader.version)["hv"] == 1
+    extras = codec.encode({**header, "legacy": True})
+    assert codec.decode(extras, hv=BinaryHeader.version)["legacy"] is True
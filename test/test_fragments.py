@@ -0,0 +1,143 @@
+import os
+import random
+
+import pytest
+
+from stmp.stmp_server.transport.fragments import (
+    FRAGMENT_HEADER,
+    FRAGMENT_MAGIC,
+    KIND_FRAGMENT,
+    KIND_NACK,
+    SLOT_COST,
+    Fragmenter,
+    Reassembler,
+    fragment_kind,
+    is_fragment,
+    pack_nack,
+    unpack_nack,
+)
+
+SENDER = ("10.0.0.2", 57000)
+
+
+def fragment(msg_id: int, index: int, count: int, payload: bytes = b"") -> bytes:
+    return FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, KIND_FRAGMENT, msg_id, index, count) + payload
+
+
+def test_split_and_reassemble_out_of_order():
+    fragmenter, reassembler = Fragmenter(fragment_size=200), Reassembler()
+    data = os.urandom(5000)
+    fragments = fragmenter.split(data, dest=SENDER)
+    assert len(fragments) == -(-len(data) // (200 - FRAGMENT_HEADER.size))
+    assert all(is_fragment(f) and len(f) <= 200 for f in fragments)
+    assert fragmenter.needs_split(data) and not fragmenter.needs_split(data[:100])
+
+    random.shuffle(fragments)
+    results = [reassembler.feed(f, SENDER, now=0.0) for f in fragments]
+    assert results[-1] == data
+    assert results[:-1] == [None] * (len(fragments) - 1)
+    assert len(reassembler) == 0 and reassembler._bytes == 0
+    assert reassembler.stats["reassembled"] == 1
+
+
+def test_duplicates_and_junk():
+    reassembler = Reassembler()
+    assert reassembler.feed(fragment(1, 0, 2, b"a"), SENDER, 0.0) is None
+    assert reassembler.feed(fragment(1, 0, 2, b"a"), SENDER, 0.0) is None
+    assert reassembler.feed(fragment(1, 1, 3, b"b"), SENDER, 0.0) is None  # count changed
+    assert reassembler.feed(fragment(2, 2, 2), SENDER, 0.0) is None  # index out of range
+    assert reassembler.feed(fragment(3, 0, 5000), SENDER, 0.0) is None  # too many fragments
+    assert reassembler.feed(b"\xffSF", SENDER, 0.0) is None
+    assert reassembler.stats["duplicates"] == 1
+    assert reassembler.stats["junk"] == 4
+    assert reassembler.feed(fragment(1, 1, 2, b"b"), SENDER, 0.0) == b"ab"
+
+
+def test_nack_round_trip():
+    data = pack_nack(42, [1, 5, 7])
+    assert is_fragment(data) and fragment_kind(data) == KIND_NACK
+    assert unpack_nack(data) == (42, [1, 5, 7])
+
+
+def test_nack_and_retransmit():
+    fragmenter = Fragmenter(fragment_size=100, resend_interval=1.0)
+    reassembler = Reassembler(nack_delay=0.1, nack_retries=2, timeout=10)
+    data = os.urandom(1000)
+    fragments = fragmenter.split(data, dest=SENDER)
+    for index, f in enumerate(fragments):
+        if index not in (2, 4):  # lost
+            reassembler.feed(f, SENDER, now=0.0)
+
+    assert reassembler.check(now=0.05) == []  # not yet
+    [(address, nack)] = reassembler.check(now=0.1)
+    assert address == SENDER
+    msg_id, missing = unpack_nack(nack)
+    assert missing == [2, 4]
+
+    dest, resend = fragmenter.retransmit(msg_id, missing, now=0.1)
+    assert dest == SENDER and resend == [fragments[2], fragments[4]]
+    # an other receiver asking within the resend interval is answered by the same resend
+    assert fragmenter.retransmit(msg_id, missing, now=0.2) == (SENDER, [])
+    assert fragmenter.stats["retransmits_coalesced"] == 2
+    assert fragmenter.retransmit(msg_id, [4, 99], now=1.2) == (SENDER, [fragments[4]])
+    assert fragmenter.retransmit(12345, [0], now=1.2) == (None, [])
+
+    assert reassembler.feed(resend[0], SENDER, now=0.3) is None
+    assert reassembler.feed(resend[1], SENDER, now=0.3) == data
+
+
+def test_nack_retries_and_timeout():
+    reassembler = Reassembler(nack_delay=0.1, nack_retries=2, timeout=1.0)
+    reassembler.feed(fragment(7, 0, 3, b"x"), SENDER, now=0.0)
+    assert len(reassembler.check(now=0.1)) == 1
+    assert len(reassembler.check(now=0.2)) == 1
+    assert reassembler.check(now=0.5) == []  # out of retries
+    assert len(reassembler) == 1
+    reassembler.check(now=1.0)
+    assert len(reassembler) == 0 and reassembler._bytes == 0
+    assert reassembler.stats["timeouts"] == 1
+
+
+def test_retransmit_buffer_bounded():
+    fragmenter = Fragmenter(fragment_size=100, retransmit_buffer=1000)
+    first = fragmenter.split(os.urandom(900))
+    msg_id = FRAGMENT_HEADER.unpack_from(first[0])[2]
+    fragmenter.split(os.urandom(900))
+    assert fragmenter.retransmit(msg_id, [0], now=0.0) == (None, [])
+    assert fragmenter._sent_bytes <= 1000
+
+
+def test_eviction_by_size():
+    reassembler = Reassembler(max_bytes=1000)
+    reassembler.feed(fragment(1, 0, 2, b"a" * 400), SENDER, 0.0)
+    reassembler.feed(fragment(2, 0, 2, b"b" * 400), SENDER, 0.0)
+    reassembler.feed(fragment(3, 0, 2, b"c" * 400), SENDER, 0.0)
+    assert [key[1] for key in reassembler._pending] == [2, 3]
+    assert reassembler._bytes <= 1000
+    assert reassembler.stats["evicted"] == 1
+
+
+def test_empty_fragments_charged_for_their_slots():
+    # fresh message ids announcing lots of fragments, no payload
+    reassembler = Reassembler(max_bytes=100_000, max_messages=10_000, max_per_sender=10_000)
+    for msg_id in range(1000):
+        reassembler.feed(fragment(msg_id, 0, 4096), SENDER, 0.0)
+    assert len(reassembler) == 100_000 // (4096 * SLOT_COST)
+    assert reassembler._bytes <= 100_000
+
+
+def test_message_caps():
+    reassembler = Reassembler(max_messages=8, max_per_sender=3)
+    for msg_id in range(5):
+        reassembler.feed(fragment(msg_id, 0, 2), ("10.0.0.9", 1000 + msg_id), 0.0)
+    # the source port doesn't make an other sender
+    assert [key[1] for key in reassembler._pending] == [2, 3, 4]
+    for ip in range(10):
+        reassembler.feed(fragment(100 + ip, 0, 2), (f"10.0.1.{ip}", 57000), 0.0)
+    assert len(reassembler) == 8
+    assert sum(reassembler._per_sender.values()) == 8
+
+
+@pytest.mark.parametrize("size", [None, 0])
+def test_no_fragment_size(size):
+    assert not Fragmenter(fragment_size=size).needs_split(b"x" * 100_000)
@@ -0,0 +1,73 @@
+import copy
+import pickle
+
+import pytest
+
+from stmp.interfaces import Packet, PacketHeader, Peer
+
+HEADER = {
+    "user": "tester",
+    "hostname": "box",
+    "udpport": 50000,
+    "tcpport": 50001,
+    "namespace": "/chat",
+    "hv": 5,
+    "ser": "raw",
+    "unknown": "ignored",
+}
+
+
+def test_slotted():
+    for cls in (Packet, Peer, PacketHeader):
+        assert "__slots__" in vars(cls)
+    # the fields are slots, the dict is only there for the application attributes
+    peer = Peer.from_header(HEADER, "10.0.0.2", 1.0)
+    assert vars(peer) == {}
+    assert not hasattr(PacketHeader.from_header(HEADER), "__dict__")
+
+
+def test_peer_from_header():
+    peer = Peer.from_header(HEADER, "10.0.0.2", 12.5, public_key="ab", key_fp="cd")
+    assert (peer.user, peer.hostname, peer.ip) == ("tester", "box", "10.0.0.2")
+    assert (peer.udpport, peer.tcpport, peer.hv) == (50000, 50001, 5)
+    assert (peer.public_key, peer.key_fp, peer.update_time) == ("ab", "cd", 12.5)
+
+
+def test_packet_from_header():
+    packet = Packet.from_header(b"body", HEADER, "10.0.0.2", "UDP", {"id": "1"})
+    assert packet.data == b"body"
+    assert packet.sender == "10.0.0.2" and packet.protocol == "UDP"
+    assert packet.params == {"id": "1"}
+    assert packet.headers.namespace == "/chat"
+    assert packet.headers.ser == "raw" and packet.headers.cmp is None
+    assert Packet.from_header(None, {}, "x", "TCP").params == {}
+
+
+def test_defaults():
+    assert Peer(user="x").hv == 0
+    assert Peer.__new__(Peer).hv == 0  # unset slots read their default
+    assert Packet().data is None
+    assert PacketHeader(user="x").encrypted is False
+    with pytest.raises(AttributeError):
+        Peer().user
+
+
+def test_keyword_constructor():
+    peer = Peer(user="x", ip="10.0.0.3", unknown=1)
+    assert (peer.user, peer.ip) == ("x", "10.0.0.3")
+    assert not hasattr(peer, "unknown")
+    with pytest.raises(ValueError):
+        Peer(strict_parse=True, unknown=1)
+
+
+def test_application_attributes():
+    packet = Packet.from_header({"a": 1}, HEADER, "10.0.0.2", "TCP")
+    packet.reply_to = "/back"
+    assert vars(packet) == {"reply_to": "/back"}
+    # offloaded routes get the packets pickled
+    clone = pickle.loads(pickle.dumps(packet))
+    assert clone.reply_to == "/back"
+    assert clone.data == {"a": 1} and clone.headers.hv == 5
+    peer = Peer.from_header(HEADER, "10.0.0.2", 1.0)
+    peer.nickname = "t"
+    assert copy.copy(peer).nickname == "t"
@@ -0,0 +1,86 @@
+import pytest
+
+from stmp.exceptions import InvalidImplementation
+from stmp.stmp_server.router import Router
+
+
+def callback(body, header, sender_id, protocol):
+    return body
+
+
+def with_params(body, header, sender_id, protocol, params):
+    return params
+
+
+def patterns(router, namespace):
+    return [(route.pattern, params) for route, params in router.resolve(namespace)]
+
+
+@pytest.fixture
+def router():
+    router = Router()
+    for pattern in (
+        "/",
+        "/chat",
+        "/room/{id}/msg",
+        "/room/lobby/msg",
+        "/room/{id}/{kind}",
+        "/sensors/*",
+        "/sensors/temp/{unit}",
+    ):
+        router.add(pattern, callback)
+    return router
+
+
+def test_exact(router):
+    assert patterns(router, "/chat") == [("/chat", {})]
+    assert patterns(router, "chat/") == [("/chat", {})]  # the slashes don't matter
+    assert patterns(router, "/") == [("/", {})]
+    assert patterns(router, "/nothing") == []
+    assert patterns(router, None) == []
+
+
+def test_params(router):
+    assert patterns(router, "/room/12/msg") == [("/room/{id}/msg", {"id": "12"})]
+    assert patterns(router, "/room/12/join") == [
+        ("/room/{id}/{kind}", {"id": "12", "kind": "join"})
+    ]
+    assert patterns(router, "/room/12") == []
+
+
+def test_most_specific_wins(router):
+    assert patterns(router, "/room/lobby/msg") == [("/room/lobby/msg", {})]
+    assert patterns(router, "/sensors/temp/c") == [("/sensors/temp/{unit}", {"unit": "c"})]
+
+
+def test_wildcard(router):
+    assert patterns(router, "/sensors/hum") == [("/sensors/*", {"*": "hum"})]
+    # falls back to the wildcard once the more specific branch doesn't match
+    assert patterns(router, "/sensors/temp/c/raw") == [("/sensors/*", {"*": "temp/c/raw"})]
+    assert patterns(router, "/sensors") == []
+
+
+def test_wildcard_only_at_the_end():
+    with pytest.raises(InvalidImplementation):
+        Router().add("/a/*/b", callback)
+
+
+def test_callbacks_of_a_pattern():
+    router = Router()
+    first, second = router.add("/x/{n}", callback), router.add("/x/{n}", with_params)
+    (route_a, params_a), (route_b, params_b) = router.resolve("/x/5")
+    assert (route_a, route_b) == (first, second)
+    assert params_a == params_b == {"n": "5"}
+    assert route_a("body", {}, "ip", "UDP", params_a) == "body"
+    assert route_b("body", {}, "ip", "UDP", params_b) == {"n": "5"}  # asked for the params
+
+
+def test_cache():
+    router = Router(cache_size=2)
+    router.add("/a/{n}", callback)
+    for n in range(5):
+        assert patterns(router, f"/a/{n}") == [("/a/{n}", {"n": str(n)})]
+    assert len(router._cache) == 2
+    # a new route drops the cached resolutions
+    router.add("/a/4", callback)
+    assert patterns(router, "/a/4") == [("/a/4", {})]
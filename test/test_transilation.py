@@ -0,0 +1,109 @@
+import struct
+
+import pytest
+
+from stmp.stmp_server.transilation import TransilationProtocol
+from stmp.stmp_server.transilation.headers import BinaryHeader
+
+
+@pytest.fixture(scope="module")
+def protocol():
+    return TransilationProtocol(udp_port=50000, tcp_port=50001, user="tester", hostname="box")
+
+
+def unpack(protocol, packet):
+    """Split a packet back into the decoded header and body"""
+    n = protocol.size()
+    version, header_s, body_s = protocol.unpack_prefix(packet[:n])
+    header = protocol.decode_header(packet[n : n + header_s], version)
+    assert len(packet) == n + header_s + body_s
+    body = protocol.decode_parts(
+        packet[n + header_s :],
+        decrypt=header.get("encrypted") and header.get("cipher", True),
+        serializer=header.get("ser", "json"),
+        compression=header.get("cmp"),
+    )
+    return version, header, body
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_round_trip(protocol, binary):
+    data = {"msg": "hello", "values": [1, 2.5, None]}
+    version, header, body = unpack(
+        protocol, protocol.pack(data, namespace="/chat/room", binary_header=binary)
+    )
+    assert bool(version) == binary
+    assert body == data
+    assert header["namespace"] == "/chat/room"
+    assert header["user"] == "tester" and header["hostname"] == "box"
+    assert (header["udpport"], header["tcpport"]) == (50000, 50001)
+    assert header["key_fp"] == protocol.default_header["key_fp"]
+
+
+def test_binary_header_optional_fields(protocol):
+    packet = protocol.pack(
+        b"\x00\x01raw",
+        namespace="/bin",
+        pass_pub_key=True,
+        extra_headers={"udp_session": "ab" * 16, "custom": [1, "x"]},
+        serializer="raw",
+        binary_header=True,
+    )
+    _, header, body = unpack(protocol, packet)
+    assert body == b"\x00\x01raw"
+    assert header["ser"] == "raw"
+    assert header["public_key"] == protocol.encyption.pub_key
+    assert header["udp_session"] == "ab" * 16
+    assert header["custom"] == [1, "x"]
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_encrypted_round_trip(protocol, binary):
+    data = {"secret": "x" * 500}
+    _, header, body = unpack(
+        protocol,
+        protocol.pack(data, enc_key=protocol.encyption.pub_key, binary_header=binary),
+    )
+    assert header["encrypted"] and header["cipher"] == "rsa-aes-gcm"
+    assert body == data
+
+
+def test_binary_header_falls_back_to_json(protocol):
+    # too long for the binary header size bits (4095 bytes), fine as JSON
+    namespace = "/" + "a" * 5000
+    version, header, _ = unpack(protocol, protocol.pack({}, namespace=namespace, binary_header=True))
+    assert version == 0
+    assert header["namespace"] == namespace
+
+
+@pytest.mark.parametrize("size", [33000, 70000])
+@pytest.mark.parametrize("binary", [False, True])
+def test_json_header_size_limit(protocol, size, binary):
+    # would set the binary header bit (or overflow the size bytes)
+    with pytest.raises(ValueError):
+        protocol.pack({"msg": 1}, namespace="/" + "a" * size, binary_header=binary)
+
+
+def test_biggest_json_header(protocol):
+    header_size = len(protocol.pack({}, namespace="/")) - protocol.size() - 2
+    namespace = "/" + "a" * (protocol._json_header_size_mask - header_size)
+    version, header, _ = unpack(protocol, protocol.pack({}, namespace=namespace))
+    assert version == 0
+    assert header["namespace"] == namespace
+    with pytest.raises(ValueError):
+        protocol.pack({}, namespace=namespace + "a")
+
+
+def test_unsupported_binary_version(protocol):
+    packet = protocol.pack({}, binary_header=True)
+    n = protocol.size()
+    header_s, body_s = struct.unpack("!HI", packet[:n])
+    header_s = (header_s & ~0x7000) | (2 << 12)  # 2..4 never carried binary headers
+    version, size, _ = protocol.unpack_prefix(struct.pack("!HI", header_s, body_s))
+    assert version == 2
+    assert protocol.decode_header(packet[n : n + size], version) is None
+
+
+def test_binary_header_rejects_unencodable():
+    with pytest.raises(ValueError):
+        BinaryHeader().encode({"udpport": 70000, "tcpport": 1})